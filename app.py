@@ -1,10 +1,24 @@
-from flask import Flask, render_template, request, redirect, session, url_for, flash
+from flask import Flask, render_template, request, redirect, session, url_for, flash, g, has_app_context, jsonify, Response, abort, send_file
 import sqlite3
 import os
+import re
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from collections import OrderedDict, deque
 import secrets
+import random
+import shutil
+import click
 import hashlib
+import mimetypes
+import tempfile
 from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from PIL import Image, ImageOps
 from twilio.rest import Client
 
 app = Flask(__name__)
@@ -14,14 +28,31 @@ app.secret_key = "sarna_broker_secret_key"
 UPLOAD_FOLDER = "static/uploads/crops"
 BILL_FOLDER = "static/uploads/bills"
 PROFILE_FOLDER = "static/uploads/miller_docs" 
+STORE_FOLDER = "uploads/store"
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", 16))
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(BILL_FOLDER, exist_ok=True)
 os.makedirs(PROFILE_FOLDER, exist_ok=True)
+os.makedirs(STORE_FOLDER, exist_ok=True)
 
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["BILL_FOLDER"] = BILL_FOLDER
 app.config["PROFILE_FOLDER"] = PROFILE_FOLDER 
+app.config["STORE_FOLDER"] = os.path.abspath(STORE_FOLDER)
+# Werkzeug refuses larger request bodies with 413 before any upload is read
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
+
+# Crops millers can post (value stored in miller_stock.crop, display label)
+CROP_OPTIONS = [
+    ("wheat", "🌾 Wheat"),
+    ("chawal", "🍚 Chawal (Rice)"),
+    ("sarso", "🌻 Sarso (Mustard)"),
+    ("maize", "🌽 Maize"),
+    ("paddy", "🌾 Paddy"),
+    ("mustard oil cake", "🧈 Mustard Oil Cake"),
+]
+BAG_TYPES = ["Jute", "Plastic", "Jute/Plastic"]
 
 # ---------------- SMS CONFIG ----------------
 # Twilio credentials - set these as environment variables or hardcode below
@@ -39,45 +70,93 @@ if not TWILIO_AUTH_TOKEN:
 if not TWILIO_PHONE_NUMBER:
     TWILIO_PHONE_NUMBER = '+16285009154'
 
+# "twilio" in production, "fake" keeps messages in memory (tests / local dev)
+SMS_TRANSPORT = os.environ.get('SMS_TRANSPORT', 'twilio')
+
+
+class TwilioTransport:
+    """Sends through one Twilio client, built lazily and reused per process."""
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def send(self, to_phone, message_text):
+        with self._lock:
+            if self._client is None:
+                self._client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+        message = self._client.messages.create(
+            body=message_text,
+            from_=TWILIO_PHONE_NUMBER,
+            to=to_phone
+        )
+        return message.sid
+
+
+class FakeTransport:
+    """Local transport: records messages instead of calling the gateway."""
+
+    def __init__(self):
+        self.sent = []
+        self.fail_next = 0  # make the next N sends raise (retry testing)
+        self._lock = threading.Lock()
+
+    def send(self, to_phone, message_text):
+        with self._lock:
+            if self.fail_next:
+                self.fail_next -= 1
+                raise ConnectionError("fake transport failure")
+            self.sent.append((to_phone, message_text))
+            return f"FAKE{len(self.sent)}"
+
+
+sms_transport = FakeTransport() if SMS_TRANSPORT == 'fake' else TwilioTransport()
+
+
+def normalize_sms_phone(to_phone):
+    """Ensure phone number has country code (assume +91 for India if not present)."""
+    if not to_phone.startswith('+'):
+        if to_phone.startswith('91'):
+            return '+' + to_phone
+        return '+91' + to_phone.lstrip('0')
+    return to_phone
+
+
 # ---------------- SMS HELPER FUNCTION ----------------
 def send_sms(to_phone, message_text):
-    """Send SMS using Twilio. Returns True if successful, False otherwise."""
+    """Send SMS right now through sms_transport. Returns True if successful, False otherwise.
+
+    Request handlers should use queue_sms() instead; this is what the outbox
+    dispatcher (and the /test_sms page) call.
+    """
+    if not to_phone:
+        print("⚠️ No phone number provided for SMS")
+        return False
+    
+    try:
+        deliver_sms(to_phone, message_text)
+        return True
+    except Exception:
+        return False
+
+
+def deliver_sms(to_phone, message_text):
+    """Send one SMS and return the provider message id; raises on failure."""
     # Check if credentials are configured
-    if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN or not TWILIO_PHONE_NUMBER:
+    if SMS_TRANSPORT != 'fake' and (not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN or not TWILIO_PHONE_NUMBER):
         print(f"⚠️ SMS not configured. Missing credentials.")
         print(f"   Account SID: {'Set' if TWILIO_ACCOUNT_SID else 'Missing'}")
         print(f"   Auth Token: {'Set' if TWILIO_AUTH_TOKEN else 'Missing'}")
         print(f"   Phone Number: {'Set' if TWILIO_PHONE_NUMBER else 'Missing'}")
         print(f"   Would send to {to_phone}: {message_text}")
-        return False
-    
-    if not to_phone:
-        print("⚠️ No phone number provided for SMS")
-        return False
-    
+        raise RuntimeError("SMS not configured")
+
+    original_phone = to_phone
+    to_phone = normalize_sms_phone(to_phone)
+    print(f"📱 Attempting to send SMS to {to_phone} (original: {original_phone})")
+    print(f"   Message: {message_text[:50]}...")
     try:
-        # Ensure phone number has country code (assume +91 for India if not present)
-        original_phone = to_phone
-        if not to_phone.startswith('+'):
-            if to_phone.startswith('91'):
-                to_phone = '+' + to_phone
-            else:
-                to_phone = '+91' + to_phone.lstrip('0')
-        
-        print(f"📱 Attempting to send SMS to {to_phone} (original: {original_phone})")
-        print(f"   From: {TWILIO_PHONE_NUMBER}")
-        print(f"   Message: {message_text[:50]}...")
-        
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-        message = client.messages.create(
-            body=message_text,
-            from_=TWILIO_PHONE_NUMBER,
-            to=to_phone
-        )
-        print(f"✅ SMS sent successfully to {to_phone}")
-        print(f"   Message SID: {message.sid}")
-        print(f"   Status: {message.status}")
-        return True
+        sid = sms_transport.send(to_phone, message_text)
     except Exception as e:
         print(f"❌ Failed to send SMS to {to_phone}")
         print(f"   Error Type: {type(e).__name__}")
@@ -87,7 +166,10 @@ def send_sms(to_phone, message_text):
             print(f"   ⚠️ Check your Twilio credentials (Account SID, Auth Token)")
         if "phone number" in str(e).lower() or "number" in str(e).lower():
             print(f"   ⚠️ Check the phone number format: {to_phone}")
-        return False
+        raise
+    print(f"✅ SMS sent successfully to {to_phone}")
+    print(f"   Message SID: {sid}")
+    return sid
 
 def clean_phone_number(phone):
     """Clean phone number by removing spaces, dashes, and other non-digit characters except +."""
@@ -177,24 +259,117 @@ def get_phone_for_password_reset(user_id, role=None, is_staff=0, parent_miller_i
 
     return None
 
-def get_all_buyer_phones():
-    """Get all buyer phone numbers."""
-    con = get_db()
-    cur = con.cursor()
-    cur.execute("SELECT DISTINCT phone FROM buyer_profiles WHERE phone IS NOT NULL AND phone != ''")
-    results = cur.fetchall()
-    con.close()
-    phones = [clean_phone_number(r[0]) for r in results if r[0]]
-    phones = [p for p in phones if p]  # Remove None values
-    print(f"📞 Retrieved {len(phones)} buyer phone numbers for broadcast")
-    return phones
-
 # ---------------- DATABASE ----------------
+DATABASE = "database.db"
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+
+# Tuned once per physical connection (not per request)
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",       # ~16 MB page cache
+    "PRAGMA mmap_size=134217728",     # 128 MB memory-mapped I/O
+    "PRAGMA temp_store=MEMORY",
+)
+
+_db_pool = []
+_db_pool_lock = threading.Lock()
+_db_pool_pid = os.getpid()
+db_stats = {"opened": 0, "reused": 0, "discarded": 0}
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that goes back to the worker pool instead of closing.
+
+    Inside a request the same connection is shared by the route and every
+    helper it calls, so close() there is a no-op and the connection is
+    released on app-context teardown.
+    """
+    request_bound = False
+
+    def close(self):
+        if self.request_bound:
+            return
+        release_db(self)
+
+    def commit(self):
+        sqlite3.Connection.commit(self)
+        if self.request_bound:
+            publish_queued_events()
+
+    def really_close(self):
+        sqlite3.Connection.close(self)
+
+
+def _open_db():
+    con = sqlite3.connect(
+        DATABASE, timeout=10, check_same_thread=False, factory=PooledConnection
+    )
+    for pragma in DB_PRAGMAS:
+        con.execute(pragma)
+    db_stats["opened"] += 1
+    return con
+
+
+def _checkout_db():
+    global _db_pool_pid
+    with _db_pool_lock:
+        # Connections must never cross a fork (gunicorn --preload)
+        if _db_pool_pid != os.getpid():
+            _db_pool.clear()
+            _db_pool_pid = os.getpid()
+        if _db_pool:
+            db_stats["reused"] += 1
+            return _db_pool.pop()
+    return _open_db()
+
+
+def release_db(con):
+    """Roll back anything uncommitted and return the connection to the pool."""
+    con.request_bound = False
+    try:
+        if con.in_transaction:
+            con.rollback()
+    except sqlite3.Error:
+        con.really_close()
+        return
+    with _db_pool_lock:
+        if _db_pool_pid == os.getpid() and len(_db_pool) < DB_POOL_SIZE:
+            _db_pool.append(con)
+            return
+        db_stats["discarded"] += 1
+    con.really_close()
+
+
 def get_db():
-    return sqlite3.connect("database.db", timeout=10, check_same_thread=False)
-def upgrade_db():
-    con = get_db()
-    cur = con.cursor()
+    """Connection for the current request (one per request, pooled per worker).
+
+    Outside a request (startup, CLI) a pooled connection is handed out and
+    con.close() returns it to the pool.
+    """
+    if not has_app_context():
+        return _checkout_db()
+    con = g.get("_db")
+    if con is None:
+        con = _checkout_db()
+        con.request_bound = True
+        g._db = con
+    return con
+
+
+@app.teardown_appcontext
+def _teardown_db(exc):
+    con = g.pop("_db", None)
+    if con is not None:
+        release_db(con)
+
+
+def get_db_stats():
+    with _db_pool_lock:
+        return dict(db_stats, pooled=len(_db_pool), pool_size=DB_POOL_SIZE)
+
+
+def upgrade_db(cur):
 
     # Get existing columns
     cur.execute("PRAGMA table_info(miller_bookings)")
@@ -206,12 +381,8 @@ def upgrade_db():
     if "reason" not in cols:
         cur.execute("ALTER TABLE miller_bookings ADD COLUMN reason TEXT")
 
-    con.commit()
-    con.close()
 
-def init_db():
-    con = get_db()
-    cur = con.cursor()
+def init_db(cur):
 
     # USERS
     cur.execute("""
@@ -320,12 +491,8 @@ CREATE TABLE IF NOT EXISTS miller_profiles (
     ))
 
 
-    con.commit()
-    con.close()
     
-def upgrade_miller_stock_status():
-    con = get_db()
-    cur = con.cursor()
+def upgrade_miller_stock_status(cur):
 
     cur.execute("PRAGMA table_info(miller_stock)")
     cols = [c[1] for c in cur.fetchall()]
@@ -336,13 +503,8 @@ def upgrade_miller_stock_status():
             ADD COLUMN status TEXT DEFAULT 'open'
         """)
 
-    con.commit()
-    con.close()
 
-init_db()
-def upgrade_staff_system():
-    con = get_db()
-    cur = con.cursor()
+def upgrade_staff_system(cur):
 
     cur.execute("PRAGMA table_info(users)")
     cols = [c[1] for c in cur.fetchall()]
@@ -353,11 +515,7 @@ def upgrade_staff_system():
     if "parent_miller_id" not in cols:
         cur.execute("ALTER TABLE users ADD COLUMN parent_miller_id INTEGER")
 
-    con.commit()
-    con.close()
-def upgrade_loading_invoices():
-    con = get_db()
-    cur = con.cursor()
+def upgrade_loading_invoices(cur):
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS loading_invoices (
@@ -397,11 +555,7 @@ def upgrade_loading_invoices():
     if "payment_at" not in cols:
         cur.execute("ALTER TABLE loading_invoices ADD COLUMN payment_at DATETIME")
 
-    con.commit()
-    con.close()
 
-upgrade_loading_invoices()
-   
 def get_effective_user_id():
     # For miller staff → parent miller
     if session.get("role") == "miller" and session.get("is_staff"):
@@ -435,9 +589,7 @@ def fix_staff_miller_data():
 
 
 
-def upgrade_partial_loading():
-    con = get_db()
-    cur = con.cursor()
+def upgrade_partial_loading(cur):
 
     cur.execute("PRAGMA table_info(miller_bookings)")
     cols = [c[1] for c in cur.fetchall()]
@@ -465,12 +617,8 @@ def upgrade_partial_loading():
         ADD COLUMN closed_by TEXT
     """)
 
-    con.commit()
-    con.close()
 
-def upgrade_users_table():
-    con = get_db()
-    cur = con.cursor()
+def upgrade_users_table(cur):
     cur.execute("PRAGMA table_info(users)")
     cols = [c[1] for c in cur.fetchall()]
 
@@ -479,14 +627,10 @@ def upgrade_users_table():
             "ALTER TABLE users ADD COLUMN status TEXT DEFAULT 'pending'"
         )
 
-    con.commit()
-    con.close()
 
 
-def upgrade_password_resets_table():
+def upgrade_password_resets_table(cur):
     """Create password reset token table."""
-    con = get_db()
-    cur = con.cursor()
 
     cur.execute("""
         CREATE TABLE IF NOT EXISTS password_resets (
@@ -499,20 +643,9 @@ def upgrade_password_resets_table():
         )
     """)
 
-    con.commit()
-    con.close()
 
 
-upgrade_db()
-upgrade_users_table()
-upgrade_password_resets_table()
-upgrade_partial_loading()
-upgrade_staff_system()
-upgrade_miller_stock_status()
-
-def upgrade_miller_booking_truck_status():
-    con = get_db()
-    cur = con.cursor()
+def upgrade_miller_booking_truck_status(cur):
 
     cur.execute("PRAGMA table_info(miller_bookings)")
     cols = [c[1] for c in cur.fetchall()]
@@ -535,12 +668,8 @@ def upgrade_miller_booking_truck_status():
             ADD COLUMN loaded_at DATETIME
         """)
 
-    con.commit()
-    con.close()
 
-def upgrade_buyer_profile_table():
-    con = get_db()
-    cur = con.cursor()
+def upgrade_buyer_profile_table(cur):
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS buyer_profiles (
@@ -566,14 +695,7 @@ def upgrade_buyer_profile_table():
     if "other_doc" not in cols:
         cur.execute("ALTER TABLE buyer_profiles ADD COLUMN other_doc TEXT")
 
-    con.commit()
-    con.close()
-upgrade_buyer_profile_table()
-upgrade_miller_booking_truck_status()
-
-def upgrade_miller_booking_bill():
-    con = get_db()
-    cur = con.cursor()
+def upgrade_miller_booking_bill(cur):
 
     cur.execute("PRAGMA table_info(miller_bookings)")
     cols = [c[1] for c in cur.fetchall()]
@@ -584,13 +706,9 @@ def upgrade_miller_booking_bill():
             ADD COLUMN bill_document TEXT
         """)
 
-    con.commit()
-    con.close()
 
-def upgrade_miller_booking_qc():
+def upgrade_miller_booking_qc(cur):
     """Add miller quality-check fields to miller_bookings."""
-    con = get_db()
-    cur = con.cursor()
 
     cur.execute("PRAGMA table_info(miller_bookings)")
     cols = [c[1] for c in cur.fetchall()]
@@ -606,15 +724,8 @@ def upgrade_miller_booking_qc():
     if "qc_at" not in cols:
         cur.execute("ALTER TABLE miller_bookings ADD COLUMN qc_at DATETIME")
 
-    con.commit()
-    con.close()
-
-upgrade_miller_booking_bill()
-upgrade_miller_booking_qc()
 
-def upgrade_miller_booking_order_id():
-    con = get_db()
-    cur = con.cursor()
+def upgrade_miller_booking_order_id(cur):
 
     cur.execute("PRAGMA table_info(miller_bookings)")
     cols = [c[1] for c in cur.fetchall()]
@@ -636,11 +747,7 @@ def upgrade_miller_booking_order_id():
                 WHERE id=?
             """, (order_id, booking[0]))
 
-    con.commit()
-    con.close()
-def upgrade_miller_payment_fields():
-    con = get_db()
-    cur = con.cursor()
+def upgrade_miller_payment_fields(cur):
 
     cur.execute("PRAGMA table_info(miller_bookings)")
     cols = [c[1] for c in cur.fetchall()]
@@ -663,11 +770,7 @@ def upgrade_miller_payment_fields():
             ADD COLUMN payment_at DATETIME
         """)
 
-    con.commit()
-    con.close()
-def upgrade_payments_table():
-    con = get_db()
-    cur = con.cursor()
+def upgrade_payments_table(cur):
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS payments (
@@ -682,11 +785,7 @@ def upgrade_payments_table():
     )
     """)
 
-    con.commit()
-    con.close()
-def upgrade_miller_stock_reserved_qty():
-    con = get_db()
-    cur = con.cursor()
+def upgrade_miller_stock_reserved_qty(cur):
 
     cur.execute("PRAGMA table_info(miller_stock)")
     cols = [c[1] for c in cur.fetchall()]
@@ -697,47 +796,116 @@ def upgrade_miller_stock_reserved_qty():
             ADD COLUMN reserved_qty INTEGER DEFAULT 0
         """)
 
-    con.commit()
-    con.close()
 
-upgrade_miller_booking_qc()
-upgrade_miller_booking_order_id()
-upgrade_miller_payment_fields()
-upgrade_payments_table()
-upgrade_miller_stock_reserved_qty()
+# ---------------- ORDER IDS ----------------
+# Order ids (S10001, S10002, ...) come from a counter row bumped inside the
+# booking transaction, so a rolled-back booking gives its number back and two
+# concurrent bookings can never share one. With ORDER_ID_BLOCK_SIZE > 1 each
+# worker reserves a block up front instead (cheaper, but a restarted worker
+# leaves a gap). Either way a number is only taken once the stock is booked.
+ORDER_ID_PREFIX = "S"
+ORDER_ID_START = 10001
+ORDER_ID_BLOCK_SIZE = int(os.environ.get("ORDER_ID_BLOCK_SIZE", 1))
 
-def generate_next_order_id():
-    """Generate next order ID in format S10001, S10002, etc."""
-    con = get_db()
-    cur = con.cursor()
-    
-    # Get the highest order number
+_order_id_block = {"pid": None, "next": 0, "end": 0}
+_order_id_lock = threading.Lock()
+
+
+def upgrade_order_id_sequence(cur):
     cur.execute("""
-        SELECT order_id FROM miller_bookings 
-        WHERE order_id IS NOT NULL AND order_id LIKE 'S%'
-        ORDER BY CAST(SUBSTR(order_id, 2) AS INTEGER) DESC
-        LIMIT 1
+    CREATE TABLE IF NOT EXISTS id_sequences (
+        name TEXT PRIMARY KEY,
+        next_value INTEGER NOT NULL
+    )
     """)
-    result = cur.fetchone()
-    
-    con.close()
-    
-    if result and result[0]:
-        # Extract number from existing order_id (e.g., "S10001" -> 10001)
+
+    # One-time seed from the highest existing order number
+    cur.execute("""
+        SELECT MAX(CAST(SUBSTR(order_id, 2) AS INTEGER))
+        FROM miller_bookings
+        WHERE order_id LIKE 'S%'
+    """)
+    last_number = cur.fetchone()[0] or (ORDER_ID_START - 1)
+
+    # Old concurrent bookings may share an order id; renumber the later ones
+    cur.execute("""
+        SELECT id FROM miller_bookings mb
+        WHERE order_id IS NULL OR EXISTS (
+            SELECT 1 FROM miller_bookings older
+            WHERE older.order_id = mb.order_id AND older.id < mb.id
+        )
+        ORDER BY id
+    """)
+    for (booking_id,) in cur.fetchall():
+        last_number += 1
+        cur.execute(
+            "UPDATE miller_bookings SET order_id=? WHERE id=?",
+            (f"{ORDER_ID_PREFIX}{last_number}", booking_id)
+        )
+
+    cur.execute(
+        "INSERT OR IGNORE INTO id_sequences (name, next_value) VALUES ('order_id', ?)",
+        (last_number + 1,)
+    )
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_miller_bookings_order_id
+        ON miller_bookings (order_id)
+    """)
+
+
+def _reserve_order_numbers(cur, count):
+    """Bump the counter by `count` and return the first reserved number."""
+    cur.execute(
+        "UPDATE id_sequences SET next_value = next_value + ? WHERE name='order_id'",
+        (count,)
+    )
+    cur.execute("SELECT next_value FROM id_sequences WHERE name='order_id'")
+    return cur.fetchone()[0] - count
+
+
+def _order_id_block_empty():
+    block = _order_id_block
+    return block["pid"] != os.getpid() or block["next"] >= block["end"]
+
+
+def refill_order_id_block():
+    """Reserve a fresh block for this worker if it has used up its last one.
+
+    Runs its own short transaction on a separate connection, so call it
+    before the booking takes the write lock. A no-op unless
+    ORDER_ID_BLOCK_SIZE > 1.
+    """
+    if ORDER_ID_BLOCK_SIZE <= 1:
+        return
+    with _order_id_lock:
+        if not _order_id_block_empty():
+            return
+        con = _checkout_db()
         try:
-            last_number = int(result[0][1:])
-            next_number = last_number + 1
-        except ValueError:
-            next_number = 10001
-    else:
-        # Start from S10001
-        next_number = 10001
-    
-    return f"S{next_number}"
+            first = _reserve_order_numbers(con.cursor(), ORDER_ID_BLOCK_SIZE)
+            con.commit()
+        finally:
+            release_db(con)
+        _order_id_block.update(pid=os.getpid(), next=first, end=first + ORDER_ID_BLOCK_SIZE)
 
-def upgrade_miller_profile_table():
-    con = get_db()
-    cur = con.cursor()
+
+def allocate_order_id(cur):
+    """Next order ID in format S10001, S10002, etc.
+
+    Call it on the booking's own cursor, inside the booking transaction and
+    only once the booking is certain.
+    """
+    if ORDER_ID_BLOCK_SIZE > 1:
+        with _order_id_lock:
+            if not _order_id_block_empty():
+                number = _order_id_block["next"]
+                _order_id_block["next"] += 1
+                return f"{ORDER_ID_PREFIX}{number}"
+    # Counter mode, or another thread drained the block since the refill:
+    # take one number inside this transaction
+    return f"{ORDER_ID_PREFIX}{_reserve_order_numbers(cur, 1)}"
+
+def upgrade_miller_profile_table(cur):
 
     cur.execute("PRAGMA table_info(miller_profiles)")
     cols = [c[1] for c in cur.fetchall()]
@@ -773,60 +941,1905 @@ def upgrade_miller_profile_table():
     if "other_doc" not in cols:
         cur.execute("ALTER TABLE miller_profiles ADD COLUMN other_doc TEXT")
 
-    con.commit()
+
+# ---------------- INDEXES ----------------
+# Secondary indexes for the hot joins/filters of the booking pipeline
+INDEXES = [
+    ("idx_miller_bookings_stock", "miller_bookings", "stock_id"),
+    ("idx_miller_bookings_buyer_created", "miller_bookings", "buyer_id, created_at"),
+    ("idx_loading_invoices_booking_created", "loading_invoices", "booking_id, created_at"),
+    ("idx_payments_booking", "payments", "booking_id"),
+    ("idx_payments_buyer_status_paid", "payments", "buyer_id, status, paid_at"),
+    ("idx_miller_stock_miller_created", "miller_stock", "miller_id, created_at"),
+    ("idx_miller_stock_status_qty_created", "miller_stock", "status, quantity, created_at"),
+    ("idx_miller_stock_market", "miller_stock", "status, created_at, id"),
+    ("idx_miller_stock_market_crop", "miller_stock", "status, crop, created_at, id"),
+    ("idx_miller_stock_market_miller", "miller_stock", "miller_id, status, created_at, id"),
+    ("idx_miller_bookings_created", "miller_bookings", "created_at, id"),
+    ("idx_miller_stock_created", "miller_stock", "created_at, id"),
+    ("idx_miller_stock_history_updated", "miller_stock_history", "updated_at, id"),
+    # Download access checks look rows up by file name
+    ("idx_loading_invoices_invoice_file", "loading_invoices", "invoice_file"),
+    ("idx_loading_invoices_final_invoice_file", "loading_invoices", "final_invoice_file"),
+    ("idx_payments_invoice_file", "payments", "invoice_file"),
+    ("idx_miller_bookings_bill_document", "miller_bookings", "bill_document"),
+    ("idx_miller_bookings_final_invoice", "miller_bookings", "final_invoice"),
+    ("idx_crops_image", "crops", "image"),
+    ("idx_trade_bills_bill_file", "trade_bills", "bill_file"),
+]
+
+
+def create_indexes(cur):
+    for name, table, columns in INDEXES:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+
+
+# Representative SQL of the hot routes; `flask check-indexes` fails if any of
+# these plans a full table scan.
+HOT_QUERIES = {
+    "miller_dashboard": ("""
+        SELECT mb.id FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        LEFT JOIN payments p ON p.booking_id = mb.id
+        WHERE mb.miller_id=? ORDER BY mb.created_at DESC
+    """, (1,)),
+    "miller_approved": ("""
+        SELECT mb.id FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        LEFT JOIN payments p ON p.booking_id = mb.id
+        WHERE mb.miller_id = ? AND mb.status = 'approved'
+        ORDER BY mb.created_at DESC
+    """, (1,)),
+    "miller_stocks": ("""
+        SELECT * FROM miller_stock WHERE miller_id=? ORDER BY created_at DESC
+    """, (1,)),
+    "market_stock": ("""
+        SELECT ms.id FROM miller_stock ms
+        JOIN users u ON ms.miller_id = u.id
+        WHERE ms.status = 'open' AND ms.quantity > 0
+          AND (ms.created_at, ms.id) < (?, ?)
+        ORDER BY ms.created_at DESC, ms.id DESC LIMIT 25
+    """, ("9999", 0)),
+    "market_stock_crop": ("""
+        SELECT ms.id FROM miller_stock ms
+        JOIN users u ON ms.miller_id = u.id
+        WHERE ms.status = 'open' AND ms.quantity > 0 AND ms.crop = ?
+          AND ms.price BETWEEN ? AND ?
+        ORDER BY ms.created_at DESC, ms.id DESC LIMIT 25
+    """, ("wheat", 0, 9999)),
+    "market_stock_miller": ("""
+        SELECT ms.id FROM miller_stock ms
+        JOIN users u ON ms.miller_id = u.id
+        WHERE ms.status = 'open' AND ms.quantity > 0 AND ms.miller_id = ?
+        ORDER BY ms.created_at DESC, ms.id DESC LIMIT 25
+    """, (1,)),
+    "market_bookings": ("""
+        SELECT mb.id FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        LEFT JOIN payments p ON p.booking_id = mb.id
+        WHERE mb.buyer_id=? ORDER BY mb.created_at DESC
+    """, (1,)),
+    "loading_invoices": ("""
+        SELECT id FROM loading_invoices WHERE booking_id IN (?, ?)
+        ORDER BY created_at ASC
+    """, (1, 2)),
+    "final_hisab_invoices": ("""
+        SELECT li.id FROM loading_invoices li
+        JOIN miller_bookings mb ON li.booking_id = mb.id
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE ms.miller_id = ? ORDER BY li.created_at ASC
+    """, (1,)),
+    "buyer_payments": ("""
+        SELECT mb.order_id FROM payments p
+        JOIN miller_bookings mb ON p.booking_id = mb.id
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        JOIN users u ON ms.miller_id = u.id
+        WHERE p.buyer_id=? AND p.status='paid' ORDER BY p.paid_at DESC
+    """, (1,)),
+}
+
+
+def find_full_scans(cur):
+    """Return {query_name: [plan lines]} for hot queries that scan a whole table."""
+    scans = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+        # Any SCAN (even over a covering index) walks the whole table
+        bad = [r[3] for r in cur.fetchall() if r[3].startswith("SCAN")]
+        if bad:
+            scans[name] = bad
+    return scans
+
+
+@app.cli.command("check-indexes")
+def check_indexes_command():
+    """Fail if a hot route query plans a full table scan."""
+    con = get_db()
+    scans = find_full_scans(con.cursor())
     con.close()
+    for name, lines in scans.items():
+        print(f"❌ {name}: {'; '.join(lines)}")
+    if scans:
+        raise SystemExit(1)
+    print(f"✅ {len(HOT_QUERIES)} hot queries use indexes")
+
+
+# ---------------- SMS OUTBOX ----------------
+# Handlers enqueue SMS rows in the same transaction as their state change;
+# a background dispatcher delivers them with retries and records the status.
+SMS_DISPATCHER = os.environ.get('SMS_DISPATCHER', 'thread')  # "thread" | "off"
+SMS_BATCH_SIZE = 50
+SMS_CONCURRENCY = int(os.environ.get('SMS_CONCURRENCY', 8))  # parallel gateway calls
+SMS_POLL_SECONDS = 5
+SMS_MAX_ATTEMPTS = 5
+SMS_RETRY_BASE_SECONDS = 30     # 30s, 60s, 120s, ...
+SMS_CLAIM_TIMEOUT_SECONDS = 300  # reclaim rows from a dispatcher that died mid-send
+
+
+def upgrade_sms_outbox(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sms_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        to_phone TEXT,
+        body TEXT,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        claimed_at DATETIME,
+        last_error TEXT,
+        provider_sid TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        sent_at DATETIME
+    )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_sms_outbox_status_next
+        ON sms_outbox (status, next_attempt_at)
+    """)
 
-# Call the upgrade function after it's defined
-upgrade_miller_profile_table()
 
-# ---------------- AUTH ----------------
-@app.route("/", methods=["GET", "POST"])
-def login():
-    # Show a one-time success message after password reset
-    if request.method == "GET" and request.args.get("reset") == "1":
-        return render_template(
-            "login.html",
-            success="✅ Password updated successfully. Please login with your new password."
-        )
+def queue_sms(cur, to_phone, message_text):
+    """Enqueue an SMS on the caller's cursor; it is sent once the caller commits."""
+    if not to_phone:
+        print("⚠️ No phone number provided for SMS")
+        return None
+    cur.execute(
+        "INSERT INTO sms_outbox (to_phone, body) VALUES (?, ?)",
+        (to_phone, message_text)
+    )
+    if has_app_context():
+        g._sms_queued = True
+    return cur.lastrowid
 
-    if request.method == "POST":
 
-        email = request.form.get("email")
-        password = request.form.get("password")
+def _claim_sms_batch(con):
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute("""
+        SELECT id, to_phone, body, attempts, broadcast_id
+        FROM sms_outbox
+        WHERE (status='pending' AND next_attempt_at <= CURRENT_TIMESTAMP)
+           OR (status='sending' AND claimed_at <= datetime('now', ?))
+        ORDER BY id
+        LIMIT ?
+    """, (f"-{SMS_CLAIM_TIMEOUT_SECONDS} seconds", SMS_BATCH_SIZE))
+    rows = cur.fetchall()
+    if rows:
+        placeholders = ",".join(["?"] * len(rows))
+        cur.execute(f"""
+            UPDATE sms_outbox
+            SET status='sending', claimed_at=CURRENT_TIMESTAMP
+            WHERE id IN ({placeholders})
+        """, [r[0] for r in rows])
+    con.commit()
+    return rows
 
-        if not email or not password:
-            return render_template(
-                "login.html",
-                error="Please enter email and password"
-            )
 
-        con = get_db()
-        cur = con.cursor()
-        cur.execute(
-            "SELECT id, name, email, password, role, status, is_staff, parent_miller_id FROM users WHERE email=? AND password=?",
-            (email, password)
-        )
-        user = cur.fetchone()
-        con.close()
+_sms_pool = None
+_sms_pool_pid = None
 
-        if not user:
-            return render_template(
-                "login.html",
-                error="Invalid credentials"
-            )
 
-        if user[5] != "approved":
-            return render_template(
-                "login.html",
-                error="⛔ Your account is not approved by admin yet"
-            )
+def _get_sms_pool():
+    global _sms_pool, _sms_pool_pid
+    if _sms_pool is None or _sms_pool_pid != os.getpid():
+        _sms_pool = ThreadPoolExecutor(max_workers=SMS_CONCURRENCY, thread_name_prefix="sms")
+        _sms_pool_pid = os.getpid()
+    return _sms_pool
 
-        session["user_id"] = user[0] 
-        session["role"] = user[4]
-        session["is_staff"] = user[6] if user[6] else 0
-        session["parent_miller_id"] = user[7] if user[7] else None
 
-        if user[4] == "farmer":
+def dispatch_sms_batch():
+    """Deliver one batch of due outbox messages. Returns how many were attempted.
+
+    Gateway calls run on a bounded thread pool; all database writes stay on
+    the calling thread, in one short transaction once every call has finished,
+    so no write lock is held while the gateway is slow.
+    """
+    con = get_db()
+    try:
+        expand_broadcasts(con)
+        rows = _claim_sms_batch(con)
+        if not rows:
+            return 0
+        pool = _get_sms_pool()
+        futures = [(r, pool.submit(deliver_sms, r[1], r[2])) for r in rows]
+        wait([f for _, f in futures])
+
+        begin_write(con)
+        cur = con.cursor()
+        for (sms_id, to_phone, body, attempts, broadcast_id), future in futures:
+            attempts += 1
+            error = future.exception()
+            if error is not None:
+                if attempts >= SMS_MAX_ATTEMPTS:
+                    cur.execute("""
+                        UPDATE sms_outbox
+                        SET status='failed', attempts=?, last_error=?
+                        WHERE id=?
+                    """, (attempts, str(error)[:500], sms_id))
+                else:
+                    delay = SMS_RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+                    cur.execute("""
+                        UPDATE sms_outbox
+                        SET status='pending', attempts=?, last_error=?,
+                            next_attempt_at=datetime('now', ?)
+                        WHERE id=?
+                    """, (attempts, str(error)[:500], f"+{delay} seconds", sms_id))
+            else:
+                cur.execute("""
+                    UPDATE sms_outbox
+                    SET status='sent', attempts=?, provider_sid=?,
+                        last_error=NULL, sent_at=CURRENT_TIMESTAMP
+                    WHERE id=?
+                """, (attempts, future.result(), sms_id))
+        update_broadcast_progress(cur, {r[4] for r in rows if r[4]})
+        con.commit()
+        return len(rows)
+    finally:
+        con.close()
+
+
+class SmsDispatcher(threading.Thread):
+    """Per-process background thread draining sms_outbox."""
+
+    def __init__(self):
+        super().__init__(name="sms-dispatcher", daemon=True)
+        self.wake = threading.Event()
+        self.pid = os.getpid()
+
+    def run(self):
+        while True:
+            try:
+                if dispatch_sms_batch():
+                    continue  # keep draining while there is work
+            except Exception as e:
+                print(f"❌ SMS dispatcher error: {type(e).__name__}: {e}")
+            self.wake.wait(SMS_POLL_SECONDS)
+            self.wake.clear()
+
+
+_sms_dispatcher = None
+_sms_dispatcher_lock = threading.Lock()
+
+
+def wake_sms_dispatcher():
+    """Start this worker's dispatcher thread if needed and nudge it."""
+    global _sms_dispatcher
+    if SMS_DISPATCHER != 'thread':
+        return
+    with _sms_dispatcher_lock:
+        # Threads do not survive a fork, so each worker starts its own
+        if _sms_dispatcher is None or _sms_dispatcher.pid != os.getpid():
+            _sms_dispatcher = SmsDispatcher()
+            _sms_dispatcher.start()
+    _sms_dispatcher.wake.set()
+
+
+@app.teardown_appcontext
+def _wake_sms_after_request(exc):
+    # Runs after the request's transaction was committed (or rolled back)
+    if g.pop("_sms_queued", False):
+        wake_sms_dispatcher()
+
+
+# ---------------- BROADCASTS ----------------
+# A broadcast (e.g. "new stock posted") is recorded as one job row by the
+# request. The dispatcher expands it into sms_outbox rows in batches and the
+# outbox delivers them, so posting stock costs the same for 10 or 10,000 buyers.
+BROADCAST_BATCH_SIZE = 500
+
+
+def upgrade_sms_broadcasts(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sms_broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT,
+        stock_id INTEGER,
+        body TEXT,
+        status TEXT DEFAULT 'pending',
+        total_recipients INTEGER DEFAULT 0,
+        sent_count INTEGER DEFAULT 0,
+        failed_count INTEGER DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        expanded_at DATETIME,
+        finished_at DATETIME
+    )
+    """)
+    cur.execute("PRAGMA table_info(sms_outbox)")
+    cols = [c[1] for c in cur.fetchall()]
+    if "broadcast_id" not in cols:
+        cur.execute("ALTER TABLE sms_outbox ADD COLUMN broadcast_id INTEGER")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_sms_outbox_broadcast_status
+        ON sms_outbox (broadcast_id, status)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_sms_broadcasts_status
+        ON sms_broadcasts (status)
+    """)
+
+
+def queue_broadcast(cur, kind, message_text, stock_id=None):
+    """Record a broadcast job on the caller's cursor (sent after commit)."""
+    cur.execute(
+        "INSERT INTO sms_broadcasts (kind, stock_id, body) VALUES (?, ?, ?)",
+        (kind, stock_id, message_text)
+    )
+    if has_app_context():
+        g._sms_queued = True
+    return cur.lastrowid
+
+
+def upgrade_crop_subscriptions(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS buyer_crop_subscriptions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        buyer_id INTEGER,
+        crop TEXT,
+        max_price INTEGER,
+        bag_type TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_crop_subscriptions_crop_price
+        ON buyer_crop_subscriptions (crop, max_price)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_crop_subscriptions_buyer
+        ON buyer_crop_subscriptions (buyer_id)
+    """)
+
+
+def seed_default_subscriptions(cur, buyer_id=None):
+    """Subscribe buyers that have no alerts yet to every crop, with no limits.
+
+    Before subscriptions every buyer got every stock SMS; this keeps that for
+    existing buyers (and new profiles) until they narrow their alerts down.
+    """
+    cur.execute("""
+        SELECT bp.buyer_id FROM buyer_profiles bp
+        WHERE (? IS NULL OR bp.buyer_id = ?)
+          AND NOT EXISTS (
+              SELECT 1 FROM buyer_crop_subscriptions s WHERE s.buyer_id = bp.buyer_id
+          )
+    """, (buyer_id, buyer_id))
+    buyers = [r[0] for r in cur.fetchall()]
+    cur.executemany(
+        "INSERT INTO buyer_crop_subscriptions (buyer_id, crop) VALUES (?, ?)",
+        [(b, crop) for b in buyers for crop, _ in CROP_OPTIONS]
+    )
+
+
+def iter_broadcast_recipients(cur, kind, stock_id):
+    """Yield cleaned, de-duplicated phones of buyers subscribed to this stock.
+
+    A subscription matches on crop (indexed), optionally capped by price and
+    restricted to a bag type; "Jute/Plastic" lots reach Jute and Plastic
+    subscribers and a "Jute/Plastic" subscriber hears about either.
+    """
+    cur.execute("SELECT crop, price, bag_type FROM miller_stock WHERE id=?", (stock_id,))
+    stock = cur.fetchone()
+    if not stock:
+        return
+    crop, price, bag_type = stock
+    cur.execute("""
+        SELECT DISTINCT bp.phone
+        FROM buyer_crop_subscriptions s
+        JOIN buyer_profiles bp ON bp.buyer_id = s.buyer_id
+        WHERE s.crop = :crop
+          AND (s.max_price IS NULL OR s.max_price >= :price)
+          AND (s.bag_type IS NULL
+               OR '/' || :bag || '/' LIKE '%/' || s.bag_type || '/%'
+               OR '/' || s.bag_type || '/' LIKE '%/' || :bag || '/%')
+          AND bp.phone IS NOT NULL AND bp.phone != ''
+    """, {"crop": (crop or "").strip().lower(), "price": price or 0, "bag": bag_type or ""})
+    seen = set()
+    while True:
+        rows = cur.fetchmany(BROADCAST_BATCH_SIZE)
+        if not rows:
+            return
+        for r in rows:
+            phone = clean_phone_number(r[0])
+            if phone and phone not in seen:
+                seen.add(phone)
+                yield phone
+
+
+def expand_broadcasts(con):
+    """Turn pending broadcast jobs into outbox rows, one job per transaction."""
+    cur = con.cursor()
+    while True:
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("""
+            SELECT id, kind, stock_id, body FROM sms_broadcasts
+            WHERE status='pending' ORDER BY id LIMIT 1
+        """)
+        job = cur.fetchone()
+        if not job:
+            con.commit()
+            return
+        broadcast_id, kind, stock_id, body = job
+        total = 0
+        batch = []
+        read_cur = con.cursor()
+        for phone in iter_broadcast_recipients(read_cur, kind, stock_id):
+            batch.append((phone, body, broadcast_id))
+            if len(batch) >= BROADCAST_BATCH_SIZE:
+                cur.executemany(
+                    "INSERT INTO sms_outbox (to_phone, body, broadcast_id) VALUES (?, ?, ?)",
+                    batch
+                )
+                total += len(batch)
+                batch = []
+        if batch:
+            cur.executemany(
+                "INSERT INTO sms_outbox (to_phone, body, broadcast_id) VALUES (?, ?, ?)",
+                batch
+            )
+            total += len(batch)
+        cur.execute("""
+            UPDATE sms_broadcasts
+            SET status=?, total_recipients=?, expanded_at=CURRENT_TIMESTAMP,
+                finished_at=CASE WHEN ?=0 THEN CURRENT_TIMESTAMP END
+            WHERE id=?
+        """, ("sending" if total else "done", total, total, broadcast_id))
+        con.commit()
+        print(f"📣 Broadcast {broadcast_id} ({kind}) expanded to {total} recipients")
+
+
+def update_broadcast_progress(cur, broadcast_ids):
+    for broadcast_id in broadcast_ids:
+        cur.execute("""
+            SELECT
+                SUM(status='sent'),
+                SUM(status='failed'),
+                SUM(status IN ('pending','sending'))
+            FROM sms_outbox
+            WHERE broadcast_id=?
+        """, (broadcast_id,))
+        sent, failed, open_count = cur.fetchone()
+        cur.execute("""
+            UPDATE sms_broadcasts
+            SET sent_count=?, failed_count=?,
+                status=CASE WHEN ?=0 THEN 'done' ELSE 'sending' END,
+                finished_at=CASE WHEN ?=0 THEN CURRENT_TIMESTAMP END
+            WHERE id=?
+        """, (sent or 0, failed or 0, open_count or 0, open_count or 0, broadcast_id))
+
+
+@app.cli.command("sms-dispatch")
+def sms_dispatch_command():
+    """Run the SMS outbox dispatcher in the foreground (separate worker process)."""
+    print("📱 SMS dispatcher running")
+    while True:
+        if not dispatch_sms_batch():
+            time.sleep(SMS_POLL_SECONDS)
+
+
+# ---------------- DAILY ROLLUPS ----------------
+# Admin analytics read small per-day tables instead of raw history. SQLite
+# triggers keep them current from every writer, and `flask rebuild-rollups`
+# recomputes them from scratch. Days are UTC, like CURRENT_TIMESTAMP.
+# booked_value is qty x the lot's current price (what invoices charge), so a
+# price change on a lot re-values its bookings' rows, as a rebuild would.
+#   daily_booking_stats   day x crop x miller: bookings, qty/value booked,
+#                         qty loaded (truck day), qty QC verified (QC day)
+#   daily_booking_status  booking day x booking status: bookings, qty
+#   daily_payment_stats   booking day x payment status: payments, amount
+
+def _stats_upsert(day, booking_id, **values):
+    """SQL adding values to the daily_booking_stats row of a booking's crop/miller."""
+    cols = ", ".join(values)
+    exprs = ", ".join(values.values())
+    sets = ", ".join(f"{c} = {c} + excluded.{c}" for c in values)
+    return f"""
+        INSERT INTO daily_booking_stats (day, crop, miller_id, {cols})
+        SELECT {day}, IFNULL(ms.crop, ''), IFNULL(ms.miller_id, 0), {exprs}
+        FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE mb.id = {booking_id} AND {day} IS NOT NULL
+        ON CONFLICT(day, crop, miller_id) DO UPDATE SET {sets};
+    """
+
+
+def _status_upsert(table, count_col, amount_col, day, status, amount):
+    return f"""
+        INSERT INTO {table} (day, status, {count_col}, {amount_col})
+        SELECT {day}, {status}, 1, {amount}
+        WHERE {day} IS NOT NULL
+        ON CONFLICT(day, status) DO UPDATE SET
+            {count_col} = {count_col} + 1,
+            {amount_col} = {amount_col} + excluded.{amount_col};
+    """
+
+
+def _status_remove(table, count_col, amount_col, day, status, amount):
+    return f"""
+        UPDATE {table}
+        SET {count_col} = {count_col} - 1,
+            {amount_col} = {amount_col} - {amount}
+        WHERE day = {day} AND status = {status};
+        DELETE FROM {table}
+        WHERE day = {day} AND status = {status} AND {count_col} <= 0;
+    """
+
+
+_BOOKING_DAY = "(SELECT date(created_at) FROM miller_bookings WHERE id = {}.booking_id)"
+
+ROLLUP_TRIGGERS = {
+    "trg_rollup_booking_insert": f"""
+        AFTER INSERT ON miller_bookings
+        BEGIN
+            {_stats_upsert("date(NEW.created_at)", "NEW.id",
+                           bookings="1",
+                           booked_qty="IFNULL(NEW.quantity, 0)",
+                           booked_value="IFNULL(NEW.quantity, 0) * IFNULL(ms.price, 0)")}
+            {_status_upsert("daily_booking_status", "bookings", "qty",
+                            "date(NEW.created_at)", "IFNULL(NEW.status, 'pending')",
+                            "IFNULL(NEW.quantity, 0)")}
+        END
+    """,
+    "trg_rollup_booking_status": f"""
+        AFTER UPDATE OF status ON miller_bookings
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            {_status_remove("daily_booking_status", "bookings", "qty",
+                            "date(OLD.created_at)", "IFNULL(OLD.status, 'pending')",
+                            "IFNULL(OLD.quantity, 0)")}
+            {_status_upsert("daily_booking_status", "bookings", "qty",
+                            "date(OLD.created_at)", "IFNULL(NEW.status, 'pending')",
+                            "IFNULL(NEW.quantity, 0)")}
+        END
+    """,
+    "trg_rollup_loading_insert": f"""
+        AFTER INSERT ON loading_invoices
+        BEGIN
+            {_stats_upsert("date(NEW.created_at)", "NEW.booking_id",
+                           loaded_qty="IFNULL(NEW.loaded_qty, 0)")}
+        END
+    """,
+    "trg_rollup_qc_verified": f"""
+        AFTER UPDATE OF qc_status ON loading_invoices
+        WHEN NEW.qc_status = 'verified' AND OLD.qc_status IS NOT 'verified'
+        BEGIN
+            {_stats_upsert("date(IFNULL(NEW.qc_at, CURRENT_TIMESTAMP))", "NEW.booking_id",
+                           qc_qty="IFNULL(NEW.loaded_qty, 0)")}
+        END
+    """,
+    "trg_rollup_stock_price": """
+        AFTER UPDATE OF price ON miller_stock
+        WHEN OLD.price IS NOT NEW.price
+        BEGIN
+            UPDATE daily_booking_stats
+            SET booked_value = booked_value + (IFNULL(NEW.price, 0) - IFNULL(OLD.price, 0)) * (
+                SELECT SUM(IFNULL(mb.quantity, 0))
+                FROM miller_bookings mb
+                WHERE mb.stock_id = NEW.id AND date(mb.created_at) = daily_booking_stats.day
+            )
+            WHERE crop = IFNULL(OLD.crop, '') AND miller_id = IFNULL(OLD.miller_id, 0)
+              AND day IN (SELECT date(created_at) FROM miller_bookings WHERE stock_id = NEW.id);
+        END
+    """,
+    "trg_rollup_payment_insert": f"""
+        AFTER INSERT ON payments
+        BEGIN
+            {_status_upsert("daily_payment_stats", "payments", "amount",
+                            _BOOKING_DAY.format("NEW"), "IFNULL(NEW.status, 'pending')",
+                            "IFNULL(NEW.amount, 0)")}
+        END
+    """,
+    "trg_rollup_payment_update": f"""
+        AFTER UPDATE OF status, amount ON payments
+        BEGIN
+            {_status_remove("daily_payment_stats", "payments", "amount",
+                            _BOOKING_DAY.format("OLD"), "IFNULL(OLD.status, 'pending')",
+                            "IFNULL(OLD.amount, 0)")}
+            {_status_upsert("daily_payment_stats", "payments", "amount",
+                            _BOOKING_DAY.format("NEW"), "IFNULL(NEW.status, 'pending')",
+                            "IFNULL(NEW.amount, 0)")}
+        END
+    """,
+}
+
+
+def upgrade_daily_rollups(cur):
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS daily_booking_stats (
+        day TEXT NOT NULL,
+        crop TEXT NOT NULL,
+        miller_id INTEGER NOT NULL,
+        bookings INTEGER DEFAULT 0,
+        booked_qty REAL DEFAULT 0,
+        booked_value REAL DEFAULT 0,
+        loaded_qty REAL DEFAULT 0,
+        qc_qty REAL DEFAULT 0,
+        PRIMARY KEY (day, crop, miller_id)
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS daily_booking_status (
+        day TEXT NOT NULL,
+        status TEXT NOT NULL,
+        bookings INTEGER DEFAULT 0,
+        qty REAL DEFAULT 0,
+        PRIMARY KEY (day, status)
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS daily_payment_stats (
+        day TEXT NOT NULL,
+        status TEXT NOT NULL,
+        payments INTEGER DEFAULT 0,
+        amount REAL DEFAULT 0,
+        PRIMARY KEY (day, status)
+    )
+    """)
+
+    for name, body in ROLLUP_TRIGGERS.items():
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+    rebuild_rollups(cur)
+
+
+def rebuild_rollups(cur):
+    """Recompute every rollup row from the raw tables."""
+    cur.execute("DELETE FROM daily_booking_stats")
+    cur.execute("DELETE FROM daily_booking_status")
+    cur.execute("DELETE FROM daily_payment_stats")
+
+    cur.execute("""
+        INSERT INTO daily_booking_stats
+            (day, crop, miller_id, bookings, booked_qty, booked_value)
+        SELECT date(mb.created_at), IFNULL(ms.crop, ''), IFNULL(ms.miller_id, 0),
+               COUNT(*),
+               SUM(IFNULL(mb.quantity, 0)),
+               SUM(IFNULL(mb.quantity, 0) * IFNULL(ms.price, 0))
+        FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE mb.created_at IS NOT NULL
+        GROUP BY 1, 2, 3
+    """)
+
+    for column, day, where in (
+        ("loaded_qty", "date(li.created_at)", "li.created_at IS NOT NULL"),
+        ("qc_qty", "date(li.qc_at)", "li.qc_status = 'verified' AND li.qc_at IS NOT NULL"),
+    ):
+        cur.execute(f"""
+            INSERT INTO daily_booking_stats (day, crop, miller_id, {column})
+            SELECT {day}, IFNULL(ms.crop, ''), IFNULL(ms.miller_id, 0),
+                   SUM(IFNULL(li.loaded_qty, 0))
+            FROM loading_invoices li
+            JOIN miller_bookings mb ON li.booking_id = mb.id
+            JOIN miller_stock ms ON mb.stock_id = ms.id
+            WHERE {where}
+            GROUP BY 1, 2, 3
+            ON CONFLICT(day, crop, miller_id) DO UPDATE SET
+                {column} = excluded.{column}
+        """)
+
+    cur.execute("""
+        INSERT INTO daily_booking_status (day, status, bookings, qty)
+        SELECT date(created_at), IFNULL(status, 'pending'),
+               COUNT(*), SUM(IFNULL(quantity, 0))
+        FROM miller_bookings
+        WHERE created_at IS NOT NULL
+        GROUP BY 1, 2
+    """)
+
+    cur.execute("""
+        INSERT INTO daily_payment_stats (day, status, payments, amount)
+        SELECT date(mb.created_at), IFNULL(p.status, 'pending'),
+               COUNT(*), SUM(IFNULL(p.amount, 0))
+        FROM payments p
+        JOIN miller_bookings mb ON p.booking_id = mb.id
+        WHERE mb.created_at IS NOT NULL
+        GROUP BY 1, 2
+    """)
+
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Recompute the daily analytics rollups from raw history."""
+    con = _checkout_db()
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        rebuild_rollups(con.cursor())
+        con.commit()
+        print("✅ Daily rollups rebuilt")
+    finally:
+        release_db(con)
+
+
+# ---------------- MARKET CACHE ----------------
+# The open-stock listing is the same for every buyer, so each worker keeps
+# recently served pages in memory. A trigger bumps cache_generations.market in
+# the same transaction as any change to what the listing shows; a request only
+# reads that one row to know whether its cached pages are still current.
+# (PRAGMA data_version would also change on every SMS outbox write and is
+# per connection, so it cannot be compared across the pool.)
+MARKET_CACHE_SIZE = 256
+
+_market_cache = {"generation": None, "pages": OrderedDict()}
+_market_cache_lock = threading.Lock()
+market_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+MARKET_TRIGGERS = {
+    "trg_market_stock_insert": "AFTER INSERT ON miller_stock",
+    "trg_market_stock_update": """
+        AFTER UPDATE OF miller_id, crop, quantity, price, condition, bag_type,
+                        deduction, status, created_at ON miller_stock""",
+    "trg_market_stock_delete": "AFTER DELETE ON miller_stock",
+    "trg_market_miller_name": "AFTER UPDATE OF name ON users WHEN NEW.role = 'miller'",
+}
+
+
+def upgrade_market_cache_generation(cur):
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS cache_generations (
+        name TEXT PRIMARY KEY,
+        generation INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("INSERT OR IGNORE INTO cache_generations (name, generation) VALUES ('market', 0)")
+
+    for name, event in MARKET_TRIGGERS.items():
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {name} {event}
+            BEGIN
+                UPDATE cache_generations SET generation = generation + 1
+                WHERE name = 'market';
+            END
+        """)
+
+
+def market_generation(cur):
+    cur.execute("SELECT generation FROM cache_generations WHERE name='market'")
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def cached_market_page(cur, filters, cursor=None):
+    """(rows, next_cursor, total) for one market page, served from memory when current."""
+    generation = market_generation(cur)
+    key = (tuple(sorted(filters.items())), cursor or "")
+
+    with _market_cache_lock:
+        if _market_cache["generation"] != generation:
+            if _market_cache["pages"]:
+                market_cache_stats["invalidations"] += 1
+            _market_cache["pages"].clear()
+            _market_cache["generation"] = generation
+        page = _market_cache["pages"].get(key)
+        if page is not None:
+            _market_cache["pages"].move_to_end(key)
+            market_cache_stats["hits"] += 1
+            return page
+        market_cache_stats["misses"] += 1
+
+    # Read after the generation, so a write landing in between only makes
+    # this page newer than its generation and the next request refetches
+    rows, next_cursor = fetch_market_stocks(cur, filters, cursor)
+    page = (rows, next_cursor, count_market_stocks(cur, filters))
+
+    with _market_cache_lock:
+        if _market_cache["generation"] == generation:
+            _market_cache["pages"][key] = page
+            while len(_market_cache["pages"]) > MARKET_CACHE_SIZE:
+                _market_cache["pages"].popitem(last=False)
+    return page
+
+
+# ---------------- CHANGE TRACKING ----------------
+# miller_bookings, loading_invoices and payments carry updated_at (ms) and
+# updated_seq, both stamped by triggers on every insert/update. updated_seq
+# comes from one counter bumped inside the write transaction; SQLite runs one
+# writer at a time, so it grows in commit order and is unique, which makes it
+# a watermark that can never skip a change (a timestamp can tie or lag).
+SYNCED_TABLES = {
+    "miller_bookings": "MAX(created_at, IFNULL(decision_at, ''), IFNULL(loaded_at, ''), IFNULL(qc_at, ''))",
+    "loading_invoices": "MAX(created_at, IFNULL(qc_at, ''), IFNULL(payment_at, ''))",
+    "payments": "IFNULL(paid_at, '')",
+}
+
+_NOW_MS = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+def upgrade_change_tracking(cur):
+
+    for table, changed_at in SYNCED_TABLES.items():
+        cur.execute(f"PRAGMA table_info({table})")
+        cols = [c[1] for c in cur.fetchall()]
+        if "updated_at" not in cols:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN updated_at DATETIME")
+        if "updated_seq" not in cols:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN updated_seq INTEGER")
+
+        # Best known time of the last change for existing rows
+        cur.execute(f"UPDATE {table} SET updated_at = {changed_at} WHERE updated_at IS NULL")
+
+    # Number existing rows in change order, across all three tables
+    cur.execute("INSERT OR IGNORE INTO id_sequences (name, next_value) VALUES ('sync', 1)")
+    cur.execute("SELECT next_value FROM id_sequences WHERE name='sync'")
+    seq = cur.fetchone()[0]
+    cur.execute(" UNION ALL ".join(
+        f"SELECT '{t}', id, updated_at FROM {t} WHERE updated_seq IS NULL" for t in SYNCED_TABLES
+    ) + " ORDER BY 3, 2")
+    for table, row_id, _ in cur.fetchall():
+        cur.execute(f"UPDATE {table} SET updated_seq=? WHERE id=?", (seq, row_id))
+        seq += 1
+    cur.execute("UPDATE id_sequences SET next_value=? WHERE name='sync'", (seq,))
+
+    for table in SYNCED_TABLES:
+        touch = f"""
+            UPDATE {table}
+            SET updated_at = {_NOW_MS},
+                updated_seq = (SELECT next_value FROM id_sequences WHERE name='sync')
+            WHERE id = NEW.id;
+            UPDATE id_sequences SET next_value = next_value + 1 WHERE name='sync';
+        """
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_touch_insert
+            AFTER INSERT ON {table}
+            BEGIN {touch} END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_touch_update
+            AFTER UPDATE ON {table}
+            WHEN NEW.updated_seq IS OLD.updated_seq
+            BEGIN {touch} END
+        """)
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_updated_at ON {table} (updated_at)")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_updated_seq ON {table} (updated_seq)")
+
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_miller_bookings_buyer_updated_seq
+        ON miller_bookings (buyer_id, updated_seq)
+    """)
+
+
+# ---------------- IDEMPOTENCY ----------------
+# A POST carrying an Idempotency-Key header (or an idempotency_key form field,
+# see idempotency_key() below) runs once per user and key: a retry within
+# IDEMPOTENCY_TTL_HOURS gets the stored response back instead of booking or
+# loading a second time. The key is claimed (status NULL) before the view
+# runs, so a retry that arrives while the first is still running gets a 409.
+# Keys are written on their own pooled connection, never on the request's, so
+# storing or releasing one can't commit what a failed view left behind. A claim
+# still pending after IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS belonged to a worker
+# that died mid-request; the next retry takes it over.
+IDEMPOTENCY_TTL_HOURS = 24
+IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS = 300
+
+
+def upgrade_idempotency_keys(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            status INTEGER,
+            content_type TEXT,
+            location TEXT,
+            body BLOB,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, key)
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created
+        ON idempotency_keys (created_at)
+    """)
+
+
+@app.template_global()
+def idempotency_key():
+    """Fresh key for a form's hidden idempotency_key field (one per render)."""
+    return secrets.token_urlsafe(16)
+
+
+def _request_fingerprint():
+    """Hash of what the request asks for, so a reused key can't replay another request."""
+    digest = hashlib.sha256(f"{request.method} {request.path}".encode())
+    for name, value in sorted(request.form.items(multi=True)):
+        if name != "idempotency_key":
+            digest.update(f"\0{name}={value}".encode())
+    for name, upload in sorted(request.files.items(multi=True), key=lambda f: f[0]):
+        # The bytes, not just the name: a retry with another photo is another request
+        digest.update(f"\0{name}@{upload.filename}:".encode())
+        for chunk in iter(lambda: upload.stream.read(UPLOAD_CHUNK), b""):
+            digest.update(chunk)
+        upload.stream.seek(0)
+    return digest.hexdigest()
+
+
+@app.before_request
+def _claim_idempotency_key():
+    user_id = session.get("user_id")
+    if request.method != "POST" or not user_id:
+        return None
+    key = request.headers.get("Idempotency-Key") or request.form.get("idempotency_key")
+    if not key:
+        return None
+    key = key[:128]
+    fingerprint = _request_fingerprint()
+
+    con = _checkout_db()
+    try:
+        cur = con.cursor()
+        cur.execute(
+            "DELETE FROM idempotency_keys WHERE created_at < datetime('now', ?)",
+            (f"-{IDEMPOTENCY_TTL_HOURS} hours",)
+        )
+        cur.execute("""
+            INSERT OR IGNORE INTO idempotency_keys (user_id, key, fingerprint)
+            VALUES (?, ?, ?)
+        """, (user_id, key, fingerprint))
+        claimed = cur.rowcount == 1
+        if not claimed:
+            cur.execute("""
+                UPDATE idempotency_keys
+                SET created_at = CURRENT_TIMESTAMP
+                WHERE user_id=? AND key=? AND fingerprint=? AND status IS NULL
+                  AND created_at < datetime('now', ?)
+            """, (user_id, key, fingerprint, f"-{IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS} seconds"))
+            claimed = cur.rowcount == 1
+        con.commit()
+        if claimed:
+            g.idempotency_claim = (user_id, key)
+            return None
+
+        cur.execute("""
+            SELECT fingerprint, status, content_type, location, body
+            FROM idempotency_keys
+            WHERE user_id=? AND key=?
+        """, (user_id, key))
+        row = cur.fetchone()
+    finally:
+        release_db(con)
+    if not row:
+        return None
+
+    stored_fingerprint, status, content_type, location, body = row
+    if stored_fingerprint != fingerprint:
+        return {"ok": False, "error": "Idempotency-Key was already used for a different request"}, 422
+    if status is None:
+        return {"ok": False, "error": "This request is still being processed"}, 409
+
+    print(f"🔁 Replayed {request.path} for idempotency key {key}")
+    response = Response(body, status=status, content_type=content_type)
+    if location:
+        response.headers["Location"] = location
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+@app.after_request
+def _store_idempotent_response(response):
+    claim = g.pop("idempotency_claim", None)
+    if claim is None:
+        return response
+
+    # Whatever the view did not commit is discarded (teardown would roll it
+    # back anyway); doing it now also frees the write lock for the key below
+    request_con = g.get("_db")
+    if request_con is not None and request_con.in_transaction:
+        request_con.rollback()
+
+    if response.status_code >= 500 or response.is_streamed or response.direct_passthrough:
+        # Nothing worth replaying; let a retry run again
+        _forget_idempotency_key(claim)
+        return response
+
+    con = _checkout_db()
+    try:
+        con.execute("""
+            UPDATE idempotency_keys
+            SET status=?, content_type=?, location=?, body=?
+            WHERE user_id=? AND key=?
+        """, (response.status_code, response.content_type, response.headers.get("Location"),
+              response.get_data(), *claim))
+        con.commit()
+    finally:
+        release_db(con)
+    return response
+
+
+def _forget_idempotency_key(claim):
+    con = _checkout_db()
+    try:
+        con.execute("DELETE FROM idempotency_keys WHERE user_id=? AND key=?", claim)
+        con.commit()
+    finally:
+        release_db(con)
+
+
+@app.teardown_request
+def _release_idempotency_key(exc):
+    """The view raised before a response was stored: free the key for a retry."""
+    claim = g.pop("idempotency_claim", None)
+    if claim is None:
+        return
+    request_con = g.get("_db")
+    if request_con is not None and request_con.in_transaction:
+        request_con.rollback()
+    _forget_idempotency_key(claim)
+
+
+# ---------------- UPLOAD STORE ----------------
+# Uploads are kept once per content: the file is hashed while it streams to
+# disk and stored as STORE_FOLDER/ab/cd/<sha256>.<ext>. Columns hold that
+# relative path (the "ref"); a name without "/" is an older upload still in
+# static/uploads/<folder> (see import-uploads). Two different IMG_001.jpg no
+# longer overwrite each other, and the same document uploaded again is not
+# stored twice.
+UPLOAD_CHUNK = 64 * 1024
+UPLOAD_MAX_AGE = 365 * 24 * 3600
+# Stored files must be readable by the front proxy (FILE_OFFLOAD), which
+# usually runs as another user; mkstemp alone would leave them 0600. Older
+# stores: `flask store-modes`.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+STORE_FILE_MODE = 0o644 & ~_UMASK
+# <sha256>.<ext> for an original, <sha256>_<width>.jpg for a resized image
+STORE_REF = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(_[0-9]+)?(\.[a-z0-9]{1,10})?$")
+
+# Photos from phones are several MB; pages link to these resized JPEGs
+# instead (longest side in px), written in the background by a process pool
+IMAGE_VARIANTS = {"display": 1280}
+# Listing sizes, made by /thumbs on first request (srcset picks one)
+THUMB_WIDTHS = (160, 480, 1024)
+IMAGE_TYPES = {"image/jpeg", "image/png", "image/webp"}
+IMAGE_QUALITY = 80
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
+
+# Folders under static/uploads that older uploads were saved to
+UPLOAD_FOLDERS = {
+    "crops": UPLOAD_FOLDER,
+    "bills": BILL_FOLDER,
+    "miller_docs": PROFILE_FOLDER,
+}
+
+# Every column that holds an upload, with its folder
+UPLOAD_COLUMNS = [
+    ("crops", "image", "crops"),
+    ("trade_bills", "bill_file", "bills"),
+    ("loading_invoices", "invoice_file", "bills"),
+    ("loading_invoices", "final_invoice_file", "bills"),
+    ("payments", "invoice_file", "bills"),
+    ("miller_bookings", "bill_document", "bills"),
+    ("miller_bookings", "final_invoice", "bills"),
+    ("miller_profiles", "document", "miller_docs"),
+    ("miller_profiles", "gst_doc", "miller_docs"),
+    ("miller_profiles", "mandi_doc", "miller_docs"),
+    ("miller_profiles", "other_doc", "miller_docs"),
+    ("buyer_profiles", "document", "miller_docs"),
+    ("buyer_profiles", "gst_doc", "miller_docs"),
+    ("buyer_profiles", "license_doc", "miller_docs"),
+    ("buyer_profiles", "other_doc", "miller_docs"),
+]
+
+
+def upgrade_upload_store(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS uploads (
+            ref TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            content_type TEXT,
+            original_name TEXT,
+            folder TEXT,
+            uploaded_by INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def stored_path(ref):
+    return os.path.join(app.config["STORE_FOLDER"], ref)
+
+
+def store_stream(stream, filename):
+    """Copy stream into the store, hashing as it goes; returns (ref, size)."""
+    ext = re.sub(r"[^a-z0-9]", "", os.path.splitext(filename)[1].lower())[:10]
+    digest = hashlib.sha256()
+    size = 0
+
+    fd, tmp_path = tempfile.mkstemp(dir=app.config["STORE_FOLDER"], prefix=".incoming-")
+    try:
+        os.fchmod(fd, STORE_FILE_MODE)
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK), b""):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+
+        hex_digest = digest.hexdigest()
+        ref = f"{hex_digest[:2]}/{hex_digest[2:4]}/{hex_digest}" + (f".{ext}" if ext else "")
+        path = stored_path(ref)
+        try:
+            # Duplicate: restart upload-gc's grace period, as a new write would
+            os.utime(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    finally:
+        # Already stored (duplicate) or failed half way
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return ref, size
+
+
+def record_upload(cur, ref, size, original_name, folder, uploaded_by=None):
+    cur.execute("""
+        INSERT OR IGNORE INTO uploads (ref, size, content_type, original_name, folder, uploaded_by)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (ref, size, mimetypes.guess_type(original_name)[0], original_name, folder, uploaded_by))
+
+
+def variant_ref(ref, width):
+    return f"{os.path.splitext(ref)[0]}_{width}.jpg"
+
+
+def make_image_variants(path, widths):
+    """Write a resized JPEG next to path for each width (runs in the image pool)."""
+    base = os.path.splitext(path)[0]
+    with Image.open(path) as img:
+        # Let the JPEG decoder skip detail we are about to throw away
+        img.draft("RGB", (max(widths), max(widths)))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            flat = Image.new("RGB", img.size, "white")
+            flat.paste(img, mask=img.getchannel("A"))
+            img = flat
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+
+        for width in widths:
+            out = f"{base}_{width}.jpg"
+            if os.path.exists(out):
+                continue
+            resized = img.copy()
+            resized.thumbnail((width, width))
+            # Two requests may make the same size at once; each writes its own file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(out), suffix=".tmp")
+            os.fchmod(fd, STORE_FILE_MODE)
+            with os.fdopen(fd, "wb") as f:
+                resized.save(f, "JPEG", quality=IMAGE_QUALITY, optimize=True, progressive=True)
+            os.replace(tmp_path, out)
+
+
+_image_pool = None
+_image_pool_pid = None
+
+
+def _get_image_pool():
+    global _image_pool, _image_pool_pid
+    if _image_pool is None or _image_pool_pid != os.getpid():
+        _image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+        _image_pool_pid = os.getpid()
+    return _image_pool
+
+
+def _image_variants_done(ref):
+    def done(future):
+        if future.exception():
+            print(f"⚠️ Could not resize {ref}: {future.exception()}")
+    return done
+
+
+def is_stored_image(ref):
+    return bool(ref) and "/" in ref and mimetypes.guess_type(ref)[0] in IMAGE_TYPES
+
+
+def queue_image_variants(ref):
+    """Resize an image upload in the background; pages fall back to the original until then."""
+    if not is_stored_image(ref):
+        return
+    future = _get_image_pool().submit(make_image_variants, stored_path(ref), list(IMAGE_VARIANTS.values()))
+    future.add_done_callback(_image_variants_done(ref))
+
+
+def save_upload(upload, folder):
+    """Store an uploaded file (werkzeug FileStorage); returns the ref to keep in the row.
+
+    The uploads row is committed on its own, so call this before the view
+    starts writing.
+    """
+    original_name = secure_filename(upload.filename or "") or "upload"
+    ref, size = store_stream(upload.stream, original_name)
+
+    con = get_db()
+    record_upload(con.cursor(), ref, size, original_name, folder, session.get("user_id"))
+    con.commit()
+
+    queue_image_variants(ref)
+    return ref
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    message = f"File is too large (max {MAX_UPLOAD_MB} MB)"
+    if wants_json():
+        return {"ok": False, "error": message}, 413
+    return f"❌ {message}.", 413
+
+
+@app.template_global()
+def upload_url(ref, folder, variant=None):
+    """URL of an upload: a store ref, or the name of an older file in static/uploads/<folder>.
+
+    With variant ("display") an image links to its resized copy once it has
+    been made.
+    """
+    if not ref:
+        return ""
+    if "/" not in ref:
+        return url_for("legacy_upload", folder=folder, name=ref)
+    if variant and is_stored_image(ref):
+        resized = variant_ref(ref, IMAGE_VARIANTS[variant])
+        if os.path.exists(stored_path(resized)):
+            return url_for("stored_upload", ref=resized)
+    return url_for("stored_upload", ref=ref)
+
+
+@app.template_global()
+def thumb_url(ref, folder, width):
+    """A THUMB_WIDTHS-sized copy of a stored image; anything else links as is."""
+    if not is_stored_image(ref):
+        return upload_url(ref, folder)
+    return url_for("image_thumb", width=width, ref=ref)
+
+
+@app.template_global()
+def image_srcset(ref, folder, widths=THUMB_WIDTHS):
+    """srcset over the thumbnail sizes, or "" when there are none (PDFs, older files)."""
+    if not is_stored_image(ref):
+        return ""
+    return ", ".join(f"{thumb_url(ref, folder, w)} {w}w" for w in widths)
+
+
+@app.template_filter("upload_name")
+def upload_name(ref):
+    """Name the file was uploaded as (store refs are just hashes)."""
+    if not ref or "/" not in ref:
+        return ref
+    cur = get_db().cursor()
+    cur.execute("SELECT original_name FROM uploads WHERE ref=?", (ref,))
+    row = cur.fetchone()
+    return row[0] if row else os.path.basename(ref)
+
+
+# ---------------- FILE DOWNLOADS ----------------
+# Uploads are only served by the routes below. Each request is checked once,
+# with a single query, against the bookings and profiles the file
+# belongs to (admin sees everything, crop photos any logged-in user). The
+# transfer itself is then left to the front proxy when FILE_OFFLOAD is set:
+#   "accel"     nginx X-Accel-Redirect to ACCEL_PREFIX + path under the app
+#               dir, e.g.  location /protected/ { internal; alias /srv/sarna/; }
+#   "sendfile"  Apache / lighttpd X-Sendfile with the absolute path
+# Otherwise send_file streams it here, answering Range and conditional
+# requests. The proxy must not serve static/uploads itself, but its user needs
+# read access to the files (STORE_FILE_MODE) and their directories.
+FILE_OFFLOAD = os.environ.get("FILE_OFFLOAD", "")
+ACCEL_PREFIX = os.environ.get("ACCEL_PREFIX", "/protected/")
+app.config["USE_X_SENDFILE"] = FILE_OFFLOAD == "sendfile"
+
+# One SELECT per column that can hold a file, by upload folder: a row means
+# :ref belongs to something :owner (buyer id, or the miller id for millers and
+# their staff) may see. Older uploads are plain client file names that repeat
+# across folders, so /download only checks its own folder's columns; a store
+# ref names its content, so any column holding it will do.
+_BOOKING_OWNER = """
+    JOIN miller_stock ms ON mb.stock_id = ms.id
+    WHERE :owner IN (mb.buyer_id, ms.miller_id) AND"""
+UPLOAD_OWNERS = {
+    "bills": [
+        f"SELECT 1 FROM loading_invoices li JOIN miller_bookings mb ON li.booking_id = mb.id {_BOOKING_OWNER} li.invoice_file = :ref",
+        f"SELECT 1 FROM loading_invoices li JOIN miller_bookings mb ON li.booking_id = mb.id {_BOOKING_OWNER} li.final_invoice_file = :ref",
+        f"SELECT 1 FROM payments p JOIN miller_bookings mb ON p.booking_id = mb.id {_BOOKING_OWNER} p.invoice_file = :ref",
+        f"SELECT 1 FROM miller_bookings mb {_BOOKING_OWNER} mb.bill_document = :ref",
+        f"SELECT 1 FROM miller_bookings mb {_BOOKING_OWNER} mb.final_invoice = :ref",
+        "SELECT 1 FROM trade_bills WHERE user_id = :owner AND bill_file = :ref",
+    ],
+    "miller_docs": [
+        """SELECT 1 FROM miller_profiles
+           WHERE miller_id = :owner AND :ref IN (document, gst_doc, mandi_doc, other_doc)""",
+        """SELECT 1 FROM buyer_profiles
+           WHERE buyer_id = :owner AND :ref IN (document, gst_doc, license_doc, other_doc)""",
+    ],
+    "crops": [
+        "SELECT 1 FROM crops WHERE image = :ref",
+    ],
+}
+# folder -> access query; None checks a store ref against every folder
+UPLOAD_ACCESS_SQL = {
+    folder: " UNION ALL ".join(queries) + " LIMIT 1"
+    for folder, queries in UPLOAD_OWNERS.items()
+}
+UPLOAD_ACCESS_SQL[None] = " UNION ALL ".join(q for qs in UPLOAD_OWNERS.values() for q in qs) + " LIMIT 1"
+HOT_QUERIES["download_access"] = (UPLOAD_ACCESS_SQL[None], {"ref": "x", "owner": 1})
+HOT_QUERIES["download_access_bills"] = (UPLOAD_ACCESS_SQL["bills"], {"ref": "x", "owner": 1})
+
+
+def original_refs(cur, ref):
+    """The upload(s) a stored file belongs to; a resized copy maps back to its original."""
+    if "_" not in ref:
+        return [ref]
+    prefix = ref.split("_")[0]
+    # Originals are <prefix> or <prefix>.<ext>; "/" sorts after both
+    cur.execute("SELECT ref FROM uploads WHERE ref >= ? AND ref < ?", (prefix, prefix + "/"))
+    return [r[0] for r in cur.fetchall()]
+
+
+def check_download(refs, folder=None):
+    """Abort unless the caller may see a file stored under one of refs (in folder, for older uploads)."""
+    role = session.get("role")
+    if not role:
+        abort(403)
+    if role == "admin":
+        return
+
+    cur = get_db().cursor()
+    owner = get_effective_user_id()
+    for ref in refs:
+        cur.execute(UPLOAD_ACCESS_SQL[folder], {"ref": ref, "owner": owner})
+        if cur.fetchone():
+            return
+    abort(404)
+
+
+def send_upload(path, etag=True, immutable=False):
+    """Hand path to the proxy (FILE_OFFLOAD) or send it from here."""
+    if FILE_OFFLOAD == "accel":
+        response = Response(mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream")
+        response.headers["X-Accel-Redirect"] = ACCEL_PREFIX + os.path.relpath(path)
+    else:
+        # With USE_X_SENDFILE this only sets the X-Sendfile header
+        response = send_file(path, etag=etag, conditional=True)
+
+    # The same header whether the proxy or send_file sends the body
+    # (send_file defaults to no-cache, which would revalidate on every use)
+    response.cache_control.private = True
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = UPLOAD_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def send_stored(ref):
+    # A ref names its content, so the response never changes and caches for good
+    return send_upload(stored_path(ref), etag=ref.split("/")[-1].split(".")[0], immutable=True)
+
+
+@app.route("/files/<path:ref>")
+def stored_upload(ref):
+    if not STORE_REF.match(ref) or not os.path.isfile(stored_path(ref)):
+        abort(404)
+    check_download(original_refs(get_db().cursor(), ref))
+    return send_stored(ref)
+
+
+@app.route("/thumbs/<int:width>/<path:ref>")
+def image_thumb(width, ref):
+    """Resized copy of a stored image, made on the first request and kept next to it."""
+    # Only originals; a resized copy is never resized again
+    if width not in THUMB_WIDTHS or not STORE_REF.match(ref) or "_" in ref or not is_stored_image(ref):
+        abort(404)
+    if not os.path.isfile(stored_path(ref)):
+        abort(404)
+    check_download([ref])
+
+    resized = variant_ref(ref, width)
+    if not os.path.exists(stored_path(resized)):
+        try:
+            make_image_variants(stored_path(ref), [width])
+        except (OSError, Image.DecompressionBombError) as e:
+            print(f"⚠️ Could not resize {ref}: {e}")
+            abort(404)
+
+    return send_stored(resized)
+
+
+@app.route("/download/<folder>/<name>")
+def legacy_upload(folder, name):
+    """Older uploads still in static/uploads/<folder> (names may be reused, so no long cache)."""
+    if folder not in UPLOAD_FOLDERS or name != secure_filename(name):
+        abort(404)
+    path = os.path.abspath(os.path.join(UPLOAD_FOLDERS[folder], name))
+    if not os.path.isfile(path):
+        abort(404)
+    check_download([name], folder)
+    return send_upload(path)
+
+
+@app.before_request
+def _hide_static_uploads():
+    """static/uploads is only reachable through the checked routes above."""
+    if request.endpoint == "static":
+        filename = os.path.normpath((request.view_args or {}).get("filename", ""))
+        if filename.split(os.sep)[0] == "uploads":
+            abort(404)
+
+
+@app.cli.command("import-uploads")
+def import_uploads_command():
+    """Move older uploads (static/uploads/<folder>/<name>) into the store and repoint their rows."""
+    con = get_db()
+    cur = con.cursor()
+
+    refs = {}
+    total = missing = 0
+    for table, column, folder in UPLOAD_COLUMNS:
+        cur.execute(f"""
+            SELECT DISTINCT {column} FROM {table}
+            WHERE IFNULL({column}, '') != '' AND instr({column}, '/') = 0
+        """)
+        for (name,) in cur.fetchall():
+            path = os.path.join(UPLOAD_FOLDERS[folder], name)
+            if path not in refs:
+                if not os.path.isfile(path):
+                    print(f"⚠️ {table}.{column}: {path} not found, left as is")
+                    missing += 1
+                    continue
+                with open(path, "rb") as f:
+                    ref, size = store_stream(f, name)
+                record_upload(cur, ref, size, name, folder)
+                queue_image_variants(ref)
+                refs[path] = ref
+                total += size
+            cur.execute(f"UPDATE {table} SET {column}=? WHERE {column}=?", (refs[path], name))
+
+    con.commit()
+
+    stored = sum(os.path.getsize(stored_path(ref)) for ref in set(refs.values()))
+    print(f"✅ Imported {len(refs)} files ({total} bytes, {stored} bytes after dedupe); {missing} missing")
+    con.close()
+    _get_image_pool().shutdown(wait=True)
+
+
+@app.cli.command("store-modes")
+def store_modes_command():
+    """Make stored files written before STORE_FILE_MODE readable by the proxy."""
+    fixed = 0
+    for path, _, st in _walk_files(app.config["STORE_FOLDER"]):
+        if st.st_mode & 0o777 != STORE_FILE_MODE:
+            os.chmod(path, STORE_FILE_MODE)
+            fixed += 1
+    print(f"✅ Set mode {STORE_FILE_MODE:o} on {fixed} files")
+
+
+@app.cli.command("image-variants")
+def image_variants_command():
+    """Make any missing resized copies of stored images."""
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("SELECT ref FROM uploads")
+    refs = [r[0] for r in cur.fetchall()]
+    con.close()
+
+    queued = 0
+    for ref in refs:
+        missing = [w for w in IMAGE_VARIANTS.values() if not os.path.exists(stored_path(variant_ref(ref, w)))]
+        if missing and is_stored_image(ref):
+            queue_image_variants(ref)
+            queued += 1
+    _get_image_pool().shutdown(wait=True)
+    print(f"✅ Resized {queued} images")
+
+
+# ---------------- UPLOAD GC ----------------
+# Replacing an invoice or profile document only repoints the row; the old
+# file stays on disk. `flask upload-gc` collects every reference into a set,
+# walks the store and static/uploads once, and reports (or with --delete
+# removes) files nothing points to. Files younger than the grace period are
+# kept: save_upload() writes (or, for a duplicate, touches) the file before the
+# view saves the row. Before removing, each orphan is checked again against a
+# fresh reference snapshot and its mtime; a store file is first moved aside, so
+# a duplicate upload racing the delete writes its own copy instead.
+UPLOAD_GC_GRACE_HOURS = 24
+
+
+def referenced_uploads(cur):
+    """(store content hashes, {folder: older file names}) referenced by any row."""
+    hashes = set()
+    names = {folder: set() for folder in UPLOAD_FOLDERS}
+    for table, column, folder in UPLOAD_COLUMNS:
+        cur.execute(f"SELECT {column} FROM {table} WHERE IFNULL({column}, '') != ''")
+        for (ref,) in cur:
+            if "/" in ref:
+                hashes.add(_content_hash(ref))
+            else:
+                names[folder].add(ref)
+    return hashes, names
+
+
+def _content_hash(ref):
+    # ab/cd/<sha256>.pdf, ab/cd/<sha256>_480.jpg -> <sha256>
+    return os.path.basename(ref).split(".")[0].split("_")[0]
+
+
+def _walk_files(root):
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            yield path, name, os.stat(path)
+
+
+@app.cli.command("upload-gc")
+@click.option("--delete", is_flag=True, help="Remove orphans older than the grace period.")
+@click.option("--grace-hours", default=UPLOAD_GC_GRACE_HOURS, show_default=True)
+def upload_gc_command(delete, grace_hours):
+    """Report storage per folder and find (optionally delete) unreferenced uploads."""
+    con = get_db()
+    cur = con.cursor()
+    hashes, names = referenced_uploads(cur)
+    cur.execute("SELECT ref, folder FROM uploads")
+    store_folders = {_content_hash(ref): folder for ref, folder in cur}
+
+    cutoff = time.time() - grace_hours * 3600
+    usage = {}
+    orphans = []
+
+    def account(label, path, st, referenced, folder=None):
+        totals = usage.setdefault(label, {"files": 0, "bytes": 0, "orphans": 0, "orphan_bytes": 0})
+        totals["files"] += 1
+        totals["bytes"] += st.st_size
+        if not referenced and st.st_mtime < cutoff:
+            totals["orphans"] += 1
+            totals["orphan_bytes"] += st.st_size
+            orphans.append((path, folder))
+
+    for path, name, st in _walk_files(app.config["STORE_FOLDER"]):
+        # Leftover temp files (.incoming-*, *.tmp) are never referenced
+        digest = _content_hash(name)
+        temp = name.startswith(".") or name.endswith(".tmp")
+        label = f"store/{store_folders.get(digest, 'unknown')}"
+        account(label, path, st, not temp and digest in hashes)
+
+    for folder, root in UPLOAD_FOLDERS.items():
+        for path, name, st in _walk_files(root):
+            account(root, path, st, name in names[folder], folder)
+
+    print(f"{'folder':<28}{'files':>8}{'MB':>10}{'orphans':>10}{'orphan MB':>12}")
+    for label, t in sorted(usage.items()):
+        print(f"{label:<28}{t['files']:>8}{t['bytes'] / 1e6:>10.1f}{t['orphans']:>10}{t['orphan_bytes'] / 1e6:>12.1f}")
+
+    orphan_bytes = sum(t["orphan_bytes"] for t in usage.values())
+    if not delete:
+        for path, _ in orphans:
+            print(f"🗑️  {path}")
+        print(f"Found {len(orphans)} orphans ({orphan_bytes / 1e6:.1f} MB) older than {grace_hours}h; run with --delete to remove them")
+        con.close()
+        return
+
+    # Rows saved since the first snapshot count too
+    hashes, names = referenced_uploads(cur)
+    deleted = deleted_bytes = 0
+    for path, folder in orphans:
+        name = os.path.basename(path)
+        store = folder is None
+        temp = name.startswith(".") or name.endswith(".tmp")
+        if store and not temp:
+            if _content_hash(name) in hashes:
+                continue
+            aside = os.path.join(os.path.dirname(path), f".gc-{name}")
+            try:
+                os.replace(path, aside)
+            except FileNotFoundError:
+                continue
+            if os.stat(aside).st_mtime >= cutoff:
+                # Re-uploaded meanwhile; any copy holds the same bytes
+                os.replace(aside, path)
+                continue
+            victim = aside
+        else:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if st.st_mtime >= cutoff or (not store and name in names[folder]):
+                continue
+            victim = path
+
+        deleted_bytes += os.stat(victim).st_size
+        os.remove(victim)
+        deleted += 1
+        if store and not temp:
+            ref = os.path.relpath(path, app.config["STORE_FOLDER"]).replace(os.sep, "/")
+            cur.execute("DELETE FROM uploads WHERE ref=?", (ref,))
+    con.commit()
+    con.close()
+    print(f"✅ Deleted {deleted} orphans ({deleted_bytes / 1e6:.1f} MB)")
+
+
+# ---------------- BOOKING OWNER COLUMNS ----------------
+# miller_bookings keeps its own copy of the stock's miller_id and of the buyer
+# and miller names, so miller pages filter on one index range instead of
+# joining miller_stock and users. book_miller_stock() fills them; triggers
+# follow later changes (a stock moved to another miller, a renamed user), and
+# `flask check-bookings` finds (and with --fix repairs) rows that drifted.
+BOOKING_OWNER_FIX = {
+    "miller_id": "(SELECT miller_id FROM miller_stock WHERE id = miller_bookings.stock_id)",
+    "buyer_name": "(SELECT name FROM users WHERE id = miller_bookings.buyer_id)",
+    "miller_name": """(SELECT u.name FROM miller_stock ms JOIN users u ON ms.miller_id = u.id
+                       WHERE ms.id = miller_bookings.stock_id)""",
+}
+
+BOOKING_OWNER_TRIGGERS = {
+    "trg_booking_owner_insert": ("AFTER INSERT ON miller_bookings WHEN NEW.miller_id IS NULL", """
+        UPDATE miller_bookings
+        SET miller_id = {miller_id}, buyer_name = {buyer_name}, miller_name = {miller_name}
+        WHERE id = NEW.id;
+    """),
+    "trg_booking_owner_stock": ("AFTER UPDATE OF miller_id ON miller_stock", """
+        UPDATE miller_bookings
+        SET miller_id = NEW.miller_id,
+            miller_name = (SELECT name FROM users WHERE id = NEW.miller_id)
+        WHERE stock_id = NEW.id;
+    """),
+    "trg_booking_owner_name": ("AFTER UPDATE OF name ON users", """
+        UPDATE miller_bookings SET buyer_name = NEW.name WHERE buyer_id = NEW.id;
+        UPDATE miller_bookings SET miller_name = NEW.name WHERE miller_id = NEW.id;
+    """),
+}
+
+
+def upgrade_booking_owner_columns(cur):
+
+    cur.execute("PRAGMA table_info(miller_bookings)")
+    cols = [c[1] for c in cur.fetchall()]
+    if "miller_id" not in cols:
+        cur.execute("ALTER TABLE miller_bookings ADD COLUMN miller_id INTEGER")
+    if "buyer_name" not in cols:
+        cur.execute("ALTER TABLE miller_bookings ADD COLUMN buyer_name TEXT")
+    if "miller_name" not in cols:
+        cur.execute("ALTER TABLE miller_bookings ADD COLUMN miller_name TEXT")
+
+    cur.execute(f"""
+        UPDATE miller_bookings
+        SET {", ".join(f"{col} = {expr}" for col, expr in BOOKING_OWNER_FIX.items())}
+        WHERE miller_id IS NULL
+    """)
+
+    # Not in INDEXES: create_indexes() also runs as step 18, before the column exists
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_miller_bookings_miller_status
+        ON miller_bookings (miller_id, status, loading_status, created_at)
+    """)
+
+    for name, (event, body) in BOOKING_OWNER_TRIGGERS.items():
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {name} {event}
+            BEGIN {body.format(**BOOKING_OWNER_FIX)} END
+        """)
+
+
+def booking_owner_drift(cur):
+    """{column: number of bookings whose copy differs from miller_stock/users}."""
+    drift = {}
+    for col, expr in BOOKING_OWNER_FIX.items():
+        cur.execute(f"SELECT COUNT(*) FROM miller_bookings WHERE {col} IS NOT {expr}")
+        drift[col] = cur.fetchone()[0]
+    return drift
+
+
+@app.cli.command("check-bookings")
+@click.option("--fix", is_flag=True, help="Rewrite drifted copies from miller_stock/users.")
+def check_bookings_command(fix):
+    """Fail if a booking's miller_id or names differ from its stock and users."""
+    con = get_db()
+    cur = con.cursor()
+    drift = booking_owner_drift(cur)
+    for col, count in drift.items():
+        if count:
+            print(f"❌ {col}: {count} bookings out of date")
+
+    if fix and any(drift.values()):
+        begin_write(con)
+        for col, expr in BOOKING_OWNER_FIX.items():
+            cur.execute(f"UPDATE miller_bookings SET {col} = {expr} WHERE {col} IS NOT {expr}")
+        con.commit()
+        print(f"✅ Fixed {sum(drift.values())} values")
+    elif any(drift.values()):
+        con.close()
+        raise SystemExit(1)
+    else:
+        print("✅ Booking owner columns match miller_stock and users")
+    con.close()
+
+
+# ---------------- MIGRATIONS ----------------
+# Ordered schema steps. PRAGMA user_version holds the last applied version and
+# schema_version keeps a log of when each step ran. Steps 1-17 are the old
+# import-time upgrades; they stay idempotent so existing databases that were
+# upgraded before versioning existed migrate cleanly. Append new steps only.
+MIGRATIONS = [
+    (1, "init_db", init_db),
+    (2, "loading_invoices", upgrade_loading_invoices),
+    (3, "booking_decision", upgrade_db),
+    (4, "users_status", upgrade_users_table),
+    (5, "password_resets", upgrade_password_resets_table),
+    (6, "partial_loading", upgrade_partial_loading),
+    (7, "staff_system", upgrade_staff_system),
+    (8, "miller_stock_status", upgrade_miller_stock_status),
+    (9, "buyer_profiles", upgrade_buyer_profile_table),
+    (10, "booking_truck_status", upgrade_miller_booking_truck_status),
+    (11, "booking_bill", upgrade_miller_booking_bill),
+    (12, "booking_qc", upgrade_miller_booking_qc),
+    (13, "booking_order_id", upgrade_miller_booking_order_id),
+    (14, "booking_payment_fields", upgrade_miller_payment_fields),
+    (15, "payments", upgrade_payments_table),
+    (16, "miller_stock_reserved_qty", upgrade_miller_stock_reserved_qty),
+    (17, "miller_profiles", upgrade_miller_profile_table),
+    (18, "booking_pipeline_indexes", create_indexes),
+    (19, "sms_outbox", upgrade_sms_outbox),
+    (20, "sms_broadcasts", upgrade_sms_broadcasts),
+    (21, "buyer_crop_subscriptions", upgrade_crop_subscriptions),
+    (22, "order_id_sequence", upgrade_order_id_sequence),
+    (23, "market_indexes", create_indexes),
+    (24, "admin_indexes", create_indexes),
+    (25, "daily_rollups", upgrade_daily_rollups),
+    (26, "market_cache_generation", upgrade_market_cache_generation),
+    (27, "change_tracking", upgrade_change_tracking),
+    (28, "idempotency_keys", upgrade_idempotency_keys),
+    (29, "upload_store", upgrade_upload_store),
+    (30, "upload_ref_indexes", create_indexes),
+    (31, "booking_owner_columns", upgrade_booking_owner_columns),
+    (32, "default_crop_subscriptions", seed_default_subscriptions),
+    (33, "rollup_stock_price", upgrade_daily_rollups),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(cur):
+    cur.execute("PRAGMA user_version")
+    return cur.fetchone()[0]
+
+
+def run_migrations():
+    """Apply every pending migration step in a single write transaction.
+
+    Returns the list of (version, name) steps that were applied.
+    """
+    con = get_db()
+    cur = con.cursor()
+    applied = []
+    try:
+        # Take the write lock up front so concurrent runners serialize here
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        current = get_schema_version(cur)
+        for version, name, step in MIGRATIONS:
+            if version <= current:
+                continue
+            step(cur)
+            cur.execute(
+                "INSERT OR REPLACE INTO schema_version (version, name) VALUES (?, ?)",
+                (version, name)
+            )
+            applied.append((version, name))
+        if applied:
+            cur.execute(f"PRAGMA user_version = {applied[-1][0]}")
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+    return applied
+
+
+def check_schema_version():
+    """Cheap startup check: one PRAGMA read, no DDL."""
+    con = get_db()
+    version = get_schema_version(con.cursor())
+    con.close()
+    if version < SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema is at version {version}, app needs {SCHEMA_VERSION}. "
+            "Run `flask --app app migrate` first."
+        )
+    return version
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Apply pending schema migrations."""
+    applied = run_migrations()
+    for version, name in applied:
+        print(f"✅ Applied migration {version}: {name}")
+    if not applied:
+        print(f"Schema already at version {SCHEMA_VERSION}")
+
+
+# The dev server and `flask migrate` migrate on their own; app servers only check
+if __name__ == "__main__":
+    run_migrations()
+elif os.environ.get("FLASK_RUN_FROM_CLI") != "true":
+    check_schema_version()
+
+# ---------------- AUTH ----------------
+@app.route("/", methods=["GET", "POST"])
+def login():
+    # Show a one-time success message after password reset
+    if request.method == "GET" and request.args.get("reset") == "1":
+        return render_template(
+            "login.html",
+            success="✅ Password updated successfully. Please login with your new password."
+        )
+
+    if request.method == "POST":
+
+        email = request.form.get("email")
+        password = request.form.get("password")
+
+        if not email or not password:
+            return render_template(
+                "login.html",
+                error="Please enter email and password"
+            )
+
+        con = get_db()
+        cur = con.cursor()
+        cur.execute(
+            "SELECT id, name, email, password, role, status, is_staff, parent_miller_id FROM users WHERE email=? AND password=?",
+            (email, password)
+        )
+        user = cur.fetchone()
+        con.close()
+
+        if not user:
+            return render_template(
+                "login.html",
+                error="Invalid credentials"
+            )
+
+        if user[5] != "approved":
+            return render_template(
+                "login.html",
+                error="⛔ Your account is not approved by admin yet"
+            )
+
+        session["user_id"] = user[0] 
+        session["role"] = user[4]
+        session["is_staff"] = user[6] if user[6] else 0
+        session["parent_miller_id"] = user[7] if user[7] else None
+
+        if user[4] == "farmer":
             return redirect("/my_commodity")
         elif user[4] == "buyer":
             return redirect("/market")
@@ -895,17 +2908,12 @@ def forgot_password():
             "INSERT INTO password_resets (user_id, token_hash, expires_at, used) VALUES (?,?,?,0)",
             (user_id, otp_hash, expires_at),
         )
-        con.commit()
-        con.close()
 
+        # 📱 OTP goes out through the outbox together with the reset row
         sms_text = f"Saarna Canvessars OTP for password reset: {otp}. Valid for 10 minutes."
-        sent = send_sms(phone, sms_text)
-        if not sent:
-            return render_template(
-                "forgot_password.html",
-                error="Could not send OTP SMS right now. Please try again later.",
-                email=email,
-            )
+        queue_sms(cur, phone, sms_text)
+        con.commit()
+        con.close()
 
         return render_template(
             "forgot_password.html",
@@ -1009,73 +3017,583 @@ def reset_password_link_fallback(token):
     return redirect("/reset-password")
 
 
-@app.route("/register", methods=["GET","POST"])
-def register():
-    if request.method == "POST":
+@app.route("/register", methods=["GET","POST"])
+def register():
+    if request.method == "POST":
+        con = get_db()
+        cur = con.cursor()
+        cur.execute("""
+        INSERT INTO users (name,email,password,role)
+        VALUES (?,?,?,?)
+        """, (
+            request.form["name"],
+            request.form["email"],
+            request.form["password"],
+            request.form["role"]
+        ))
+        con.commit()
+        con.close()
+        return redirect("/")
+    return render_template("register.html")
+
+@app.route("/logout")
+def logout():
+    session.clear()
+    return redirect("/")
+
+# ---------------- FARMER ----------------
+@app.route("/post_crop", methods=["GET","POST"])
+def post_crop():
+    if session.get("role") != "farmer":
+        return redirect("/")
+
+    if request.method == "POST":
+        image = request.files.get("image")
+        filename = None
+        if image and image.filename:
+            filename = save_upload(image, "crops")
+
+        con = get_db()
+        cur = con.cursor()
+        cur.execute("""
+        INSERT INTO crops (farmer_id,crop,variety,price,quantity,location,image)
+        VALUES (?,?,?,?,?,?,?)
+        """, (
+           get_effective_user_id(),
+            request.form["crop"],
+            request.form["variety"],
+            request.form["price"],
+            request.form["quantity"],
+            request.form["location"],
+            filename
+        ))
+        con.commit()
+        con.close()
+        return redirect("/my_commodity")
+
+    return render_template("post_crop.html")
+
+@app.route("/my_commodity")
+def my_commodity():
+    if session.get("role") != "farmer":
+        return redirect("/")
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("SELECT * FROM crops WHERE farmer_id=?", (get_effective_user_id(),))
+    crops = cur.fetchall()
+    con.close()
+    return render_template("my_commodity.html", crops=crops)
+
+# ---------------- LOADING INVOICES ----------------
+INVOICE_BATCH = 500  # stay well under SQLite's bound-parameter limit
+
+def load_invoices_map(cur, booking_ids):
+    """Per-truck invoices (with QC and final invoice) for the given bookings.
+
+    Only the bookings being rendered are fetched; the result is grouped by
+    booking_id in one pass.
+    """
+    invoices_map = {}
+    booking_ids = list(dict.fromkeys(booking_ids))
+    for start in range(0, len(booking_ids), INVOICE_BATCH):
+        chunk = booking_ids[start:start + INVOICE_BATCH]
+        placeholders = ",".join(["?"] * len(chunk))
+        cur.execute(f"""
+            SELECT id, booking_id, loaded_qty, invoice_file, truck_number, created_at,
+                   qc_weight, qc_moisture, qc_remarks, qc_status, qc_at,
+                   final_invoice_file, payment_status, payment_at
+            FROM loading_invoices
+            WHERE booking_id IN ({placeholders})
+            ORDER BY created_at ASC
+        """, chunk)
+        for r in cur.fetchall():
+            invoices_map.setdefault(r[1], []).append({
+                "id": r[0],  # invoice id
+                "qty": r[2],
+                "file": r[3],
+                "truck_number": r[4],
+                "date": r[5],
+                "qc_weight": r[6],
+                "qc_moisture": r[7],
+                "qc_remarks": r[8],
+                "qc_status": r[9] or "pending",
+                "qc_at": r[10],
+                "final_invoice_file": r[11],
+                "payment_status": r[12] or "pending",
+                "payment_at": r[13]
+            })
+    return invoices_map
+
+# ---------------- LIVE EVENTS ----------------
+# Handlers queue compact events while they write; they are published to this
+# process's event bus only once the transaction commits, and /events streams
+# them (Server-Sent Events) to every open page allowed to see them. Each event
+# names its audience: whole roles (stock is public to buyers) and/or user ids
+# (the buyer and miller of a booking). Admin sees everything.
+#
+# Off unless LIVE_EVENTS=1: an open stream holds its worker, so with gunicorn's
+# default sync workers a few open tabs take every worker. Turn it on only with
+# a threaded or async worker class (gunicorn -k gthread --threads 32, or
+# -k gevent). Streams also end after SSE_MAX_SECONDS; the browser reconnects
+# with Last-Event-ID and gets what it missed from the history.
+LIVE_EVENTS = os.environ.get("LIVE_EVENTS", "") == "1"
+EVENT_HISTORY = 500
+EVENT_QUEUE_SIZE = 100
+SSE_PING_SECONDS = 15
+SSE_RETRY_MS = 5000
+SSE_MAX_SECONDS = 300
+
+
+class EventSubscriber:
+    def __init__(self, role, user_id):
+        self.role = role
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.dropped = False
+
+    def wants(self, event):
+        return (
+            self.role == "admin"
+            or self.role in event["roles"]
+            or self.user_id in event["users"]
+        )
+
+
+class EventBus:
+    """In-process fan-out of live events to the SSE streams of this worker."""
+
+    def __init__(self, history=EVENT_HISTORY):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._history = deque(maxlen=history)
+        self._next_id = 1
+
+    def publish(self, kind, data, roles=(), users=()):
+        with self._lock:
+            event = {
+                "id": self._next_id,
+                "type": kind,
+                "data": data,
+                "roles": frozenset(roles),
+                "users": frozenset(u for u in users if u),
+            }
+            self._next_id += 1
+            self._history.append(event)
+            subscribers = list(self._subscribers)
+
+        for sub in subscribers:
+            if not sub.wants(event):
+                continue
+            try:
+                sub.queue.put_nowait(event)
+            except queue.Full:
+                # Slow client: end its stream; it reconnects with Last-Event-ID
+                sub.dropped = True
+                self.unsubscribe(sub)
+
+    def subscribe(self, role, user_id, last_id=None):
+        sub = EventSubscriber(role, user_id)
+        with self._lock:
+            if last_id is not None:
+                missed = [e for e in self._history if e["id"] > last_id and sub.wants(e)]
+                for event in missed[-EVENT_QUEUE_SIZE:]:
+                    sub.queue.put_nowait(event)
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+
+event_bus = EventBus()
+
+
+def queue_event(kind, data, roles=(), users=()):
+    """Publish an event when the current request's transaction commits."""
+    if not has_app_context():
+        return
+    g.setdefault("_events", []).append((kind, data, roles, users))
+
+
+def publish_queued_events():
+    if not has_app_context():
+        return
+    for kind, data, roles, users in g.pop("_events", []):
+        event_bus.publish(kind, data, roles, users)
+
+
+@app.teardown_appcontext
+def _drop_uncommitted_events(exc):
+    # Anything still queued belongs to a transaction that was rolled back
+    g.pop("_events", None)
+
+
+def queue_stock_event(cur, kind, stock_id):
+    """Queue the current state of a lot for buyers and its miller."""
+    cur.execute("""
+        SELECT ms.id, ms.miller_id, ms.crop, ms.quantity, ms.price,
+               ms.bag_type, ms.status, u.name
+        FROM miller_stock ms
+        JOIN users u ON ms.miller_id = u.id
+        WHERE ms.id=?
+    """, (stock_id,))
+    row = cur.fetchone()
+    if not row:
+        return
+    queue_event(kind, {
+        "id": row[0],
+        "crop": row[2],
+        "quantity": row[3],
+        "price": row[4],
+        "bag_type": row[5],
+        "status": row[6],
+        "miller": row[7],
+    }, roles=("buyer",), users=(row[1],))
+
+
+def queue_booking_event(cur, kind, booking_id):
+    """Queue the current state of a booking for its buyer and miller."""
+    cur.execute("""
+        SELECT mb.id, mb.order_id, mb.stock_id, ms.crop, mb.quantity,
+               IFNULL(mb.loaded_qty, 0), mb.status, mb.loading_status,
+               mb.buyer_id, ms.miller_id
+        FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE mb.id=?
+    """, (booking_id,))
+    row = cur.fetchone()
+    if not row:
+        return
+    queue_event(kind, {
+        "id": row[0],
+        "order_id": row[1],
+        "stock_id": row[2],
+        "crop": row[3],
+        "quantity": row[4],
+        "loaded_qty": row[5],
+        "status": row[6],
+        "loading_status": row[7],
+    }, users=(row[8], row[9]))
+
+
+@app.template_global()
+def live_events_enabled():
+    return LIVE_EVENTS
+
+
+@app.route("/events")
+def events_stream():
+    """Server-Sent Events feed of live stock and booking updates for this session."""
+    if not LIVE_EVENTS:
+        abort(404)
+    role = session.get("role")
+    if not role:
+        return {"error": "Unauthorized"}, 403
+
+    sub = event_bus.subscribe(
+        role,
+        get_effective_user_id(),
+        request.headers.get("Last-Event-ID", type=int),
+    )
+
+    def stream():
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            while not sub.dropped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # Hand the worker back; the browser reconnects on its own
+                    return
+                try:
+                    event = sub.queue.get(timeout=min(SSE_PING_SECONDS, remaining))
+                except queue.Empty:
+                    # Keeps proxies from timing out and notices closed clients
+                    yield ": ping\n\n"
+                    continue
+                yield (
+                    f"id: {event['id']}\n"
+                    f"event: {event['type']}\n"
+                    f"data: {json.dumps(event['data'])}\n\n"
+                )
+        finally:
+            event_bus.unsubscribe(sub)
+
+    return Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+# ---------------- OFFLINE (PWA) ----------------
+# Gate staff lose signal often. static/js/sw.js caches the static assets and
+# the open-bookings pages; static/js/offline-queue.js keeps loading and QC
+# submissions in IndexedDB and replays them (Accept: application/json, with
+# an Idempotency-Key header, see IDEMPOTENCY) once the network is back.
+
+@app.route("/sw.js")
+def service_worker():
+    """Served from the root so the worker's scope covers every page."""
+    response = app.send_static_file("js/sw.js")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Service-Worker-Allowed"] = "/"
+    return response
+
+
+def wants_json():
+    return request.accept_mimetypes.best == "application/json"
+
+
+def form_result(url, error=None, status=400):
+    """Redirect a normal form post; answer queued (JSON) submits with ok/error."""
+    if wants_json():
+        if error:
+            return {"ok": False, "error": error}, status
+        return {"ok": True}
+    return redirect(url)
+
+# ---------------- STOCK RESERVATION ----------------
+# miller_stock.quantity is what buyers can still book; reserved_qty is the part
+# already taken by approved bookings that has not been loaded yet.
+#   book     quantity -= qty        (one conditional UPDATE, fails if short)
+#   approve  reserved_qty += qty
+#   load     reserved_qty -= qty    (quantity was already taken at booking)
+#   release  quantity += remaining, reserved_qty -= reserved part; lot reopens
+
+def begin_write(con):
+    """Take SQLite's write lock now so a read-check-write sequence is atomic."""
+    con.execute("BEGIN IMMEDIATE")
+
+
+def take_stock(cur, stock_id, qty):
+    """Atomically take qty from an open lot. Returns False if it is not available."""
+    cur.execute("""
+        UPDATE miller_stock
+        SET quantity = quantity - ?,
+            status = CASE WHEN quantity - ? <= 0 THEN 'closed' ELSE status END
+        WHERE id=? AND status='open' AND quantity >= ?
+    """, (qty, qty, stock_id, qty))
+    if cur.rowcount != 1:
+        return False
+    queue_stock_event(cur, "stock_updated", stock_id)
+    return True
+
+
+def return_stock(cur, stock_id, qty, reserved=0):
+    """Put qty back on sale (reserved of it was held by an approval)."""
+    cur.execute("""
+        UPDATE miller_stock
+        SET quantity = quantity + ?,
+            reserved_qty = MAX(IFNULL(reserved_qty, 0) - ?, 0),
+            status = CASE WHEN status='closed' AND quantity + ? > 0 THEN 'open' ELSE status END
+        WHERE id=?
+    """, (qty, reserved, qty, stock_id))
+    queue_stock_event(cur, "stock_updated", stock_id)
+
+
+def release_booking(cur, booking_id):
+    """Return the unloaded part of a pending/approved booking to its lot."""
+    cur.execute("""
+        SELECT stock_id, quantity, IFNULL(loaded_qty, 0), status
+        FROM miller_bookings
+        WHERE id=?
+    """, (booking_id,))
+    row = cur.fetchone()
+    if not row:
+        return 0
+    stock_id, qty, loaded, status = row
+    remaining = max(0, (qty or 0) - loaded)
+    if remaining > 0:
+        return_stock(cur, stock_id, remaining, remaining if status == 'approved' else 0)
+    return remaining
+
+
+def approve_booking(cur, booking_id, miller_id=None):
+    """pending -> approved, holding the booked qty as reserved. Returns True on success."""
+    owner = "AND stock_id IN (SELECT id FROM miller_stock WHERE miller_id=?)" if miller_id else ""
+    cur.execute(f"""
+        UPDATE miller_bookings
+        SET status='approved',
+            decision_at=CURRENT_TIMESTAMP
+        WHERE id=? AND status='pending' {owner}
+    """, (booking_id, miller_id) if miller_id else (booking_id,))
+    if cur.rowcount != 1:
+        return False
+
+    # 🔒 Reserve stock instead of deducting
+    cur.execute("""
+        UPDATE miller_stock
+        SET reserved_qty = IFNULL(reserved_qty, 0) + (
+            SELECT quantity FROM miller_bookings WHERE id=?
+        )
+        WHERE id = (
+            SELECT stock_id FROM miller_bookings WHERE id=?
+        )
+    """, (booking_id, booking_id))
+    queue_booking_event(cur, "booking_approved", booking_id)
+    return True
+
+
+def decline_booking(cur, booking_id, reason, miller_id=None):
+    """pending/approved (nothing loaded) -> declined, returning stock. Returns True on success."""
+    owner = "AND stock_id IN (SELECT id FROM miller_stock WHERE miller_id=?)" if miller_id else ""
+    cur.execute(f"""
+        SELECT id FROM miller_bookings
+        WHERE id=? AND status IN ('pending','approved') AND IFNULL(loaded_qty, 0)=0 {owner}
+    """, (booking_id, miller_id) if miller_id else (booking_id,))
+    if not cur.fetchone():
+        return False
+
+    release_booking(cur, booking_id)
+    cur.execute("""
+    UPDATE miller_bookings
+    SET status='declined', reason=?, decision_at=CURRENT_TIMESTAMP
+    WHERE id=?
+    """, (reason, booking_id))
+    queue_booking_event(cur, "booking_declined", booking_id)
+    return True
+
+
+def stock_invariant_errors(cur, stock_id, initial_qty):
+    """Ways one lot's bookkeeping disagrees with its bookings (empty if none)."""
+    cur.execute("SELECT quantity, IFNULL(reserved_qty, 0) FROM miller_stock WHERE id=?", (stock_id,))
+    quantity, reserved = cur.fetchone()
+    cur.execute("""
+        SELECT
+            IFNULL(SUM(CASE WHEN status IN ('pending','approved') THEN quantity END), 0),
+            IFNULL(SUM(CASE WHEN status='approved' THEN quantity END), 0),
+            COUNT(*), COUNT(DISTINCT order_id)
+        FROM miller_bookings WHERE stock_id=?
+    """, (stock_id,))
+    booked, approved, bookings, order_ids = cur.fetchone()
+
+    errors = []
+    if quantity < 0 or booked > initial_qty:
+        errors.append(f"overbooked: {booked} booked of {initial_qty}, {quantity} left")
+    if quantity + booked != initial_qty:
+        errors.append(f"lost stock: {quantity} left + {booked} booked != {initial_qty}")
+    if reserved != approved:
+        errors.append(f"reserved_qty {reserved} != {approved} approved")
+    if order_ids != bookings:
+        errors.append(f"{bookings - order_ids} duplicate order ids")
+    return errors
+
+
+def _close_pooled_connections():
+    # The CLI's app context holds one connection in g besides the pool
+    bound = g.pop("_db", None)
+    if bound is not None:
+        bound.really_close()
+    with _db_pool_lock:
+        for con in _db_pool:
+            con.really_close()
+        _db_pool.clear()
+
+
+@app.cli.command("stress-booking")
+@click.option("--threads", default=16, show_default=True, help="Concurrent buyers.")
+@click.option("--bookings", default=40, show_default=True, help="Booking attempts per buyer.")
+@click.option("--stock", "stock_qty", default=500, show_default=True, help="Quantity of the contested lot.")
+def stress_booking_command(threads, bookings, stock_qty):
+    """Hammer one lot from many threads on a scratch database; fail on any overbooking.
+
+    Buyers book and cancel while a miller approves and declines, all through
+    the real routes. The live database is never touched.
+    """
+    global DATABASE, SMS_DISPATCHER
+    workdir = tempfile.mkdtemp(prefix="stress-booking-")
+    live_database, live_dispatcher = DATABASE, SMS_DISPATCHER
+    DATABASE, SMS_DISPATCHER = os.path.join(workdir, "stress.db"), "off"
+    _close_pooled_connections()
+
+    try:
+        run_migrations()
         con = get_db()
         cur = con.cursor()
+        cur.execute("INSERT INTO users (name, email, password, role, status) VALUES ('Mill', 'mill@stress', '', 'miller', 'approved')")
+        miller_id = cur.lastrowid
+        buyer_ids = []
+        for i in range(threads):
+            cur.execute("INSERT INTO users (name, email, password, role, status) VALUES (?, ?, '', 'buyer', 'approved')",
+                        (f"Buyer {i}", f"buyer{i}@stress"))
+            buyer_ids.append(cur.lastrowid)
         cur.execute("""
-        INSERT INTO users (name,email,password,role)
-        VALUES (?,?,?,?)
-        """, (
-            request.form["name"],
-            request.form["email"],
-            request.form["password"],
-            request.form["role"]
-        ))
+            INSERT INTO miller_stock (miller_id, crop, quantity, price, condition, bag_type, deduction)
+            VALUES (?, 'wheat', ?, 2000, 'good', 'Jute', 0)
+        """, (miller_id, stock_qty))
+        stock_id = cur.lastrowid
         con.commit()
         con.close()
-        return redirect("/")
-    return render_template("register.html")
-
-@app.route("/logout")
-def logout():
-    session.clear()
-    return redirect("/")
 
-# ---------------- FARMER ----------------
-@app.route("/post_crop", methods=["GET","POST"])
-def post_crop():
-    if session.get("role") != "farmer":
-        return redirect("/")
-
-    if request.method == "POST":
-        image = request.files.get("image")
-        filename = None
-        if image and image.filename:
-            filename = secure_filename(image.filename)
-            image.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
+        def client(user_id, role):
+            c = app.test_client()
+            with c.session_transaction() as s:
+                s["user_id"], s["role"] = user_id, role
+            return c
+
+        stop = threading.Event()
+        failures = []
+
+        def buyer(user_id):
+            c, rng = client(user_id, "buyer"), random.Random(user_id)
+            try:
+                for _ in range(bookings):
+                    c.post(f"/book_miller_stock/{stock_id}", data={"quantity": rng.randint(1, 8)})
+                    if rng.random() < 0.2:
+                        con = get_db()
+                        row = con.execute("SELECT id FROM miller_bookings WHERE buyer_id=? ORDER BY RANDOM() LIMIT 1",
+                                          (user_id,)).fetchone()
+                        con.close()
+                        if row:
+                            c.get(f"/cancel_booking/{row[0]}")
+            except Exception as e:
+                failures.append(f"buyer {user_id}: {type(e).__name__}: {e}")
+
+        def miller():
+            c, rng = client(miller_id, "miller"), random.Random(0)
+            while not stop.is_set():
+                con = get_db()
+                row = con.execute("SELECT id FROM miller_bookings WHERE status='pending' ORDER BY RANDOM() LIMIT 1").fetchone()
+                con.close()
+                if not row:
+                    time.sleep(0.01)
+                elif rng.random() < 0.8:
+                    c.get(f"/miller/approve_booking/{row[0]}")
+                else:
+                    c.post(f"/miller/decline_booking/{row[0]}", data={"reason": "stress"})
+
+        started = time.time()
+        workers = [threading.Thread(target=buyer, args=(b,)) for b in buyer_ids]
+        approver = threading.Thread(target=miller)
+        for t in workers + [approver]:
+            t.start()
+        for t in workers:
+            t.join()
+        stop.set()
+        approver.join()
+        elapsed = time.time() - started
 
         con = get_db()
         cur = con.cursor()
-        cur.execute("""
-        INSERT INTO crops (farmer_id,crop,variety,price,quantity,location,image)
-        VALUES (?,?,?,?,?,?,?)
-        """, (
-           get_effective_user_id(),
-            request.form["crop"],
-            request.form["variety"],
-            request.form["price"],
-            request.form["quantity"],
-            request.form["location"],
-            filename
-        ))
-        con.commit()
+        errors = failures + stock_invariant_errors(cur, stock_id, stock_qty)
+        cur.execute("SELECT status, COUNT(*), IFNULL(SUM(quantity), 0) FROM miller_bookings GROUP BY status")
+        summary = ", ".join(f"{n} {status} ({qty:g} Qt)" for status, n, qty in cur.fetchall())
         con.close()
-        return redirect("/my_commodity")
-
-    return render_template("post_crop.html")
-
-@app.route("/my_commodity")
-def my_commodity():
-    if session.get("role") != "farmer":
-        return redirect("/")
-    con = get_db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM crops WHERE farmer_id=?", (get_effective_user_id(),))
-    crops = cur.fetchall()
-    con.close()
-    return render_template("my_commodity.html", crops=crops)
+    finally:
+        _close_pooled_connections()
+        DATABASE, SMS_DISPATCHER = live_database, live_dispatcher
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{threads * bookings} booking attempts in {elapsed:.1f}s: {summary}")
+    for error in errors:
+        print(f"❌ {error}")
+    if errors:
+        raise SystemExit(1)
+    print(f"✅ No overbooking of {stock_qty} Qt across {threads} buyers")
 
 # ---------------- MILLER ----------------
 @app.route("/miller", methods=["GET", "POST"])
@@ -1107,18 +3625,18 @@ def miller_dashboard():
             request.form["bag_type"],
             request.form["deduction"]
         ))
+        stock_id = cur.lastrowid
         # Ensure the stock is visible in buyer market (market filters status='open')
-        cur.execute("UPDATE miller_stock SET status='open' WHERE id=last_insert_rowid()")
-        con.commit()
+        cur.execute("UPDATE miller_stock SET status='open' WHERE id=?", (stock_id,))
         
         # 📱 Send SMS to all buyers about new stock
         crop = request.form["crop"]
         quantity = request.form["quantity"]
         price = request.form["price"]
-        buyer_phones = get_all_buyer_phones()
         message = f"🆕 New stock available! {crop} - Qty: {quantity}, Price: ₹{price}/unit. Check the market for details."
-        for phone in buyer_phones:
-            send_sms(phone, message)
+        queue_broadcast(cur, "stock_posted", message, stock_id)
+        queue_stock_event(cur, "stock_posted", stock_id)
+        con.commit()
 
 
 # ✅ LIVE STOCKS
@@ -1134,7 +3652,7 @@ def miller_dashboard():
     cur.execute("""
 SELECT
     mb.id,              -- 0 booking_id
-    u.name,             -- 1 buyer_name
+    mb.buyer_name,      -- 1 buyer_name
     ms.crop,            -- 2 crop
     mb.quantity,        -- 3 booked
     mb.status,          -- 4 booking_status
@@ -1155,42 +3673,15 @@ SELECT
     p.paid_at                      AS payment_at       -- 18 ✅
 
 FROM miller_bookings mb
-JOIN users u ON mb.buyer_id = u.id
 JOIN miller_stock ms ON mb.stock_id = ms.id
 LEFT JOIN payments p ON p.booking_id = mb.id
-WHERE ms.miller_id=?
+WHERE mb.miller_id=?
 ORDER BY mb.created_at DESC
 """, (miller_id,))
     bookings = cur.fetchall()
 
     # 🔹 FETCH PER-TRUCK LOADING INVOICES WITH QC DATA AND FINAL INVOICE
-    cur.execute("""
-    SELECT id, booking_id, loaded_qty, invoice_file, truck_number, created_at,
-           qc_weight, qc_moisture, qc_remarks, qc_status, qc_at,
-           final_invoice_file, payment_status, payment_at
-    FROM loading_invoices
-    ORDER BY created_at ASC
-""")
-    rows = cur.fetchall()
-
-# Group invoices by booking_id with QC data and final invoice
-    invoices_map = {}
-    for r in rows:
-     invoices_map.setdefault(r[1], []).append({
-        "id": r[0],  # invoice id
-        "qty": r[2],
-        "file": r[3],
-        "truck_number": r[4],
-        "date": r[5],
-        "qc_weight": r[6],
-        "qc_moisture": r[7],
-        "qc_remarks": r[8],
-        "qc_status": r[9] or "pending",
-        "qc_at": r[10],
-        "final_invoice_file": r[11],
-        "payment_status": r[12] or "pending",
-        "payment_at": r[13]
-    })
+    invoices_map = load_invoices_map(cur, [b[0] for b in bookings])
 
     con.close()
 
@@ -1213,7 +3704,7 @@ def miller_approved_page():
     cur.execute("""
         SELECT
             mb.id,              -- 0 booking_id
-            u.name,             -- 1 buyer
+            mb.buyer_name,      -- 1 buyer
             ms.crop,            -- 2 crop
             mb.quantity,        -- 3 booked
             mb.status,          -- 4
@@ -1234,11 +3725,10 @@ def miller_approved_page():
             p.invoice_file,                                -- 17
             p.paid_at                                     -- 18
         FROM miller_bookings mb
-        JOIN users u ON mb.buyer_id = u.id
         JOIN miller_stock ms ON mb.stock_id = ms.id
         LEFT JOIN payments p ON p.booking_id = mb.id
         WHERE
-            ms.miller_id = ?
+            mb.miller_id = ?
             AND mb.status = 'approved'
         ORDER BY mb.created_at DESC
     """, (miller_id,))
@@ -1246,33 +3736,7 @@ def miller_approved_page():
     approved = cur.fetchall()
 
     # ✅ Fetch per-truck invoices (WITH QC AND FINAL INVOICE)
-    cur.execute("""
-        SELECT
-            id, booking_id, loaded_qty, invoice_file, truck_number, created_at,
-            qc_weight, qc_moisture, qc_remarks, qc_status, qc_at,
-            final_invoice_file, payment_status, payment_at
-        FROM loading_invoices
-        ORDER BY created_at ASC
-    """)
-
-    rows = cur.fetchall()
-    invoices_map = {}
-    for r in rows:
-        invoices_map.setdefault(r[1], []).append({
-            "id": r[0],
-            "qty": r[2],
-            "file": r[3],
-            "truck_number": r[4],
-            "date": r[5],
-            "qc_weight": r[6],
-            "qc_moisture": r[7],
-            "qc_remarks": r[8],
-            "qc_status": r[9] or "pending",
-            "qc_at": r[10],
-            "final_invoice_file": r[11],
-            "payment_status": r[12] or "pending",
-            "payment_at": r[13]
-        })
+    invoices_map = load_invoices_map(cur, [b[0] for b in approved])
 
     con.close()
 
@@ -1296,7 +3760,7 @@ def miller_qc_page():
     # 1️⃣ Fetch bookings (same as miller dashboard)
     cur.execute("""
     SELECT
-        mb.id, u.name, ms.crop, mb.quantity,
+        mb.id, mb.buyer_name, ms.crop, mb.quantity,
         mb.status, mb.reason, mb.decision_at,
         mb.loaded_qty, mb.loading_status,
         mb.close_reason, mb.order_id,
@@ -1308,43 +3772,14 @@ def miller_qc_page():
         p.invoice_file,
         p.paid_at
     FROM miller_bookings mb
-    JOIN users u ON mb.buyer_id = u.id
     JOIN miller_stock ms ON mb.stock_id = ms.id
     LEFT JOIN payments p ON p.booking_id = mb.id
-    WHERE ms.miller_id=?
+    WHERE mb.miller_id=?
     ORDER BY mb.created_at DESC
     """, (miller_id,))
 
     bookings = cur.fetchall()
 
-    # 2️⃣ Fetch per-truck invoices (WITH QC AND FINAL INVOICE)
-    cur.execute("""
-    SELECT id, booking_id, loaded_qty, invoice_file, truck_number, created_at,
-           qc_weight, qc_moisture, qc_remarks, qc_status, qc_at,
-           final_invoice_file, payment_status, payment_at
-    FROM loading_invoices
-    ORDER BY created_at ASC
-    """)
-    rows = cur.fetchall()
-
-    invoices_map = {}
-    for r in rows:
-        invoices_map.setdefault(r[1], []).append({
-            "id": r[0],
-            "qty": r[2],
-            "file": r[3],
-            "truck_number": r[4],
-            "date": r[5],
-            "qc_weight": r[6],
-            "qc_moisture": r[7],
-            "qc_remarks": r[8],
-            "qc_status": r[9] or "pending",
-            "qc_at": r[10],
-            "final_invoice_file": r[11],
-            "payment_status": r[12] or "pending",
-            "payment_at": r[13]
-        })
-
     # 3️⃣ FILTER ONLY COMPLETED LOADING → QC REQUIRED
     completed_loading_qc = []
     EPS = 1e-6
@@ -1368,6 +3803,9 @@ def miller_qc_page():
         if abs(loaded_val - booked_val) < EPS and not final_invoice and payment_status != 'paid':
             completed_loading_qc.append(b)
 
+    # 2️⃣ Fetch per-truck invoices (WITH QC AND FINAL INVOICE) for those bookings only
+    invoices_map = load_invoices_map(cur, [b[0] for b in completed_loading_qc])
+
     con.close()
 
     return render_template(
@@ -1390,7 +3828,7 @@ def miller_final_hisab_page():
     cur.execute("""
         SELECT
             mb.id,              -- 0 booking_id
-            u.name,             -- 1 buyer_name
+            mb.buyer_name,      -- 1 buyer_name
             ms.crop,            -- 2 crop
             mb.quantity,        -- 3 booked
             mb.status,          -- 4 booking_status
@@ -1413,11 +3851,10 @@ def miller_final_hisab_page():
             ms.price                       AS price          -- 19
 
         FROM miller_bookings mb
-        JOIN users u ON mb.buyer_id = u.id
         JOIN miller_stock ms ON mb.stock_id = ms.id
         LEFT JOIN payments p ON p.booking_id = mb.id
         WHERE
-            ms.miller_id = ?
+            mb.miller_id = ?
             AND mb.loading_status IN ('loaded', 'partial')
         ORDER BY mb.created_at DESC
     """, (miller_id,))
@@ -1425,47 +3862,7 @@ def miller_final_hisab_page():
     all_bookings = cur.fetchall()
 
     # ✅ Fetch per-truck invoices + QC + FINAL INVOICE
-    cur.execute("""
-        SELECT
-            li.id,
-            li.booking_id,
-            li.loaded_qty,
-            li.invoice_file,
-            li.truck_number,
-            li.created_at,
-            li.qc_weight,
-            li.qc_moisture,
-            li.qc_remarks,
-            li.qc_status,
-            li.qc_at,
-            li.final_invoice_file,
-            li.payment_status,
-            li.payment_at
-        FROM loading_invoices li
-        JOIN miller_bookings mb ON li.booking_id = mb.id
-        JOIN miller_stock ms ON mb.stock_id = ms.id
-        WHERE ms.miller_id = ?
-        ORDER BY li.created_at ASC
-    """, (miller_id,))
-    rows = cur.fetchall()
-
-    invoices_map = {}
-    for r in rows:
-        invoices_map.setdefault(r[1], []).append({
-            "id": r[0],
-            "qty": r[2],
-            "file": r[3],
-            "truck_number": r[4],
-            "date": r[5],
-            "qc_weight": r[6],
-            "qc_moisture": r[7],
-            "qc_remarks": r[8],
-            "qc_status": r[9] or "pending",
-            "qc_at": r[10],
-            "final_invoice_file": r[11],
-            "payment_status": r[12] or "pending",
-            "payment_at": r[13]
-        })
+    invoices_map = load_invoices_map(cur, [b[0] for b in all_bookings])
 
     con.close()
 
@@ -1489,7 +3886,7 @@ def miller_rejected_page():
     cur.execute("""
         SELECT
             mb.id,              -- 0 booking_id
-            u.name,             -- 1 buyer
+            mb.buyer_name,      -- 1 buyer
             ms.crop,            -- 2 crop
             mb.quantity,        -- 3 qty
             mb.status,          -- 4
@@ -1500,10 +3897,9 @@ def miller_rejected_page():
             mb.close_reason,    -- 9
             mb.order_id         -- 10
         FROM miller_bookings mb
-        JOIN users u ON mb.buyer_id = u.id
         JOIN miller_stock ms ON mb.stock_id = ms.id
         WHERE
-            ms.miller_id = ?
+            mb.miller_id = ?
             AND mb.status = 'declined'
         ORDER BY mb.created_at DESC
     """, (miller_id,))
@@ -1524,7 +3920,7 @@ def miller_payment_completed_page():
     cur.execute("""
         SELECT
             mb.id,              -- 0 booking_id
-            u.name,             -- 1 buyer
+            mb.buyer_name,      -- 1 buyer
             ms.crop,            -- 2 crop
             mb.quantity,        -- 3 booked
             mb.status,          -- 4
@@ -1546,10 +3942,9 @@ def miller_payment_completed_page():
             p.paid_at           -- 18 payment_at
         FROM miller_bookings mb
         JOIN miller_stock ms ON mb.stock_id = ms.id
-        JOIN users u ON mb.buyer_id = u.id
         JOIN payments p ON p.booking_id = mb.id
         WHERE
-            ms.miller_id = ?
+            mb.miller_id = ?
             AND p.status = 'paid'
         ORDER BY p.paid_at DESC
     """, (miller_id,))
@@ -1573,8 +3968,7 @@ def miller_upload_final_invoice(booking_id):
     if not invoice or invoice.filename == "":
         return redirect("/miller")
 
-    filename = secure_filename(invoice.filename)
-    invoice.save(os.path.join(app.config["BILL_FOLDER"], filename))
+    filename = save_upload(invoice, "bills")
 
     con = get_db()
     cur = con.cursor()
@@ -1635,7 +4029,7 @@ def miller_upload_final_invoice(booking_id):
         if buyer_phone:
             total_amount = loaded_qty * price
             message = f"📄 Final invoice uploaded for Order {order_id}. Amount: ₹{total_amount}. Please review and proceed with payment."
-            send_sms(buyer_phone, message)
+            queue_sms(cur, buyer_phone, message)
 
     con.commit()
     con.close()
@@ -1672,6 +4066,7 @@ def miller_mark_payment_done(booking_id):
             paid_at=CURRENT_TIMESTAMP
         WHERE booking_id=?
     """, (booking_id,))
+    queue_booking_event(cur, "payment_done", booking_id)
     
     # 📱 Send SMS to buyer about payment completion
     cur.execute("""
@@ -1686,7 +4081,7 @@ def miller_mark_payment_done(booking_id):
         buyer_phone = get_buyer_phone(buyer_id)
         if buyer_phone:
             message = f"✅ Payment received for Order {order_id}. Amount: ₹{amount}. Thank you!"
-            send_sms(buyer_phone, message)
+            queue_sms(cur, buyer_phone, message)
 
     con.commit()
     con.close()
@@ -1703,8 +4098,7 @@ def miller_edit_final_invoice(booking_id):
     if not invoice or invoice.filename == "":
         return redirect("/miller")
 
-    filename = secure_filename(invoice.filename)
-    invoice.save(os.path.join(app.config["BILL_FOLDER"], filename))
+    filename = save_upload(invoice, "bills")
 
     con = get_db()
     cur = con.cursor()
@@ -1740,7 +4134,7 @@ def miller_edit_final_invoice(booking_id):
         buyer_phone = get_buyer_phone(buyer_id)
         if buyer_phone:
             message = f"📄 Final invoice updated for Order {order_id}. Please review the updated invoice."
-            send_sms(buyer_phone, message)
+            queue_sms(cur, buyer_phone, message)
 
     con.commit()
     con.close()
@@ -1757,8 +4151,7 @@ def miller_upload_truck_final_invoice(invoice_id):
     if not final_invoice or final_invoice.filename == "":
         return redirect(request.referrer or "/miller")
 
-    filename = secure_filename(final_invoice.filename)
-    final_invoice.save(os.path.join(app.config["BILL_FOLDER"], filename))
+    filename = save_upload(final_invoice, "bills")
 
     con = get_db()
     cur = con.cursor()
@@ -1802,7 +4195,7 @@ def miller_upload_truck_final_invoice(invoice_id):
             truck_info = f" (Truck: {truck_number})" if truck_number else ""
             total_amount = loaded_qty * price
             message = f"📄 Final invoice uploaded for Order {order_id}{truck_info}. Qty: {loaded_qty}, Amount: ₹{total_amount}. Please review."
-            send_sms(buyer_phone, message)
+            queue_sms(cur, buyer_phone, message)
 
     con.commit()
     con.close()
@@ -1819,8 +4212,7 @@ def miller_edit_truck_final_invoice(invoice_id):
     if not final_invoice or final_invoice.filename == "":
         return redirect(request.referrer or "/miller")
 
-    filename = secure_filename(final_invoice.filename)
-    final_invoice.save(os.path.join(app.config["BILL_FOLDER"], filename))
+    filename = save_upload(final_invoice, "bills")
 
     con = get_db()
     cur = con.cursor()
@@ -1860,7 +4252,7 @@ def miller_edit_truck_final_invoice(invoice_id):
         buyer_phone = get_buyer_phone(buyer_id)
         if buyer_phone:
             message = f"📄 Final invoice updated for Order {order_id}. Please review the updated invoice."
-            send_sms(buyer_phone, message)
+            queue_sms(cur, buyer_phone, message)
 
     con.commit()
     con.close()
@@ -1914,7 +4306,7 @@ def miller_mark_truck_payment_done(invoice_id):
         if buyer_phone:
             amount = loaded_qty * price
             message = f"✅ Payment received for Order {order_id} (Truck). Amount: ₹{amount}. Thank you!"
-            send_sms(buyer_phone, message)
+            queue_sms(cur, buyer_phone, message)
 
     con.commit()
     con.close()
@@ -1949,11 +4341,7 @@ def upload_booking_bill(booking_id):
     filename = None
     
     if bill_file and bill_file.filename:
-        filename = secure_filename(bill_file.filename)
-        # Add booking_id to filename to avoid conflicts
-        name, ext = os.path.splitext(filename)
-        filename = f"booking_{booking_id}_{name}{ext}"
-        bill_file.save(os.path.join(app.config["BILL_FOLDER"], filename))
+        filename = save_upload(bill_file, "bills")
 
     # Update booking with bill document
     if filename:
@@ -1976,9 +4364,6 @@ def miller_profile():
     if session.get("role") != "miller" or session.get("is_staff"):
         return redirect("/")
 
-    # Ensure database is upgraded
-    upgrade_miller_profile_table()
-
     miller_id = get_effective_user_id()
 
 
@@ -2024,24 +4409,15 @@ def miller_profile():
             
             # Save GST document (only if new file is uploaded)
             if gst_doc and gst_doc.filename:
-                gst_filename = secure_filename(gst_doc.filename)
-                name, ext = os.path.splitext(gst_filename)
-                gst_filename = f"gst_{miller_id}_{name}{ext}"
-                gst_doc.save(os.path.join(app.config["PROFILE_FOLDER"], gst_filename))
+                gst_filename = save_upload(gst_doc, "miller_docs")
             
             # Save Mandi document (only if new file is uploaded)
             if mandi_doc and mandi_doc.filename:
-                mandi_filename = secure_filename(mandi_doc.filename)
-                name, ext = os.path.splitext(mandi_filename)
-                mandi_filename = f"mandi_{miller_id}_{name}{ext}"
-                mandi_doc.save(os.path.join(app.config["PROFILE_FOLDER"], mandi_filename))
+                mandi_filename = save_upload(mandi_doc, "miller_docs")
             
             # Save Other document (only if new file is uploaded)
             if other_doc and other_doc.filename:
-                other_filename = secure_filename(other_doc.filename)
-                name, ext = os.path.splitext(other_filename)
-                other_filename = f"other_{miller_id}_{name}{ext}"
-                other_doc.save(os.path.join(app.config["PROFILE_FOLDER"], other_filename))
+                other_filename = save_upload(other_doc, "miller_docs")
 
             if profile:
                 cur.execute("""
@@ -2139,18 +4515,15 @@ def buyer_profile():
 
         gst_filename = gst_existing
         if gst_doc and gst_doc.filename:
-            gst_filename = secure_filename(gst_doc.filename)
-            gst_doc.save(os.path.join(app.config["PROFILE_FOLDER"], gst_filename))
+            gst_filename = save_upload(gst_doc, "miller_docs")
 
         lic_filename = lic_existing
         if license_doc and license_doc.filename:
-            lic_filename = secure_filename(license_doc.filename)
-            license_doc.save(os.path.join(app.config["PROFILE_FOLDER"], lic_filename))
+            lic_filename = save_upload(license_doc, "miller_docs")
 
         other_filename = other_existing
         if other_doc and other_doc.filename:
-            other_filename = secure_filename(other_doc.filename)
-            other_doc.save(os.path.join(app.config["PROFILE_FOLDER"], other_filename))
+            other_filename = save_upload(other_doc, "miller_docs")
 
         if profile:
             cur.execute("""
@@ -2171,13 +4544,75 @@ def buyer_profile():
                 session["user_id"], shop_name, owner_name, phone, address,
                 gst_filename, lic_filename, other_filename
             ))
+            seed_default_subscriptions(cur, session["user_id"])
 
         con.commit()
         con.close()
         return redirect("/buyer/profile")
 
+    cur.execute("""
+        SELECT id, crop, max_price, bag_type
+        FROM buyer_crop_subscriptions
+        WHERE buyer_id=?
+        ORDER BY crop
+    """, (session["user_id"],))
+    subscriptions = cur.fetchall()
+
+    con.close()
+    return render_template(
+        "buyer_profile.html",
+        profile=profile,
+        subscriptions=subscriptions,
+        crop_options=CROP_OPTIONS,
+        bag_types=BAG_TYPES
+    )
+
+
+@app.route("/buyer/subscriptions", methods=["POST"])
+def buyer_add_subscription():
+    """Subscribe to stock alerts for a crop (optional price ceiling / bag type)."""
+    if session.get("role") != "buyer":
+        return redirect("/")
+
+    crop = (request.form.get("crop") or "").strip().lower()
+    if crop not in dict(CROP_OPTIONS):
+        return redirect("/buyer/profile")
+
+    try:
+        max_price = int(request.form.get("max_price") or 0) or None
+    except ValueError:
+        max_price = None
+    bag_type = request.form.get("bag_type") or None
+    if bag_type not in BAG_TYPES:
+        bag_type = None
+
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("""
+        INSERT INTO buyer_crop_subscriptions (buyer_id, crop, max_price, bag_type)
+        VALUES (?, ?, ?, ?)
+    """, (session["user_id"], crop, max_price, bag_type))
+    con.commit()
+    con.close()
+
+    return redirect("/buyer/profile")
+
+
+@app.route("/buyer/subscriptions/delete/<int:subscription_id>", methods=["POST"])
+def buyer_delete_subscription(subscription_id):
+    if session.get("role") != "buyer":
+        return redirect("/")
+
+    con = get_db()
+    cur = con.cursor()
+    cur.execute(
+        "DELETE FROM buyer_crop_subscriptions WHERE id=? AND buyer_id=?",
+        (subscription_id, session["user_id"])
+    )
+    con.commit()
     con.close()
-    return render_template("buyer_profile.html", profile=profile)
+
+    return redirect("/buyer/profile")
 @app.route("/buyer/close_remaining/<int:booking_id>", methods=["POST"])
 def buyer_close_remaining(booking_id):
     if session.get("role") != "buyer":
@@ -2190,30 +4625,22 @@ def buyer_close_remaining(booking_id):
 
     con = get_db()
     cur = con.cursor()
+    begin_write(con)
 
     # Fetch booking
     cur.execute("""
-        SELECT stock_id, quantity, loaded_qty, status
+        SELECT id
         FROM miller_bookings
         WHERE id=? AND buyer_id=? AND status='approved'
+          AND loading_status IN ('pending','partial')
     """, (booking_id, session["user_id"]))
 
-    row = cur.fetchone()
-    if not row:
+    if not cur.fetchone():
         con.close()
         return redirect(request.referrer or "/market")
 
-    stock_id, booked_qty, loaded_qty, status = row
-    loaded_qty = loaded_qty or 0
-    remaining_qty = booked_qty - loaded_qty
-
-    # Return remaining stock to miller
-    if remaining_qty > 0:
-        cur.execute("""
-            UPDATE miller_stock
-            SET quantity = quantity + ?
-            WHERE id=?
-        """, (remaining_qty, stock_id))
+    # Return remaining stock (and its reservation) to miller
+    release_booking(cur, booking_id)
 
     # Close booking partially
     cur.execute("""
@@ -2240,7 +4667,7 @@ def buyer_close_remaining(booking_id):
         if miller_phone:
             remaining = total_qty - (loaded_qty or 0)
             message = f"⚠️ Order {order_id} partially closed. {crop} - Remaining: {remaining} qty. Reason: {reason}"
-            send_sms(miller_phone, message)
+            queue_sms(cur, miller_phone, message)
 
     con.commit()
     con.close()
@@ -2255,25 +4682,12 @@ def miller_approve_booking(id):
 
     con = get_db()
     cur = con.cursor()
+    begin_write(con)
 
-    # 🔒 Reserve stock instead of deducting
-    cur.execute("""
-        UPDATE miller_stock
-        SET reserved_qty = reserved_qty + (
-            SELECT quantity FROM miller_bookings WHERE id=?
-        )
-        WHERE id = (
-            SELECT stock_id FROM miller_bookings WHERE id=?
-        )
-    """, (id, id))
-
-    # Approve booking
-    cur.execute("""
-        UPDATE miller_bookings
-        SET status='approved',
-            decision_at=CURRENT_TIMESTAMP
-        WHERE id=?
-    """, (id,))
+    # Approve booking (only a pending one of this miller's) and reserve its stock
+    if not approve_booking(cur, id, get_effective_user_id()):
+        con.close()
+        return redirect("/miller")
     
     # 📱 Send SMS to buyer about approval
     cur.execute("""
@@ -2288,16 +4702,12 @@ def miller_approve_booking(id):
         buyer_phone = get_buyer_phone(buyer_id)
         if buyer_phone:
             message = f"✅ Order {order_id} approved! {crop} - Qty: {qty}. Please proceed with loading."
-            send_sms(buyer_phone, message)
+            queue_sms(cur, buyer_phone, message)
 
     con.commit()
     con.close()
     return redirect("/miller")
 
-
-
-    return redirect("/admin")
-
 @app.route("/miller/decline_booking/<int:id>", methods=["POST"])
 def miller_decline_booking(id):
     if session.get("role") != "miller":
@@ -2307,22 +4717,12 @@ def miller_decline_booking(id):
 
     con = get_db()
     cur = con.cursor()
+    begin_write(con)
 
     # return stock to inventory
-    cur.execute("""
-    SELECT stock_id, quantity FROM miller_bookings WHERE id=?
-    """, (id,))
-    row = cur.fetchone()
-
-    if row:
-        stock_id, qty = row
-        cur.execute("UPDATE miller_stock SET quantity=quantity+? WHERE id=?", (qty, stock_id))
-
-    cur.execute("""
-    UPDATE miller_bookings
-    SET status='declined', reason=?, decision_at=CURRENT_TIMESTAMP
-    WHERE id=?
-    """, (reason, id))
+    if not decline_booking(cur, id, reason, get_effective_user_id()):
+        con.close()
+        return redirect("/miller")
     
     # 📱 Send SMS to buyer about decline
     cur.execute("""
@@ -2337,7 +4737,7 @@ def miller_decline_booking(id):
         buyer_phone = get_buyer_phone(buyer_id)
         if buyer_phone:
             message = f"❌ Order {order_id} declined. {crop} - Reason: {reason}"
-            send_sms(buyer_phone, message)
+            queue_sms(cur, buyer_phone, message)
 
     con.commit()
     con.close()
@@ -2383,8 +4783,6 @@ def update_miller_stock(id):
         old_qty,
         request.form["quantity"]
     ))
-
-    con.commit()
     
     # 📱 Send SMS to all buyers about stock update
     cur.execute("SELECT crop FROM miller_stock WHERE id=?", (id,))
@@ -2393,40 +4791,145 @@ def update_miller_stock(id):
         crop = crop_result[0]
         new_price = request.form["price"]
         new_qty = request.form["quantity"]
-        buyer_phones = get_all_buyer_phones()
         message = f"📢 Stock updated! {crop} - New Qty: {new_qty}, New Price: ₹{new_price}/unit. Check the market for details."
-        for phone in buyer_phones:
-            send_sms(phone, message)
-    
+        queue_broadcast(cur, "stock_updated", message, id)
+        queue_stock_event(cur, "stock_updated", id)
+
+    con.commit()
     con.close()
     return redirect("/miller")
 
 # ---------------- BUYER ----------------
+# Open stock is listed newest first and paged with a keyset cursor on
+# (created_at, id), so every page is an index range read of MARKET_PAGE_SIZE
+# rows no matter how many lots are open.
+MARKET_PAGE_SIZE = 24
+
+
+def _float_arg(args, name):
+    try:
+        return float(args.get(name)) if args.get(name) else None
+    except ValueError:
+        return None
+
+
+def parse_market_filters(args):
+    """Read the market's stock filters from query args, dropping invalid ones."""
+    crop = (args.get("crop") or "").strip().lower()
+    bag_type = (args.get("bag_type") or "").strip()
+    miller_id = args.get("miller", type=int)
+    return {
+        "crop": crop if crop in dict(CROP_OPTIONS) else "",
+        "min_price": _float_arg(args, "min_price"),
+        "max_price": _float_arg(args, "max_price"),
+        "bag_type": bag_type if bag_type in BAG_TYPES else "",
+        "miller": miller_id,
+    }
+
+
+def _market_where(filters):
+    where = ["ms.status = 'open'", "ms.quantity > 0"]
+    params = []
+    if filters["crop"]:
+        where.append("ms.crop = ?")
+        params.append(filters["crop"])
+    if filters["min_price"] is not None:
+        where.append("ms.price >= ?")
+        params.append(filters["min_price"])
+    if filters["max_price"] is not None:
+        where.append("ms.price <= ?")
+        params.append(filters["max_price"])
+    if filters["bag_type"]:
+        where.append("ms.bag_type = ?")
+        params.append(filters["bag_type"])
+    if filters["miller"]:
+        where.append("ms.miller_id = ?")
+        params.append(filters["miller"])
+    return where, params
+
+
+def encode_cursor(sort_value, row_id):
+    return f"{sort_value}|{row_id}"
+
+
+def decode_cursor(cursor):
+    """'created_at|id' -> (created_at, id), or None if missing/garbled."""
+    created_at, _, stock_id = (cursor or "").rpartition("|")
+    if not created_at or not stock_id.isdigit():
+        return None
+    return created_at, int(stock_id)
+
+
+def fetch_market_stocks(cur, filters, cursor=None, limit=MARKET_PAGE_SIZE):
+    """One page of open stock; returns (rows, next_cursor or None)."""
+    where, params = _market_where(filters)
+    after = decode_cursor(cursor)
+    if after:
+        where.append("(ms.created_at, ms.id) < (?, ?)")
+        params.extend(after)
+
+    cur.execute(f"""
+    SELECT
+        ms.id,           -- 0
+        ms.miller_id,    -- 1
+        ms.crop,         -- 2
+        ms.quantity,     -- 3
+        ms.price,        -- 4
+        ms.condition,    -- 5
+        ms.bag_type,     -- 6
+        ms.deduction,    -- 7
+        ms.created_at,   -- 8
+        ms.status,       -- 9
+        u.name           -- 10 (miller name)
+    FROM miller_stock ms
+    JOIN users u ON ms.miller_id = u.id
+    WHERE {" AND ".join(where)}
+    ORDER BY ms.created_at DESC, ms.id DESC
+    LIMIT ?
+    """, params + [limit + 1])
+    rows = cur.fetchall()
+
+    # Fetched one extra row only to know whether there is a next page
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1][8], rows[-1][0])
+    return rows, None
+
+
+def count_market_stocks(cur, filters):
+    where, params = _market_where(filters)
+    cur.execute(f"SELECT COUNT(*) FROM miller_stock ms WHERE {' AND '.join(where)}", params)
+    return cur.fetchone()[0]
+
+
+@app.route("/market/stocks")
+def market_stocks_page():
+    """Next page of stock cards for the market's "Load more" button."""
+    con = get_db()
+    cur = con.cursor()
+
+    filters = parse_market_filters(request.args)
+    miller_stocks, next_cursor, _ = cached_market_page(cur, filters, request.args.get("cursor"))
+
+    con.close()
+    return {
+        "html": render_template("_stock_cards.html", miller_stocks=miller_stocks),
+        "next_cursor": next_cursor,
+    }
+
+
 @app.route("/market")
 def market():
     con = get_db()
     cur = con.cursor()
 
-    cur.execute("""
-    SELECT 
-        miller_stock.id,           -- 0
-        miller_stock.miller_id,    -- 1
-        miller_stock.crop,         -- 2
-        miller_stock.quantity,     -- 3
-        miller_stock.price,        -- 4
-        miller_stock.condition,    -- 5
-        miller_stock.bag_type,     -- 6
-        miller_stock.deduction,    -- 7
-        miller_stock.created_at,   -- 8
-        miller_stock.status,       -- 9
-        users.name                 -- 10 (miller name)
-    FROM miller_stock
-    JOIN users ON miller_stock.miller_id = users.id
-    WHERE miller_stock.quantity > 0
-    AND miller_stock.status = 'open'
-    ORDER BY miller_stock.created_at DESC
-    """)
-    miller_stocks = cur.fetchall()
+    # Only the first screen of stock (shared by all buyers); the rest is
+    # fetched on demand
+    stock_filters = parse_market_filters(request.args)
+    miller_stocks, next_cursor, total_stocks = cached_market_page(cur, stock_filters)
+
+    cur.execute("SELECT id, name FROM users WHERE role='miller' AND IFNULL(is_staff, 0)=0 ORDER BY name")
+    millers = cur.fetchall()
 
     cur.execute("""
 SELECT
@@ -2480,57 +4983,24 @@ ORDER BY mb.created_at DESC
     ]
 
     # Fetch per-truck loading invoices WITH QC DATA AND FINAL INVOICE
-    all_booking_ids = [b[0] for b in my_bookings]
-    invoices_map = {}
-    if all_booking_ids:
-        placeholders = ",".join(["?"] * len(all_booking_ids))
-        cur.execute(f"""
-        SELECT id, booking_id, loaded_qty, invoice_file, truck_number, created_at,
-               qc_weight, qc_moisture, qc_remarks, qc_status, qc_at,
-               final_invoice_file, payment_status, payment_at
-        FROM loading_invoices
-        WHERE booking_id IN ({placeholders})
-        ORDER BY created_at ASC
-        """, all_booking_ids)
-        rows = cur.fetchall()
-        for r in rows:
-            invoices_map.setdefault(r[1], []).append({
-                "id": r[0],  # invoice id
-                "qty": r[2],
-                "file": r[3],
-                "truck_number": r[4],
-                "date": r[5],
-                "qc_weight": r[6],
-                "qc_moisture": r[7],
-                "qc_remarks": r[8],
-                "qc_status": r[9] or "pending",
-                "qc_at": r[10],
-                "final_invoice_file": r[11],
-                "payment_status": r[12] or "pending",
-                "payment_at": r[13]
-            })
+    invoices_map = load_invoices_map(cur, [b[0] for b in my_bookings])
 
     # Calculate totals
     total_booked = sum(b[2] or 0 for b in active_bookings)
     total_loaded = sum(b[3] or 0 for b in active_bookings)
     total_remaining = sum(b[4] or 0 for b in active_bookings)
 
-    # Fetch all crops for market
-    cur.execute("""
-    SELECT crops.*, users.name
-    FROM crops
-    JOIN users ON crops.farmer_id = users.id
-    WHERE crops.sold = 0
-    ORDER BY crops.id DESC
-    """)
-    crops = cur.fetchall()
-
     con.close()
     
     return render_template(
         "market.html",
-        crops=crops,
         miller_stocks=miller_stocks,
+        next_cursor=next_cursor,
+        total_stocks=total_stocks,
+        stock_filters=stock_filters,
+        millers=millers,
+        crop_options=CROP_OPTIONS,
+        bag_types=BAG_TYPES,
         my_bookings=active_bookings,
         partial_closed_bookings=partial_closed_bookings,
         loaded_bookings=loaded_bookings,
@@ -2589,32 +5059,7 @@ LEFT JOIN payments p ON p.booking_id = mb.id
 
     rows = cur.fetchall()
 
-    cur.execute("""
-        SELECT id, booking_id, loaded_qty, invoice_file, truck_number, created_at,
-               qc_weight, qc_moisture, qc_remarks, qc_status, qc_at,
-               final_invoice_file, payment_status, payment_at
-        FROM loading_invoices
-        ORDER BY created_at ASC
-    """)
-    invs = cur.fetchall()
-
-    invoices_map = {}
-    for i in invs:
-        invoices_map.setdefault(i[1], []).append({
-            "id": i[0],  # invoice id
-            "qty": i[2],
-            "file": i[3],
-            "truck_number": i[4],
-            "date": i[5],
-            "qc_weight": i[6],
-            "qc_moisture": i[7],
-            "qc_remarks": i[8],
-            "qc_status": i[9] or "pending",
-            "qc_at": i[10],
-            "final_invoice_file": i[11],
-            "payment_status": i[12] or "pending",
-            "payment_at": i[13]
-        })
+    invoices_map = load_invoices_map(cur, [r[0] for r in rows])
 
     orders = []
     for r in rows:
@@ -2663,7 +5108,7 @@ def get_miller_orders_by_type(filter_type):
         SELECT
             mb.id,                -- 0
             mb.order_id,          -- 1
-            u.name,               -- 2 buyer
+            mb.buyer_name,        -- 2 buyer
             ms.crop,              -- 3
             mb.quantity,          -- 4 booked
             IFNULL(mb.loaded_qty,0), -- 5 loaded
@@ -2678,42 +5123,16 @@ def get_miller_orders_by_type(filter_type):
             mb.close_reason       -- 14
         FROM miller_bookings mb
         JOIN miller_stock ms ON mb.stock_id = ms.id
-        JOIN users u ON mb.buyer_id = u.id
         LEFT JOIN payments p ON p.booking_id = mb.id
-        WHERE ms.miller_id=?
+        WHERE mb.miller_id=?
         {where}
         ORDER BY mb.created_at DESC
     """, (get_effective_user_id(),))
 
-    rows = cur.fetchall()
-
-    # 🔹 Fetch per-truck invoices WITH FINAL INVOICE
-    cur.execute("""
-        SELECT id, booking_id, loaded_qty, invoice_file, truck_number, created_at,
-               qc_weight, qc_moisture, qc_remarks, qc_status, qc_at,
-               final_invoice_file, payment_status, payment_at
-        FROM loading_invoices
-        ORDER BY created_at ASC
-    """)
-    invs = cur.fetchall()
-
-    invoices_map = {}
-    for i in invs:
-        invoices_map.setdefault(i[1], []).append({
-            "id": i[0],
-            "qty": i[2],
-            "file": i[3],
-            "truck_number": i[4],
-            "date": i[5],
-            "qc_weight": i[6],
-            "qc_moisture": i[7],
-            "qc_remarks": i[8],
-            "qc_status": i[9] or "pending",
-            "qc_at": i[10],
-            "final_invoice_file": i[11],
-            "payment_status": i[12] or "pending",
-            "payment_at": i[13]
-        })
+    rows = cur.fetchall()
+
+    # 🔹 Fetch per-truck invoices WITH FINAL INVOICE
+    invoices_map = load_invoices_map(cur, [r[0] for r in rows])
 
     orders = []
     for r in rows:
@@ -2795,6 +5214,308 @@ def buyer_payments():
 
     return render_template("buyer_payments.html", payments=payments)
 
+# ---------------- JSON API (v1) ----------------
+# Read-only JSON versions of the buyer and miller order pages for mobile and
+# integration clients. Every list takes:
+#   fields=a,b,c   only these fields (default: all of the view's fields)
+#   limit=N        page size (default API_PAGE_SIZE, max API_MAX_PAGE_SIZE)
+#   cursor=...     next_cursor from the previous page
+#   since=N        only rows changed after watermark N (the updated_seq counter
+#                  of CHANGE TRACKING); pass back the watermark of the first
+#                  page of the previous walk
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+
+_BOOKING_FROM = """
+    FROM miller_bookings mb
+    JOIN miller_stock ms ON mb.stock_id = ms.id
+    LEFT JOIN payments p ON p.booking_id = mb.id
+"""
+
+# Last change to a booking, its payment or any of its trucks (updated_seq is
+# stamped by the change-tracking triggers)
+_BOOKING_CHANGED_SEQ = """MAX(mb.updated_seq, IFNULL(p.updated_seq, 0), IFNULL(
+    (SELECT MAX(li.updated_seq) FROM loading_invoices li WHERE li.booking_id = mb.id), 0))"""
+
+BOOKING_FIELDS = {
+    "id": "mb.id",
+    "order_id": "mb.order_id",
+    "crop": "ms.crop",
+    "price": "ms.price",
+    "booked": "mb.quantity",
+    "loaded": "IFNULL(mb.loaded_qty, 0)",
+    "remaining": "(mb.quantity - IFNULL(mb.loaded_qty, 0))",
+    "status": "mb.status",
+    "reason": "mb.reason",
+    "decision_at": "mb.decision_at",
+    "loading_status": "mb.loading_status",
+    "loaded_at": "mb.loaded_at",
+    "close_reason": "mb.close_reason",
+    "qc_status": "mb.qc_status",
+    "qc_weight": "mb.qc_weight",
+    "qc_moisture": "mb.qc_moisture",
+    "qc_remarks": "mb.qc_remarks",
+    "qc_at": "mb.qc_at",
+    "payment_status": "IFNULL(p.status, 'pending')",
+    "final_invoice": "p.invoice_file",
+    "payment_at": "p.paid_at",
+    "buyer": "mb.buyer_name",
+    "miller": "mb.miller_name",
+    "created_at": "mb.created_at",
+    "updated_at": "mb.updated_at",
+    "invoices": None,  # per-truck loading invoices, from load_invoices_map
+}
+
+PAYMENT_FIELDS = {
+    "id": "p.id",
+    "order_id": "mb.order_id",
+    "crop": "ms.crop",
+    "loaded_qty": "mb.loaded_qty",
+    "price": "ms.price",
+    "total_amount": "(mb.loaded_qty * ms.price)",
+    "amount": "p.amount",
+    "status": "p.status",
+    "invoice_file": "p.invoice_file",
+    "paid_at": "p.paid_at",
+    "miller": "miller.name",
+}
+
+# view name -> extra WHERE on top of the owner filter, as on the HTML pages
+BUYER_ORDER_VIEWS = {
+    "all": "",
+    "active": "AND mb.loading_status IN ('pending','partial')",
+    "partial": "AND mb.loading_status='partial_closed'",
+    "loaded": "AND mb.loading_status='loaded'",
+}
+
+MILLER_ORDER_VIEWS = {
+    "all": "",
+    "approved": "AND mb.status='approved' AND mb.loading_status IN ('pending','partial')",
+    "qc": "AND mb.loading_status='loaded' AND mb.qc_status='pending'",
+    "final": "AND mb.loading_status='loaded' AND IFNULL(p.invoice_file,'') != '' AND IFNULL(p.status,'pending')='pending'",
+    "final-hisab": "AND mb.loading_status IN ('loaded', 'partial')",
+    "rejected": "AND mb.status IN ('declined','cancelled')",
+}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@app.errorhandler(ApiError)
+def handle_api_error(e):
+    return {"error": e.message}, e.status
+
+
+def _api_fields(available):
+    requested = [f.strip() for f in (request.args.get("fields") or "").split(",") if f.strip()]
+    for field in requested:
+        if field not in available:
+            raise ApiError(f"Unknown field: {field}")
+    return requested or list(available)
+
+
+def api_list(cur, available, from_sql, where_sql, params, sort, changed_seq):
+    """One page of a projected, keyset-paginated, optionally delta-filtered list.
+
+    sort is the (timestamp, id) pair the list is ordered by, newest first.
+    """
+    fields = _api_fields(available)
+    limit = min(max(request.args.get("limit", API_PAGE_SIZE, type=int), 1), API_MAX_PAGE_SIZE)
+
+    # Sort keys always come first so the cursor can be built from any projection
+    columns = [sort[0], sort[1]] + [available[f] for f in fields if available[f]]
+    where = [where_sql]
+    params = list(params)
+
+    since = request.args.get("since", type=int)
+    if since is not None:
+        where.append(f"{changed_seq} > ?")
+        params.append(since)
+
+    after = decode_cursor(request.args.get("cursor"))
+    if after:
+        where.append(f"({sort[0]}, {sort[1]}) < (?, ?)")
+        params.extend(after)
+
+    # One read transaction: the watermark is the last change this snapshot can
+    # see, and any write it can't see will get a higher sequence number
+    cur.execute("BEGIN")
+    cur.execute("SELECT next_value - 1 FROM id_sequences WHERE name='sync'")
+    watermark = cur.fetchone()[0]
+
+    cur.execute(f"""
+        SELECT {", ".join(columns)}
+        {from_sql}
+        WHERE {" AND ".join(where)}
+        ORDER BY {sort[0]} DESC, {sort[1]} DESC
+        LIMIT ?
+    """, params + [limit + 1])
+    rows = cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][0], rows[-1][1])
+
+    sql_fields = [f for f in fields if available[f]]
+    data = [dict(zip(sql_fields, r[2:])) for r in rows]
+
+    if "invoices" in fields:
+        invoices_map = load_invoices_map(cur, [r[1] for r in rows])
+        for item, r in zip(data, rows):
+            item["invoices"] = invoices_map.get(r[1], [])
+
+    cur.connection.rollback()
+    return {"data": data, "next_cursor": next_cursor, "watermark": watermark}
+
+
+def _api_role(role):
+    if session.get("role") != role:
+        raise ApiError("Unauthorized", 403)
+
+
+@app.route("/api/v1/buyer/orders")
+@app.route("/api/v1/buyer/orders/<view>")
+def api_buyer_orders(view="all"):
+    _api_role("buyer")
+    if view not in BUYER_ORDER_VIEWS:
+        raise ApiError(f"Unknown view: {view}", 404)
+
+    con = get_db()
+    result = api_list(
+        con.cursor(), BOOKING_FIELDS, _BOOKING_FROM,
+        f"mb.buyer_id=? {BUYER_ORDER_VIEWS[view]}", (session["user_id"],),
+        ("mb.created_at", "mb.id"), _BOOKING_CHANGED_SEQ,
+    )
+    con.close()
+    return result
+
+
+@app.route("/api/v1/buyer/payments")
+def api_buyer_payments():
+    _api_role("buyer")
+
+    con = get_db()
+    result = api_list(
+        con.cursor(), PAYMENT_FIELDS, """
+        FROM payments p
+        JOIN miller_bookings mb ON p.booking_id = mb.id
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        JOIN users miller ON ms.miller_id = miller.id
+        """,
+        "p.buyer_id=? AND p.status='paid'", (session["user_id"],),
+        ("p.paid_at", "p.id"), "p.updated_seq",
+    )
+    con.close()
+    return result
+
+
+@app.route("/api/v1/miller/orders")
+@app.route("/api/v1/miller/orders/<view>")
+def api_miller_orders(view="all"):
+    _api_role("miller")
+    if view not in MILLER_ORDER_VIEWS:
+        raise ApiError(f"Unknown view: {view}", 404)
+
+    con = get_db()
+    result = api_list(
+        con.cursor(), BOOKING_FIELDS, _BOOKING_FROM,
+        f"mb.miller_id=? {MILLER_ORDER_VIEWS[view]}", (get_effective_user_id(),),
+        ("mb.created_at", "mb.id"), _BOOKING_CHANGED_SEQ,
+    )
+    con.close()
+    return result
+
+# Delta sync for field clients: only rows changed after the client's watermark,
+# as compact column lists, at most SYNC_LIMIT rows per call.
+SYNC_LIMIT = 200
+
+SYNC_QUERIES = {
+    "bookings": ("""
+        SELECT mb.updated_seq, mb.id, mb.order_id, ms.crop, mb.quantity,
+               IFNULL(mb.loaded_qty, 0), mb.status, mb.loading_status, mb.updated_at
+        FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE {owner} AND mb.updated_seq > ?
+        ORDER BY mb.updated_seq
+        LIMIT ?
+    """, ["id", "order_id", "crop", "quantity", "loaded_qty", "status",
+          "loading_status", "updated_at"]),
+    "invoices": ("""
+        SELECT li.updated_seq, li.id, li.booking_id, li.loaded_qty, li.truck_number,
+               li.qc_status, li.qc_weight, li.qc_moisture, li.updated_at
+        FROM loading_invoices li
+        JOIN miller_bookings mb ON li.booking_id = mb.id
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE {owner} AND li.updated_seq > ?
+        ORDER BY li.updated_seq
+        LIMIT ?
+    """, ["id", "booking_id", "loaded_qty", "truck_number", "qc_status",
+          "qc_weight", "qc_moisture", "updated_at"]),
+    "payments": ("""
+        SELECT p.updated_seq, p.id, p.booking_id, p.amount, p.status, p.paid_at,
+               p.updated_at
+        FROM payments p
+        JOIN miller_bookings mb ON p.booking_id = mb.id
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE {owner} AND p.updated_seq > ?
+        ORDER BY p.updated_seq
+        LIMIT ?
+    """, ["id", "booking_id", "amount", "status", "paid_at", "updated_at"]),
+}
+
+
+@app.route("/api/v1/sync")
+def api_sync():
+    """Rows of the caller's bookings, truck invoices and payments changed since ?since=.
+
+    Start with no since; then pass back the returned watermark. While "more"
+    is true, call again straight away.
+    """
+    role = session.get("role")
+    if role == "buyer":
+        owner, owner_id = "mb.buyer_id = ?", session["user_id"]
+    elif role == "miller":
+        owner, owner_id = "ms.miller_id = ?", get_effective_user_id()
+    else:
+        raise ApiError("Unauthorized", 403)
+
+    since = request.args.get("since", 0, type=int)
+
+    con = get_db()
+    cur = con.cursor()
+
+    # One read transaction, so the three tables come from the same snapshot
+    cur.execute("BEGIN")
+    changes = []
+    for name, (sql, _) in SYNC_QUERIES.items():
+        # One extra row per table, so a single busy table still reports "more"
+        cur.execute(sql.format(owner=owner), (owner_id, since, SYNC_LIMIT + 1))
+        changes.extend((r[0], name, r[1:]) for r in cur.fetchall())
+    con.rollback()
+
+    # Keep the SYNC_LIMIT oldest changes overall; the watermark is the last
+    # one sent, so nothing past it is skipped
+    changes.sort(key=lambda c: c[0])
+    more = len(changes) > SYNC_LIMIT
+    changes = changes[:SYNC_LIMIT]
+
+    result = {
+        "watermark": changes[-1][0] if changes else since,
+        "more": more,
+    }
+    for name, (_, columns) in SYNC_QUERIES.items():
+        rows = [list(row) for _, n, row in changes if n == name]
+        if rows:
+            result[name] = {"columns": columns, "rows": rows}
+
+    con.close()
+    return result
+
 @app.route("/book_miller_stock/<int:stock_id>", methods=["POST"])
 def book_miller_stock(stock_id):
     if session.get("role") != "buyer":
@@ -2811,54 +5532,44 @@ def book_miller_stock(stock_id):
     con = get_db()
     cur = con.cursor()
 
-    # Check if stock exists and has enough quantity
-    cur.execute("""
-        SELECT quantity, status
-        FROM miller_stock
-        WHERE id=?
-    """, (stock_id,))
-    row = cur.fetchone()
+    # Block mode refills its id block on a separate connection, so it must
+    # not run while we hold the write lock below
+    refill_order_id_block()
+
+    begin_write(con)
+
+    # DEDUCT quantity from stock only if the lot is open and still has enough;
+    # the check and the deduction are one statement, so two buyers can never
+    # both take the last bags
+    if take_stock(cur, stock_id, qty):
+        # Generate order ID (only now, so a rejected booking uses up none)
+        order_id = allocate_order_id(cur)
 
-    if row and row[0] >= qty and row[1] == 'open':
-        # Generate order ID
-        order_id = generate_next_order_id()
-        
-        # Create booking
-        cur.execute("""
-            INSERT INTO miller_bookings
-            (stock_id, buyer_id, quantity, status, order_id)
-            VALUES (?, ?, ?, 'pending', ?)
-        """, (stock_id, session["user_id"], qty, order_id))
-        
-        booking_id = cur.lastrowid
-        
-        # DEDUCT quantity immediately from stock
-        cur.execute("""
-            UPDATE miller_stock
-            SET quantity = quantity - ?
-            WHERE id=?
-        """, (qty, stock_id))
-        
-        # Close stock if quantity reaches 0
-        cur.execute("""
-            UPDATE miller_stock
-            SET status='closed'
-            WHERE id=? AND quantity <= 0
-        """, (stock_id,))
-        
-        # 📱 Send SMS to miller about new booking
         cur.execute("""
-            SELECT ms.miller_id, ms.crop
+            SELECT ms.miller_id, ms.crop, u.name
             FROM miller_stock ms
+            JOIN users u ON ms.miller_id = u.id
             WHERE ms.id = ?
         """, (stock_id,))
         stock_info = cur.fetchone()
+
+        # Create booking (with its own copy of the miller and both names)
+        cur.execute("""
+            INSERT INTO miller_bookings
+            (stock_id, buyer_id, quantity, status, order_id, miller_id, buyer_name, miller_name)
+            VALUES (?, ?, ?, 'pending', ?, ?, (SELECT name FROM users WHERE id = ?), ?)
+        """, (stock_id, session["user_id"], qty, order_id,
+              stock_info[0] if stock_info else None, session["user_id"],
+              stock_info[2] if stock_info else None))
+        queue_booking_event(cur, "booking_created", cur.lastrowid)
+
+        # 📱 Send SMS to miller about new booking
         if stock_info:
-            miller_id, crop = stock_info
+            miller_id, crop, _ = stock_info
             miller_phone = get_miller_phone(miller_id)
             if miller_phone:
                 message = f"🆕 New booking received! Order {order_id}: {crop} - Qty: {qty}. Please review and approve."
-                send_sms(miller_phone, message)
+                queue_sms(cur, miller_phone, message)
         
         con.commit()
 
@@ -2873,24 +5584,18 @@ def cancel_booking(id):
 
     con = get_db()
     cur = con.cursor()
+    begin_write(con)
 
     cur.execute("""
-    SELECT stock_id, quantity, loaded_qty
+    SELECT id
     FROM miller_bookings
-    WHERE id=? AND buyer_id=? AND status IN ('pending','approved') AND loaded_qty=0
+    WHERE id=? AND buyer_id=? AND status IN ('pending','approved') AND IFNULL(loaded_qty, 0)=0
     """, (id, get_effective_user_id()))
     row = cur.fetchone()
 
     if row:
-        stock_id, qty, loaded = row
-        loaded = loaded or 0
-        remaining = max(0, qty - loaded)
-
-        if remaining > 0:
-            cur.execute(
-                "UPDATE miller_stock SET quantity=quantity+? WHERE id=?",
-                (remaining, stock_id)
-            )
+        # Return stock (and any approval reservation) to inventory
+        release_booking(cur, id)
 
         # Keep original booked qty; mark cancelled while preserving loaded part
         cur.execute("""
@@ -2900,6 +5605,7 @@ def cancel_booking(id):
                 decision_at=CURRENT_TIMESTAMP
             WHERE id=?
         """, (id,))
+        queue_booking_event(cur, "booking_cancelled", id)
         
         # 📱 Send SMS to miller about cancellation
         cur.execute("""
@@ -2914,7 +5620,7 @@ def cancel_booking(id):
             miller_phone = get_miller_phone(miller_id)
             if miller_phone:
                 message = f"❌ Order {order_id} cancelled by buyer. {crop} - Qty: {qty}. Stock returned to inventory."
-                send_sms(miller_phone, message)
+                queue_sms(cur, miller_phone, message)
 
         con.commit()
 
@@ -2924,7 +5630,7 @@ def cancel_booking(id):
 @app.route("/buyer/update_loading/<int:id>", methods=["POST"])
 def buyer_update_loading(id):
     if session.get("role") != "buyer":
-        return redirect("/market")
+        return form_result("/market", "Unauthorized", 401)
 
     try:
         load_qty = float(request.form.get("load_qty", 0) or 0)
@@ -2935,14 +5641,14 @@ def buyer_update_loading(id):
     invoice = request.files.get("invoice")
 
     if load_qty <= 0 or not invoice:
-        return redirect("/market")
+        return form_result("/market", "Loading quantity and invoice are required")
 
     # Save invoice
-    filename = secure_filename(invoice.filename)
-    invoice.save(os.path.join(app.config["BILL_FOLDER"], filename))
+    filename = save_upload(invoice, "bills")
 
     con = get_db()
     cur = con.cursor()
+    begin_write(con)
 
     # Fetch booking details
     cur.execute("""
@@ -2954,7 +5660,7 @@ def buyer_update_loading(id):
     row = cur.fetchone()
     if not row:
         con.close()
-        return redirect("/market")
+        return form_result("/market", "Booking is not open for loading")
 
     total_qty, loaded_qty, stock_id = row
 
@@ -2973,6 +5679,10 @@ def buyer_update_loading(id):
     if load_qty > remaining:
         load_qty = remaining
 
+    if load_qty <= 0:
+        con.close()
+        return form_result("/market", "Booking is already fully loaded")
+
     new_loaded = loaded_qty + load_qty
 
     # Float-safe completion check
@@ -3000,22 +5710,14 @@ def buyer_update_loading(id):
         (booking_id, loaded_qty, invoice_file, truck_number)
         VALUES (?, ?, ?, ?)
     """, (id, load_qty, filename, truck_number_val))
+    queue_booking_event(cur, "truck_loaded", id)
 
-    # 🔹 MOVE RESERVED → USED STOCK
+    # 🔹 MOVE RESERVED → USED STOCK (quantity was already taken at booking)
     cur.execute("""
         UPDATE miller_stock
-        SET
-            quantity = quantity - ?,
-            reserved_qty = reserved_qty - ?
+        SET reserved_qty = MAX(IFNULL(reserved_qty, 0) - ?, 0)
         WHERE id=?
-    """, (load_qty, load_qty, stock_id))
-
-    # 🔹 Auto close stock if empty
-    cur.execute("""
-        UPDATE miller_stock
-        SET status='closed'
-        WHERE quantity <= 0
-    """)
+    """, (load_qty, stock_id))
     
     # 📱 Send SMS to miller about loading update
     cur.execute("""
@@ -3031,12 +5733,12 @@ def buyer_update_loading(id):
         if miller_phone:
             truck_part = f" Truck: {truck_number}" if truck_number else ""
             message = f"🚚 Loading update for Order {order_id}: {crop} - Loaded: {loaded_qty}/{total_qty}.{truck_part} Invoice uploaded."
-            send_sms(miller_phone, message)
+            queue_sms(cur, miller_phone, message)
 
     con.commit()
     con.close()
 
-    return redirect("/market")
+    return form_result("/market")
 
 @app.route("/buyer/edit_loading_invoice/<int:invoice_id>", methods=["POST"])
 def buyer_edit_loading_invoice(invoice_id):
@@ -3050,8 +5752,7 @@ def buyer_edit_loading_invoice(invoice_id):
     if not invoice or invoice.filename == "":
         return redirect("/market")
 
-    filename = secure_filename(invoice.filename)
-    invoice.save(os.path.join(app.config["BILL_FOLDER"], filename))
+    filename = save_upload(invoice, "bills")
 
     con = get_db()
     cur = con.cursor()
@@ -3123,7 +5824,7 @@ def invoice(booking_id):
 def miller_update_qc(invoice_id):
     """Miller records quality check for a specific truck/invoice."""
     if session.get("role") != "miller":
-        return redirect("/")
+        return form_result("/", "Unauthorized", 401)
 
     miller_id = get_effective_user_id()
 
@@ -3140,7 +5841,7 @@ def miller_update_qc(invoice_id):
     """, (invoice_id, miller_id))
     if not cur.fetchone():
         con.close()
-        return redirect(request.referrer or "/miller")
+        return form_result(request.referrer or "/miller", "Invoice not found")
 
     qc_weight = request.form.get("qc_weight") or None
     qc_moisture = request.form.get("qc_moisture") or None
@@ -3166,6 +5867,8 @@ def miller_update_qc(invoice_id):
             qc_at=CURRENT_TIMESTAMP
         WHERE id=?
     """, (qc_weight_val, qc_moisture_val, qc_remarks, invoice_id))
+    cur.execute("SELECT booking_id FROM loading_invoices WHERE id=?", (invoice_id,))
+    queue_booking_event(cur, "qc_verified", cur.fetchone()[0])
     
     # 📱 Send SMS to buyer about QC update
     cur.execute("""
@@ -3182,15 +5885,31 @@ def miller_update_qc(invoice_id):
             qc_details = f"Weight: {qc_weight_val or 'N/A'}, Moisture: {qc_moisture_val or 'N/A'}"
             truck_part = f" Truck: {truck_number}." if truck_number else ""
             message = f"✅ QC verified for Order {order_id},{truck_part} Truck Qty: {loaded_qty}. {qc_details}"
-            send_sms(buyer_phone, message)
+            queue_sms(cur, buyer_phone, message)
 
     con.commit()
     con.close()
 
-    return redirect(request.referrer or "/miller")
+    return form_result(request.referrer or "/miller")
 
 
 # ---------------- ADMIN ----------------
+# The dashboard only shows totals and charts, so it is built from GROUP BY
+# queries; the detail tables live on their own pages, ADMIN_PAGE_SIZE rows
+# at a time.
+ADMIN_PAGE_SIZE = 50
+ADMIN_RANGES = (7, 30, 90, 365)
+
+
+def fetch_page(cur, sql, params=(), per_page=ADMIN_PAGE_SIZE):
+    """Run sql for the request's ?page=N; returns (rows, pager) for _pagination.html."""
+    page = max(request.args.get("page", 1, type=int), 1)
+    cur.execute(f"{sql} LIMIT ? OFFSET ?", (*params, per_page + 1, (page - 1) * per_page))
+    rows = cur.fetchall()
+    pager = {"page": page, "has_prev": page > 1, "has_next": len(rows) > per_page}
+    return rows[:per_page], pager
+
+
 @app.route("/admin")
 def admin():
     if session.get("role") != "admin":
@@ -3199,181 +5918,107 @@ def admin():
     con = get_db()
     cur = con.cursor()
 
-    cur.execute("SELECT * FROM users")
-    users = cur.fetchall()
-
-    farmer_count = sum(1 for u in users if u[4]=="farmer")
-    buyer_count  = sum(1 for u in users if u[4]=="buyer")
-    miller_count = sum(1 for u in users if u[4]=="miller")
-
+    # Users by role and status
     cur.execute("""
-    SELECT miller_stock.*, users.name
-    FROM miller_stock
-    JOIN users ON miller_stock.miller_id = users.id
+        SELECT role, status, COUNT(*)
+        FROM users
+        GROUP BY role, status
     """)
-    stocks = cur.fetchall()
-
+    role_counts = {}
+    status_counts = {}
+    for role, status, n in cur.fetchall():
+        role_counts[role] = role_counts.get(role, 0) + n
+        status_counts[status] = status_counts.get(status, 0) + n
+
+    days = request.args.get("days", 7, type=int)
+    if days not in ADMIN_RANGES:
+        days = 7
+    since = f"-{days} days"
+
+    # Booking count per status (daily rollup)
     cur.execute("""
-    SELECT h.*, u.name
-    FROM miller_stock_history h
-    JOIN users u ON h.miller_id = u.id
-    ORDER BY h.updated_at DESC
+        SELECT status, SUM(bookings)
+        FROM daily_booking_status
+        GROUP BY status
     """)
-    history = cur.fetchall()
-
-    cur.execute("""
-    SELECT
-        mb.id,                 -- 0 Booking ID
-        buyer.name,            -- 1 Buyer
-        miller.name,           -- 2 Miller
-        ms.crop,               -- 3 Crop
-        mb.quantity,           -- 4 Qty
-        ms.price,              -- 5 Price
-        (mb.quantity * ms.price), -- 6 Total
-        mb.status,             -- 7 Booking status
-        mb.truck_status,       -- 8 🚚 Loading status
-        mb.loaded_at,          -- 9 Loaded date
-        mb.truck_remark,       -- 10 Remark
-        mb.order_id            -- 11 Order ID
-    FROM miller_bookings mb
-    JOIN users buyer ON mb.buyer_id = buyer.id
-    JOIN miller_stock ms ON mb.stock_id = ms.id
-    JOIN users miller ON ms.miller_id = miller.id
-    ORDER BY mb.created_at DESC
-""")
-    bookings = cur.fetchall()
+    booking_counts = dict(cur.fetchall())
 
-    
-    # 🔹 BUYER PROFILES
+    # Revenue by payment status, all time and for the range (daily rollup)
     cur.execute("""
-        SELECT
-        bp.id,
-        u.name,
-        bp.shop_name,
-        bp.phone,
-        bp.address,
-        bp.document,
-        bp.created_at
-    FROM buyer_profiles bp
-    JOIN users u ON bp.buyer_id = u.id
-    ORDER BY bp.created_at DESC
-    """)
-    buyer_profiles = cur.fetchall()
+        SELECT status,
+               SUM(amount),
+               SUM(CASE WHEN day >= date('now', ?) THEN payments ELSE 0 END),
+               SUM(CASE WHEN day >= date('now', ?) THEN amount ELSE 0 END)
+        FROM daily_payment_stats
+        GROUP BY status
+    """, (since, since))
+    payment_rows = cur.fetchall()
+    revenue = {r[0]: r[1] or 0 for r in payment_rows}
+    payment_stats = [
+        {"status": r[0], "payments": r[2], "amount": r[3]}
+        for r in payment_rows
+    ]
 
-    # 🔹 MILLER PROFILES
-    cur.execute("""
-        SELECT
-            mp.id,
-            u.name,
-            mp.mill_name,
-            mp.owner_phone,
-            mp.address,
-            mp.gst_doc,
-            mp.mandi_doc,
-            mp.other_doc,
-            mp.created_at
-        FROM miller_profiles mp
-        JOIN users u ON mp.miller_id = u.id
-        ORDER BY mp.created_at DESC
-    """)
-    miller_profiles = cur.fetchall()
+    # Tonnage booked / loaded / QC verified per crop in the range
     cur.execute("""
-    SELECT
-        u.id,                     -- 0
-        u.name,                   -- 1
-        u.email,                  -- 2
-        u.role,                   -- 3
-        u.status,                 -- 4
-        u.is_staff,               -- 5
-        pm.name                   -- 6 Parent miller name
-    FROM users u
-    LEFT JOIN users pm
-        ON u.parent_miller_id = pm.id
-    WHERE u.role != 'admin'
-    ORDER BY u.id DESC
-""")
+        SELECT crop, SUM(bookings), SUM(booked_qty), SUM(booked_value),
+               SUM(loaded_qty), SUM(qc_qty)
+        FROM daily_booking_stats
+        WHERE day >= date('now', ?)
+        GROUP BY crop
+        ORDER BY SUM(booked_qty) DESC
+    """, (since,))
+    tonnage_by_crop = cur.fetchall()
 
-    all_users = cur.fetchall()
-
-    # Get all main millers (not staff) for comparison
+    # Stock statistics by crop
     cur.execute("""
-        SELECT u.id, u.name
-        FROM users u
-        WHERE u.role = 'miller' AND (u.is_staff = 0 OR u.is_staff IS NULL)
-        ORDER BY u.name
+        SELECT crop, IFNULL(SUM(quantity), 0), COUNT(*)
+        FROM miller_stock
+        GROUP BY crop
     """)
-    millers = cur.fetchall()
+    crop_stats = {
+        crop: {'quantity': qty, 'count': n}
+        for crop, qty, n in cur.fetchall()
+    }
 
-    # Calculate statistics for charts
-    # Booking status distribution
-    pending_bookings = sum(1 for b in bookings if b[7] == 'pending')
-    approved_bookings = sum(1 for b in bookings if b[7] == 'approved')
-    declined_bookings = sum(1 for b in bookings if b[7] == 'declined')
-    
-    # Total revenue (from approved bookings)
-    total_revenue = sum(b[6] for b in bookings if b[7] == 'approved')
-    
-    # Stock statistics by crop
-    crop_stats = {}
-    for stock in stocks:
-        crop = stock[2]
-        if crop not in crop_stats:
-            crop_stats[crop] = {'quantity': 0, 'count': 0}
-        crop_stats[crop]['quantity'] += stock[3] or 0
-        crop_stats[crop]['count'] += 1
-    
-    # Recent bookings (last 7 days)
+    # Recent bookings per day in the range
     cur.execute("""
-        SELECT DATE(created_at) as date, COUNT(*) as count
-        FROM miller_bookings
-        WHERE created_at >= datetime('now', '-7 days')
-        GROUP BY DATE(created_at)
-        ORDER BY date ASC
-    """)
+        SELECT day, SUM(bookings)
+        FROM daily_booking_stats
+        WHERE day >= date('now', ?)
+        GROUP BY day
+        ORDER BY day ASC
+    """, (since,))
     recent_data = cur.fetchall()
     recent_bookings_dates = [row[0] or '' for row in recent_data]
     recent_bookings_counts = [row[1] or 0 for row in recent_data]
-    
-    # User status distribution
-    approved_users = sum(1 for u in users if u[4] == 'approved')
-    pending_users = sum(1 for u in users if u[4] == 'pending')
-    blocked_users = sum(1 for u in users if u[4] == 'blocked')
-    
-    # Total bookings count
-    total_bookings = len(bookings)
-    
-    # Total stock quantity
-    total_stock_qty = sum(s[3] or 0 for s in stocks)
 
     con.close()
 
     return render_template(
         "admin.html",
-       users=users,
-    stocks=stocks,
-    history=history,
-    bills=[],
-    bookings=bookings,
-    miller_profiles=miller_profiles,
-    farmer_count=farmer_count,
-    buyer_profiles=buyer_profiles,
-    buyer_count=buyer_count,
-    miller_count=miller_count,
-    all_users=all_users,
-    millers=millers,
-    # Chart data
-    pending_bookings=pending_bookings,
-    approved_bookings=approved_bookings,
-    declined_bookings=declined_bookings,
-    total_revenue=total_revenue,
-    crop_stats=crop_stats,
-    recent_bookings_dates=recent_bookings_dates,
-    recent_bookings_counts=recent_bookings_counts,
-    approved_users=approved_users,
-    pending_users=pending_users,
-    blocked_users=blocked_users,
-    total_bookings=total_bookings,
-    total_stock_qty=total_stock_qty,
+        farmer_count=role_counts.get("farmer", 0),
+        buyer_count=role_counts.get("buyer", 0),
+        miller_count=role_counts.get("miller", 0),
+        # Chart data
+        pending_bookings=booking_counts.get("pending", 0),
+        approved_bookings=booking_counts.get("approved", 0),
+        declined_bookings=booking_counts.get("declined", 0),
+        # Total revenue (paid payments)
+        total_revenue=revenue.get("paid", 0),
+        pending_revenue=revenue.get("pending", 0),
+        crop_stats=crop_stats,
+        recent_bookings_dates=recent_bookings_dates,
+        recent_bookings_counts=recent_bookings_counts,
+        approved_users=status_counts.get("approved", 0),
+        pending_users=status_counts.get("pending", 0),
+        blocked_users=status_counts.get("blocked", 0),
+        total_bookings=sum(booking_counts.values()),
+        total_stock_qty=sum(c['quantity'] for c in crop_stats.values()),
+        days=days,
+        ranges=ADMIN_RANGES,
+        tonnage_by_crop=tonnage_by_crop,
+        payment_stats=payment_stats,
     )
     
 @app.route("/admin/api/miller_stock/<int:miller_id>")
@@ -3423,6 +6068,115 @@ def get_miller_stock_api(miller_id):
         "stocks": stock_data
     }
 
+MAX_COMPARE_MILLERS = 50
+
+@app.route("/admin/api/miller_compare")
+def miller_compare_api():
+    """Crop x miller matrix of each miller's latest open lot, for admin_compare.
+
+    ?ids=2,5,9 (order kept) and optional &crop=wheat. One query for any number
+    of millers; the response carries an ETag so an unchanged matrix is a 304.
+    """
+    if session.get("role") != "admin":
+        return {"error": "Unauthorized"}, 403
+
+    ids = []
+    for part in (request.args.get("ids") or "").split(","):
+        if part.strip().isdigit() and int(part) not in ids:
+            ids.append(int(part))
+    ids = ids[:MAX_COMPARE_MILLERS]
+    if not ids:
+        return {"error": "No millers selected"}, 400
+
+    crop = (request.args.get("crop") or "").strip().lower()
+    marks = ",".join("?" * len(ids))
+    crop_clause = "AND LOWER(ms.crop) = ?" if crop else ""
+
+    con = get_db()
+    cur = con.cursor()
+
+    # Latest open lot per (miller, crop), joined back to every requested
+    # miller so ones with nothing open still get a column
+    cur.execute(f"""
+        WITH latest AS (
+            SELECT ms.miller_id, ms.crop, ms.price, ms.quantity, ms.deduction,
+                   ms.condition, ms.bag_type, ms.created_at,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY ms.miller_id, ms.crop
+                       ORDER BY ms.created_at DESC, ms.id DESC
+                   ) AS rn
+            FROM miller_stock ms
+            WHERE ms.miller_id IN ({marks})
+              AND ms.status = 'open' AND ms.quantity > 0
+              {crop_clause}
+        )
+        SELECT u.id, u.name, l.crop, l.price, l.quantity, l.deduction,
+               l.condition, l.bag_type, l.created_at
+        FROM users u
+        LEFT JOIN latest l ON l.miller_id = u.id AND l.rn = 1
+        WHERE u.id IN ({marks}) AND u.role = 'miller'
+    """, (*ids, *([crop] if crop else []), *ids))
+    rows = cur.fetchall()
+    con.close()
+
+    names = {}
+    matrix = {}
+    for miller_id, name, crop_name, price, qty, deduction, condition, bag_type, created_at in rows:
+        names[miller_id] = name
+        if crop_name is None:
+            continue
+        matrix.setdefault(crop_name, {})[str(miller_id)] = {
+            "price": price,
+            "quantity": qty,
+            "deduction": deduction,
+            "condition": condition,
+            "bag_type": bag_type,
+            "created_at": created_at,
+        }
+
+    resp = jsonify({
+        "millers": [{"id": i, "name": names[i]} for i in ids if i in names],
+        "crops": sorted(matrix),
+        "matrix": {c: matrix[c] for c in sorted(matrix)},
+    })
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.add_etag()
+    return resp.make_conditional(request)
+
+@app.route("/admin/api/db_stats")
+def get_db_stats_api():
+    """Connection pool, market cache and live feed counters for this worker process"""
+    if session.get("role") != "admin":
+        return {"error": "Unauthorized"}, 403
+
+    return dict(
+        get_db_stats(),
+        market_cache=dict(market_cache_stats),
+        sse_subscribers=event_bus.subscriber_count(),
+        pid=os.getpid(),
+    )
+
+@app.route("/admin/api/broadcasts")
+def get_broadcasts_api():
+    """Progress of recent SMS broadcasts"""
+    if session.get("role") != "admin":
+        return {"error": "Unauthorized"}, 403
+
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("""
+        SELECT id, kind, stock_id, status, total_recipients, sent_count,
+               failed_count, created_at, expanded_at, finished_at
+        FROM sms_broadcasts
+        ORDER BY id DESC
+        LIMIT 50
+    """)
+    cols = [d[0] for d in cur.description]
+    broadcasts = [dict(zip(cols, r)) for r in cur.fetchall()]
+    con.close()
+
+    return {"broadcasts": broadcasts}
+
 @app.route("/admin/compare")
 def admin_compare():
     """Miller Rate Comparison Page"""
@@ -3454,7 +6208,7 @@ def admin_users():
     con = get_db()
     cur = con.cursor()
     
-    cur.execute("""
+    all_users, pager = fetch_page(cur, """
     SELECT
         u.id,                     -- 0
         u.name,                   -- 1
@@ -3469,10 +6223,9 @@ def admin_users():
     WHERE u.role != 'admin'
     ORDER BY u.id DESC
 """)
-    all_users = cur.fetchall()
     con.close()
     
-    return render_template("admin_users.html", all_users=all_users)
+    return render_template("admin_users.html", all_users=all_users, pager=pager)
 
 @app.route("/admin/stock")
 def admin_stock():
@@ -3483,16 +6236,15 @@ def admin_stock():
     con = get_db()
     cur = con.cursor()
     
-    cur.execute("""
+    stocks, pager = fetch_page(cur, """
     SELECT miller_stock.*, users.name
     FROM miller_stock
     JOIN users ON miller_stock.miller_id = users.id
-    ORDER BY miller_stock.created_at DESC
+    ORDER BY miller_stock.created_at DESC, miller_stock.id DESC
     """)
-    stocks = cur.fetchall()
     con.close()
     
-    return render_template("admin_stock.html", stocks=stocks)
+    return render_template("admin_stock.html", stocks=stocks, pager=pager)
 
 @app.route("/admin/stock-history")
 def admin_stock_history():
@@ -3503,16 +6255,15 @@ def admin_stock_history():
     con = get_db()
     cur = con.cursor()
     
-    cur.execute("""
+    history, pager = fetch_page(cur, """
     SELECT h.*, u.name
     FROM miller_stock_history h
     JOIN users u ON h.miller_id = u.id
-    ORDER BY h.updated_at DESC
+    ORDER BY h.updated_at DESC, h.id DESC
     """)
-    history = cur.fetchall()
     con.close()
     
-    return render_template("admin_stock_history.html", history=history)
+    return render_template("admin_stock_history.html", history=history, pager=pager)
 
 @app.route("/admin/bookings")
 def admin_bookings():
@@ -3523,7 +6274,7 @@ def admin_bookings():
     con = get_db()
     cur = con.cursor()
     
-    cur.execute("""
+    bookings, pager = fetch_page(cur, """
     SELECT
         mb.id,                 -- 0 Booking ID
         buyer.name,            -- 1 Buyer
@@ -3544,12 +6295,11 @@ def admin_bookings():
     JOIN users buyer ON mb.buyer_id = buyer.id
     JOIN miller_stock ms ON mb.stock_id = ms.id
     JOIN users miller ON ms.miller_id = miller.id
-    ORDER BY mb.created_at DESC
+    ORDER BY mb.created_at DESC, mb.id DESC
 """)
-    bookings = cur.fetchall()
     con.close()
     
-    return render_template("admin_bookings.html", bookings=bookings)
+    return render_template("admin_bookings.html", bookings=bookings, pager=pager)
 
 @app.route("/admin/miller-profiles")
 def admin_miller_profiles():
@@ -3560,7 +6310,7 @@ def admin_miller_profiles():
     con = get_db()
     cur = con.cursor()
     
-    cur.execute("""
+    miller_profiles, pager = fetch_page(cur, """
         SELECT
             mp.id,
             u.name,
@@ -3573,12 +6323,11 @@ def admin_miller_profiles():
             mp.created_at
         FROM miller_profiles mp
         JOIN users u ON mp.miller_id = u.id
-        ORDER BY mp.created_at DESC
+        ORDER BY mp.created_at DESC, mp.id DESC
     """)
-    miller_profiles = cur.fetchall()
     con.close()
     
-    return render_template("admin_miller_profiles.html", miller_profiles=miller_profiles)
+    return render_template("admin_miller_profiles.html", miller_profiles=miller_profiles, pager=pager)
 
 @app.route("/admin/buyer-profiles")
 def admin_buyer_profiles():
@@ -3589,7 +6338,7 @@ def admin_buyer_profiles():
     con = get_db()
     cur = con.cursor()
     
-    cur.execute("""
+    buyer_profiles, pager = fetch_page(cur, """
         SELECT
         bp.id,
         u.name,
@@ -3600,12 +6349,11 @@ def admin_buyer_profiles():
         bp.created_at
     FROM buyer_profiles bp
     JOIN users u ON bp.buyer_id = u.id
-    ORDER BY bp.created_at DESC
+    ORDER BY bp.created_at DESC, bp.id DESC
     """)
-    buyer_profiles = cur.fetchall()
     con.close()
     
-    return render_template("admin_buyer_profiles.html", buyer_profiles=buyer_profiles)
+    return render_template("admin_buyer_profiles.html", buyer_profiles=buyer_profiles, pager=pager)
 
 @app.route("/admin/update_deduction/<int:stock_id>", methods=["POST"])
 def admin_update_deduction(stock_id):
@@ -3688,13 +6436,9 @@ def admin_approve_booking(id):
 
     con = get_db()
     cur = con.cursor()
+    begin_write(con)
 
-    cur.execute("""
-        UPDATE miller_bookings
-        SET status='approved',
-            decision_at=CURRENT_TIMESTAMP
-        WHERE id=?
-    """, (id,))
+    approve_booking(cur, id)
 
     con.commit()
     con.close()
@@ -3706,14 +6450,9 @@ def admin_decline_booking(id):
 
     con = get_db()
     cur = con.cursor()
+    begin_write(con)
 
-    cur.execute("""
-        UPDATE miller_bookings
-        SET status='declined',
-            decision_at=CURRENT_TIMESTAMP,
-            reason='Declined by admin'
-        WHERE id=?
-    """, (id,))
+    decline_booking(cur, id, 'Declined by admin')
 
     con.commit()
     con.close()
@@ -0,0 +1,97 @@
+// Offline submit queue, shared by the pages (_offline_queue.html) and the
+// service worker (sw.js). Loading and QC submits are kept in IndexedDB until
+// the server has answered them, so lost signal or a closed tab loses nothing.
+// Every entry carries its own Idempotency-Key, so a replay that races another
+// (page and worker both flushing) is only applied once.
+const OfflineQueue = (() => {
+  const DB_NAME = 'saarna-offline';
+  const STORE = 'submits';
+
+  function open() {
+    return new Promise((resolve, reject) => {
+      const req = indexedDB.open(DB_NAME, 1);
+      req.onupgradeneeded = () => req.result.createObjectStore(STORE, { keyPath: 'key' });
+      req.onsuccess = () => resolve(req.result);
+      req.onerror = () => reject(req.error);
+    });
+  }
+
+  function run(mode, fn) {
+    return open().then(db => new Promise((resolve, reject) => {
+      const req = fn(db.transaction(STORE, mode).objectStore(STORE));
+      req.onsuccess = () => resolve(req.result);
+      req.onerror = () => reject(req.error);
+    }));
+  }
+
+  function newKey() {
+    if (self.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+  }
+
+  // Files are stored as plain bytes; some mobile browsers cannot keep File
+  // objects in IndexedDB. A form's own idempotency_key is reused, so a double
+  // tap replaces the queued entry instead of adding a second one.
+  async function enqueue(url, formData, label, key = newKey()) {
+    const fields = [];
+    for (const [name, value] of formData.entries()) {
+      if (typeof value === 'string') {
+        fields.push([name, value]);
+      } else if (value.size) {
+        fields.push([name, { bytes: await value.arrayBuffer(), filename: value.name, type: value.type }]);
+      }
+    }
+    const entry = { key, url, label, fields, created: Date.now() };
+    await run('readwrite', store => store.put(entry));
+    return entry;
+  }
+
+  function toFormData(fields) {
+    const fd = new FormData();
+    fields.forEach(([name, value]) => {
+      if (typeof value === 'string') fd.append(name, value);
+      else fd.append(name, new Blob([value.bytes], { type: value.type }), value.filename);
+    });
+    return fd;
+  }
+
+  const count = () => run('readonly', store => store.count());
+
+  // Send queued submits oldest first. Stops at the first network error,
+  // 401 (logged out), 409 (same key still running) or 5xx and leaves the
+  // rest queued; any other answer removes the entry and is reported back
+  // as {label, ok, error}.
+  async function send() {
+    const results = [];
+    const entries = (await run('readonly', store => store.getAll()))
+      .sort((a, b) => a.created - b.created);
+
+    for (const entry of entries) {
+      let res;
+      try {
+        res = await fetch(entry.url, {
+          method: 'POST',
+          body: toFormData(entry.fields),
+          credentials: 'same-origin',
+          headers: { 'Accept': 'application/json', 'Idempotency-Key': entry.key },
+        });
+      } catch (e) {
+        break;
+      }
+      if (res.status === 401 || res.status === 409 || res.status >= 500) break;
+
+      const data = await res.json().catch(() => ({}));
+      await run('readwrite', store => store.delete(entry.key));
+      results.push({ label: entry.label, ok: data.ok === true, error: data.error || `HTTP ${res.status}` });
+    }
+    return results;
+  }
+
+  let flushing = null;
+  function flush() {
+    if (!flushing) flushing = send().finally(() => { flushing = null; });
+    return flushing;
+  }
+
+  return { enqueue, flush, count, newKey };
+})();
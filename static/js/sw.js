@@ -0,0 +1,124 @@
+// Service worker (served at /sw.js so it controls every page).
+//   static assets      stale-while-revalidate, precached on install
+//   open-bookings pages network first, last copy served when offline
+//   queued submits     replayed on Background Sync / when a page asks
+importScripts('/static/js/offline-queue.js');
+
+const STATIC_CACHE = 'static-v1';
+const PAGE_CACHE = 'pages';
+
+const STATIC_ASSETS = [
+  '/static/css/style.css',
+  '/static/js/offline-queue.js',
+  '/static/image/images.png',
+  'https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css',
+  'https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/js/bootstrap.bundle.min.js',
+  'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.5.0/css/all.min.css',
+  'https://unpkg.com/aos@2.3.1/dist/aos.css',
+  'https://unpkg.com/aos@2.3.1/dist/aos.js',
+];
+
+// Pages listing the user's open bookings (the loading / QC forms live here)
+const OFFLINE_PAGES = [
+  '/market', '/buyer/active', '/buyer/partial',
+  '/miller', '/miller/approved', '/miller/qc',
+];
+
+const OFFLINE_HTML = `<!DOCTYPE html><meta name="viewport" content="width=device-width, initial-scale=1">
+<p style="font-family:sans-serif;padding:24px">📴 No network, and this page has not been opened on this phone yet.</p>`;
+
+self.addEventListener('install', event => {
+  event.waitUntil(caches.open(STATIC_CACHE).then(cache => Promise.all(
+    STATIC_ASSETS.map(url =>
+      fetch(url, { mode: url.startsWith('/') ? 'same-origin' : 'no-cors' })
+        .then(res => cache.put(url, res))
+        .catch(() => {})
+    )
+  )).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+  event.waitUntil(caches.keys().then(keys => Promise.all(
+    keys.filter(key => key.startsWith('static-') && key !== STATIC_CACHE)
+      .map(key => caches.delete(key))
+  )).then(() => self.clients.claim()));
+});
+
+async function networkFirst(request) {
+  const cache = await caches.open(PAGE_CACHE);
+  try {
+    const res = await fetch(request);
+    // A redirect here means logged out; don't keep the login page
+    if (res.ok && !res.redirected) cache.put(request.url, res.clone());
+    return res;
+  } catch (e) {
+    const hit = await cache.match(request.url) || await cache.match(request.url, { ignoreSearch: true });
+    return hit || new Response(OFFLINE_HTML, {
+      status: 503,
+      headers: { 'Content-Type': 'text/html; charset=utf-8' },
+    });
+  }
+}
+
+async function staleWhileRevalidate(event) {
+  const cache = await caches.open(STATIC_CACHE);
+  const hit = await cache.match(event.request);
+  const refresh = fetch(event.request).then(res => {
+    if (res.ok || res.type === 'opaque') cache.put(event.request, res.clone());
+    return res;
+  });
+  if (hit) {
+    event.waitUntil(refresh.catch(() => {}));
+    return hit;
+  }
+  return refresh;
+}
+
+self.addEventListener('fetch', event => {
+  const request = event.request;
+  if (request.method !== 'GET') return;
+  const url = new URL(request.url);
+  const local = url.origin === location.origin;
+
+  if (local && url.pathname === '/logout') {
+    // Gate phones are shared; don't leave one user's bookings for the next
+    event.respondWith(caches.delete(PAGE_CACHE).then(() => fetch(request)));
+  } else if (local && request.mode === 'navigate' && OFFLINE_PAGES.includes(url.pathname)) {
+    event.respondWith(networkFirst(request));
+  } else if (local ? url.pathname.startsWith('/static/') && !url.pathname.startsWith('/static/uploads/')
+                   : STATIC_ASSETS.includes(request.url)) {
+    event.respondWith(staleWhileRevalidate(event));
+  }
+});
+
+async function flushQueue() {
+  const results = await OfflineQueue.flush();
+  if (!results.length) return;
+  const pages = await self.clients.matchAll({ type: 'window' });
+  pages.forEach(page => page.postMessage({ type: 'offline-queue', results }));
+}
+
+// Cache the role's open-bookings pages the first time, so they work offline
+// even if the user never opened them while online
+async function warm(urls) {
+  const cache = await caches.open(PAGE_CACHE);
+  for (const url of urls.filter(u => OFFLINE_PAGES.includes(u))) {
+    if (await cache.match(url)) continue;
+    try {
+      const res = await fetch(url, { credentials: 'same-origin' });
+      if (res.ok && !res.redirected) await cache.put(url, res);
+    } catch (e) {
+      return;
+    }
+  }
+}
+
+self.addEventListener('sync', event => {
+  if (event.tag === 'offline-queue') event.waitUntil(flushQueue());
+});
+
+self.addEventListener('message', event => {
+  const msg = event.data || {};
+  if (msg.type === 'flush') event.waitUntil(flushQueue());
+  if (msg.type === 'warm') event.waitUntil(warm(msg.urls || []));
+});